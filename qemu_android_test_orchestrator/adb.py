@@ -0,0 +1,147 @@
+import asyncio
+import os
+import shlex
+import struct
+import time
+from typing import Dict, Tuple, Optional
+
+ADB_SERVER_PORT = 5037
+# Largest DATA packet the sync protocol accepts
+SYNC_DATA_MAX = 64 * 1024
+
+
+class AdbError(Exception):
+    pass
+
+
+class AdbClient:
+    # Talks to the adb server over its smart socket protocol instead of forking an adb client for every command. Each
+    # request is a 4-digit hex length followed by the service name, answered with OKAY or FAIL plus a message.
+    # Connections that switched to a device service belong to it until it ends, so every call opens its own, which
+    # is cheap on loopback compared to spawning a process.
+
+    def __init__(self, host: str = '127.0.0.1', port: int = ADB_SERVER_PORT) -> None:
+        self.host = host
+        self.port = port
+
+    async def start_server(self) -> None:
+        proc = await asyncio.create_subprocess_exec('adb', 'start-server', stdout=asyncio.subprocess.DEVNULL,
+                                                    stderr=asyncio.subprocess.DEVNULL)
+        await proc.wait()
+
+    async def connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        try:
+            return await asyncio.open_connection(self.host, self.port)
+        except ConnectionRefusedError:
+            # Nobody started the server yet (or Gradle killed it), do what the adb client would do
+            await self.start_server()
+            return await asyncio.open_connection(self.host, self.port)
+
+    @staticmethod
+    async def _read_status(reader: asyncio.StreamReader) -> None:
+        status = await reader.readexactly(4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise AdbError(await AdbClient._read_message(reader))
+        raise AdbError(f"Unexpected reply from the adb server: {status!r}")
+
+    @staticmethod
+    async def _read_message(reader: asyncio.StreamReader) -> str:
+        length = int(await reader.readexactly(4), 16)
+        return (await reader.readexactly(length)).decode(errors='replace')
+
+    async def request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, service: str) -> None:
+        data = service.encode()
+        writer.write(b'%04x' % len(data) + data)
+        await writer.drain()
+        await self._read_status(reader)
+
+    async def register_emulator(self, console_port: int) -> None:
+        # The server doesn't reply to this one
+        reader, writer = await self.connect()
+        data = f'host:emulator:{console_port}'.encode()
+        writer.write(b'%04x' % len(data) + data)
+        await writer.drain()
+        writer.close()
+
+    @staticmethod
+    def _parse_devices(data: str) -> Dict[str, str]:
+        devices = {}
+        for line in data.splitlines():
+            serial, _, state = line.partition('\t')
+            if serial:
+                devices[serial] = state
+        return devices
+
+    async def wait_for_device(self, serial: str, state: str = 'device', timeout: Optional[float] = None) -> None:
+        # The server pushes the whole device list whenever something changes, so there is nothing to poll
+        reader, writer = await self.connect()
+        try:
+            await self.request(reader, writer, 'host:track-devices')
+            deadline = asyncio.get_event_loop().time() + timeout if timeout is not None else None
+            while True:
+                remaining = deadline - asyncio.get_event_loop().time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise asyncio.TimeoutError(f"Timeout waiting for {serial} to become '{state}'")
+                devices = self._parse_devices(await asyncio.wait_for(self._read_message(reader), remaining))
+                if devices.get(serial) == state:
+                    return
+        finally:
+            writer.close()
+
+    async def open_service(self, serial: str, service: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await self.connect()
+        try:
+            await self.request(reader, writer, f'host:transport:{serial}')
+            await self.request(reader, writer, service)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def open_shell(self, serial: str, *command: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        # Closing the writer hangs up the remote process
+        return await self.open_service(serial, 'shell:' + ' '.join(shlex.quote(c) for c in command))
+
+    async def shell(self, serial: str, *command: str) -> bytes:
+        reader, writer = await self.open_shell(serial, *command)
+        try:
+            return await reader.read()
+        finally:
+            writer.close()
+
+    async def push(self, serial: str, local_path: str, remote_path: str, mode: int = 0o644) -> None:
+        reader, writer = await self.open_service(serial, 'sync:')
+        try:
+            target = f'{remote_path},{mode}'.encode()
+            writer.write(b'SEND' + struct.pack('<I', len(target)) + target)
+            with open(local_path, 'rb') as f:
+                while True:
+                    chunk = f.read(SYNC_DATA_MAX)
+                    if not chunk:
+                        break
+                    writer.write(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+                    await writer.drain()
+            writer.write(b'DONE' + struct.pack('<I', int(os.stat(local_path).st_mtime or time.time())))
+            await writer.drain()
+
+            status, length = struct.unpack('<4sI', await reader.readexactly(8))
+            if status == b'FAIL':
+                raise AdbError(f"Unable to push '{local_path}': {(await reader.readexactly(length)).decode()}")
+            if status != b'OKAY':
+                raise AdbError(f"Unexpected sync reply: {status!r}")
+            writer.write(b'QUIT' + struct.pack('<I', 0))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def install(self, serial: str, local_path: str, *options: str) -> None:
+        remote_path = f'/data/local/tmp/{os.path.basename(local_path)}'
+        await self.push(serial, local_path, remote_path)
+        try:
+            output = await self.shell(serial, 'pm', 'install', *options, remote_path)
+        finally:
+            await self.shell(serial, 'rm', '-f', remote_path)
+        if b'Success' not in output:
+            raise AdbError(f"Unable to install '{local_path}': {output.decode(errors='replace').strip()}")
@@ -0,0 +1,68 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+from typing import Optional
+
+from qemu_android_test_orchestrator.config import get_config
+from qemu_android_test_orchestrator.utils import Color
+
+
+async def submit(socket_path: str, command: Optional[str], workdir: Optional[str], wait: bool) -> int:
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    request = {'action': 'submit', 'wait': wait}
+    if command:
+        request['job_command'] = command
+    if workdir:
+        request['job_workdir'] = os.path.abspath(workdir)
+    writer.write(json.dumps(request).encode() + b'\n')
+    await writer.drain()
+
+    returncode = 0
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        reply = json.loads(line)
+        if reply['status'] == 'leased':
+            print(Color.GREEN + f"Job {reply['job']} is running on {reply['vm']} ({reply['adb_serial']})" + Color.RESET)
+            if not wait:
+                break
+        elif reply['status'] == 'finished':
+            returncode = reply['returncode'] if reply['returncode'] is not None else 1
+            break
+        else:
+            print(Color.RED + f"Daemon error: {reply.get('error')}" + Color.RESET)
+            returncode = 1
+            break
+    writer.close()
+    return returncode
+
+
+async def status(socket_path: str) -> int:
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(json.dumps({'action': 'status'}).encode() + b'\n')
+    await writer.drain()
+    print(json.dumps(json.loads(await reader.readline()), indent=2))
+    writer.close()
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Submit a job to a running orchestrator daemon")
+    parser.add_argument('--socket', help="daemon socket path (default: daemon_socket from the config)")
+    parser.add_argument('--workdir', help="working directory for the job")
+    parser.add_argument('--no-wait', action='store_true', help="return as soon as a VM is leased")
+    parser.add_argument('--status', action='store_true', help="print the daemon status and exit")
+    parser.add_argument('command', nargs='?', help="job command (default: job_command from the daemon's config)")
+    args = parser.parse_args()
+
+    socket_path = args.socket or get_config()['daemon_socket']
+    if args.status:
+        sys.exit(asyncio.run(status(socket_path)))
+    sys.exit(asyncio.run(submit(socket_path, args.command, args.workdir, not args.no_wait)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,121 @@
 import json
 import os
 from _warnings import warn
-from typing import TypeVar, Dict, Tuple, Callable
+from typing import TypeVar, Dict, Tuple, Callable, Any, List
 
 T = TypeVar('T')
 
 _default_cfg = {
     'job_workdir': None,
     'job_command': './gradlew connectedAndroidTest',
+    'job_prepare_command': None,
+    'job_prepare_nice': 10,
+    'job_prepare_cpus': None,
+    'job_sharding': False,
+    'job_shards': None,
+    'job_instrumentation': None,
+    'job_instrumentation_args': {},
+    'job_install_apks': [],
+    'job_timings_file': None,
+    'job_results_output': None,
     'virtwifi_hack': True,
     'virtwificonnector_apk': 'virtwificonnector-debug.apk',
+    'transfer_method': 'tcp',
+    'transfer_host_address': '10.0.2.2',
+    'transfer_serial_compress': True,
     'permission_approve': True,
+    # Only pressed if the dialog's positive button can't be found on screen
     'permission_approve_buttons': ['right', 'right', 'ret'],
+    # Window the permission dialog shows up in, and the button that grants the permission
+    'permission_dialog_window': 'UsbPermissionActivity',
+    'permission_positive_button': 'android:id/button1',
     'vnc_recorder': False,
     'vnc_recorder_debug': False,
     'vnc_recorder_bin': None,
     'vnc_recorder_output': 'qemu_recording.mp4',
     'vnc_recorder_port': 5910,
+    # Built-in recorder, grabs the screen through QMP and only keeps what changed
+    'screen_recorder': False,
+    'screen_recorder_output': 'screen_recording.qsr',
+    'screen_recorder_min_interval': 0.2,
+    'screen_recorder_max_interval': 2.0,
+    # Seconds kept in memory and only written out around test failures, None to record everything
+    'screen_recorder_failure_window': None,
     'qemu_workdir': None,
     'qemu_bin': f'qemu-system-{os.uname().machine}',
     'qemu_debug': False,
+    # With qemu_debug, the consoles are also logged as-is to <root>-vm<ext> and <root>-qemu<ext>
+    'qemu_debug_log': 'qemu_debug.log',
+    # Bytes per second of console output printed to the terminal, 0 for no limit
+    'qemu_debug_rate': 64 * 1024,
+    # Bytes of console output waiting for the rate limit, past that lines are dropped from the terminal
+    'qemu_debug_backlog': 1024 * 1024,
+    # Which lines are dropped when the backlog is full: oldest or newest
+    'qemu_debug_drop': 'oldest',
     'qemu_force_kvm': False,
+    # Size the VM (-smp, -m, hugepages, NUMA) and its drives (cache mode, iothreads) from what the host can offer
+    'qemu_tune': False,
+    # Only print the tuned QEMU args and the reasoning behind them, then exit
+    'qemu_tune_dry_run': False,
+    'qemu_max_vcpus': 4,
+    # MiB
+    'qemu_max_memory': 4096,
+    'qemu_min_memory': 2048,
+    'qemu_hugepages': True,
+    'instances': 1,
+    'daemon': False,
+    'daemon_socket': '/tmp/qemu-orchestrator.sock',
+    'daemon_pool_size': 1,
+    'qemu_serial_socket': '/tmp/qemu-android.sock',
+    'qemu_monitor_socket': '/tmp/qemu-monitor.sock',
+    # QMP socket, added to the QEMU command line by the orchestrator
+    'qemu_qmp_socket': '/tmp/qemu-qmp.sock',
+    'adb_port': 5555,
+    'vnc_display': 10,
+    'console_buffer_size': 4 * 1024 * 1024,
+    'qemu_serial_log': None,
+    'qemu_monitor_log': None,
+    'snapshot': False,
+    'snapshot_dir': None,
+    'provision': False,
+    'provision_dir': None,
+    'provision_data_size': '4G',
+    'provision_data_device': 'vdc',
+    'qemu_img_bin': 'qemu-img',
+    # Run every writable drive with an id on a throwaway copy, leaving the original images untouched
+    'image_overlays': False,
+    'image_overlay_dir': None,
+    # Port on the host's loopback accepting "reset <drive id>" requests, None to disable. Needs image_overlays.
+    'image_reset_port': None,
     'logcat_output': None,
     'dmesg_output': None,
     'bugreport_output': None,
+    # None writes the artifacts to the configured paths as is, gzip and zstd add a .gz/.zst suffix
+    'artifact_compression': None,
+    'artifact_max_size': 256 * 1024 * 1024,
+    'artifact_timeouts': {
+        'logcat': 120,
+        'dmesg': 60,
+        'bugreport': 600,
+    },
+    'logcat_stream_output': None,
+    'dmesg_stream_output': None,
+    'log_compression': 'gzip',
+    'log_rotate_size': 64 * 1024 * 1024,
+    'log_rotate_keep': 5,
+    'log_store_output': None,
+    'resource_sample_interval': 2.0,
+    'resource_guest_sample_every': 5,
+    'resource_samples_output': None,
+    'timeout_history': True,
+    'timeout_history_file': None,
+    'timeout_margin': 3.0,
+    'timeout_min_samples': 5,
+    'timeout_regression_factor': 2.0,
+    'timeout_calibration_reference': 0.5,
+    'trace_output': None,
+    'trace_summary': True,
+    'trace_summary_output': None,
     'qemu_args': [
         # CPU
         '-cpu', 'host',
@@ -40,14 +132,14 @@ _default_cfg = {
 
         # Generic hardware
         '-audiodev', 'none,id=audionull', '-device', 'AC97,audiodev=audionull',
-        '-netdev', 'user,id=network,hostfwd=tcp::5555-:5555',
+        '-netdev', 'user,id=network,hostfwd=tcp::{adb_port}-:5555',
         '-device', 'virtio-net-pci,netdev=network',
-        '-chardev', 'socket,id=serial0,server,path=/tmp/qemu-android.sock',
+        '-chardev', 'socket,id=serial0,server,path={qemu_serial_socket}',
         '-serial', 'chardev:serial0',
-        '-chardev', 'socket,id=monitor0,server,path=/tmp/qemu-monitor.sock',
+        '-chardev', 'socket,id=monitor0,server,path={qemu_monitor_socket}',
         '-monitor', 'chardev:monitor0',
         '-vga', 'qxl',
-        '-display', 'vnc=127.0.0.1:10',
+        '-display', 'vnc=127.0.0.1:{vnc_display}',
         #'-display', 'gtk,gl=on',
 
         # Drives and disk images
@@ -111,21 +203,92 @@ def space_separated_values(val: str) -> list:
 _environ_cfg: Dict[str, Tuple[str, Callable]] = {
     'job_workdir': ('JOB_WORKDIR', noop),
     'job_command': ('JOB_COMMAND', noop),
+    'job_prepare_command': ('JOB_PREPARE_COMMAND', noop),
+    'job_prepare_nice': ('JOB_PREPARE_NICE', int),
+    'job_prepare_cpus': ('JOB_PREPARE_CPUS', int),
+    'job_sharding': ('JOB_SHARDING', env_bool),
+    'job_shards': ('JOB_SHARDS', int),
+    'job_instrumentation': ('JOB_INSTRUMENTATION', noop),
+    'job_install_apks': ('JOB_INSTALL_APKS', space_separated_values),
+    'job_timings_file': ('JOB_TIMINGS_FILE', noop),
+    'job_results_output': ('JOB_RESULTS_OUTPUT', noop),
     'virtwifi_hack': ('VIRTWIFI_HACK', env_bool),
     'virtwificonnector_apk': ('VIRTWIFICONNECTOR_APK', noop),
+    'transfer_method': ('TRANSFER_METHOD', noop),
+    'transfer_host_address': ('TRANSFER_HOST_ADDRESS', noop),
+    'transfer_serial_compress': ('TRANSFER_SERIAL_COMPRESS', env_bool),
     'permission_approve': ('PERMISSION_APPROVE', env_bool),
+    'permission_dialog_window': ('PERMISSION_DIALOG_WINDOW', noop),
+    'permission_positive_button': ('PERMISSION_POSITIVE_BUTTON', noop),
     'vnc_recorder': ('VNC_RECORDER', env_bool),
     'vnc_recorder_debug': ('VNC_RECORDER_DEBUG', env_bool),
     'vnc_recorder_bin': ('VNC_RECORDER_BIN', noop),
     'vnc_recorder_output': ('VNC_RECORDER_OUTPUT', noop),
     'vnc_recorder_port': ('VNC_RECORDER_PORT', int),
+    'screen_recorder': ('SCREEN_RECORDER', env_bool),
+    'screen_recorder_output': ('SCREEN_RECORDER_OUTPUT', noop),
+    'screen_recorder_min_interval': ('SCREEN_RECORDER_MIN_INTERVAL', float),
+    'screen_recorder_max_interval': ('SCREEN_RECORDER_MAX_INTERVAL', float),
+    'screen_recorder_failure_window': ('SCREEN_RECORDER_FAILURE_WINDOW', float),
     'qemu_workdir': ('QEMU_WORKDIR', noop),
     'qemu_bin': ('QEMU_BIN', noop),
     'qemu_debug': ('QEMU_DEBUG', env_bool),
+    'qemu_debug_log': ('QEMU_DEBUG_LOG', noop),
+    'qemu_debug_rate': ('QEMU_DEBUG_RATE', int),
+    'qemu_debug_backlog': ('QEMU_DEBUG_BACKLOG', int),
+    'qemu_debug_drop': ('QEMU_DEBUG_DROP', noop),
     'qemu_force_kvm': ('QEMU_FORCE_KVM', env_bool),
+    'qemu_tune': ('QEMU_TUNE', env_bool),
+    'qemu_tune_dry_run': ('QEMU_TUNE_DRY_RUN', env_bool),
+    'qemu_max_vcpus': ('QEMU_MAX_VCPUS', int),
+    'qemu_max_memory': ('QEMU_MAX_MEMORY', int),
+    'qemu_min_memory': ('QEMU_MIN_MEMORY', int),
+    'qemu_hugepages': ('QEMU_HUGEPAGES', env_bool),
+    'instances': ('INSTANCES', int),
+    'daemon': ('ORCHESTRATOR_DAEMON', env_bool),
+    'daemon_socket': ('ORCHESTRATOR_DAEMON_SOCKET', noop),
+    'daemon_pool_size': ('ORCHESTRATOR_DAEMON_POOL_SIZE', int),
+    'qemu_serial_socket': ('QEMU_SERIAL_SOCKET', noop),
+    'qemu_monitor_socket': ('QEMU_MONITOR_SOCKET', noop),
+    'qemu_qmp_socket': ('QEMU_QMP_SOCKET', noop),
+    'adb_port': ('ADB_PORT', int),
+    'vnc_display': ('VNC_DISPLAY', int),
+    'console_buffer_size': ('CONSOLE_BUFFER_SIZE', int),
+    'qemu_serial_log': ('QEMU_SERIAL_LOG', noop),
+    'qemu_monitor_log': ('QEMU_MONITOR_LOG', noop),
+    'snapshot': ('SNAPSHOT', env_bool),
+    'snapshot_dir': ('SNAPSHOT_DIR', noop),
+    'provision': ('PROVISION', env_bool),
+    'provision_dir': ('PROVISION_DIR', noop),
+    'provision_data_size': ('PROVISION_DATA_SIZE', noop),
+    'provision_data_device': ('PROVISION_DATA_DEVICE', noop),
+    'qemu_img_bin': ('QEMU_IMG_BIN', noop),
+    'image_overlays': ('IMAGE_OVERLAYS', env_bool),
+    'image_overlay_dir': ('IMAGE_OVERLAY_DIR', noop),
+    'image_reset_port': ('IMAGE_RESET_PORT', int),
     'logcat_output': ('LOGCAT_OUTPUT', noop),
     'dmesg_output': ('DMESG_OUTPUT', noop),
-    'bugreport_output': ('BUGREPORT_OUTPUT', noop)
+    'bugreport_output': ('BUGREPORT_OUTPUT', noop),
+    'artifact_compression': ('ARTIFACT_COMPRESSION', noop),
+    'artifact_max_size': ('ARTIFACT_MAX_SIZE', int),
+    'logcat_stream_output': ('LOGCAT_STREAM_OUTPUT', noop),
+    'dmesg_stream_output': ('DMESG_STREAM_OUTPUT', noop),
+    'log_compression': ('LOG_COMPRESSION', noop),
+    'log_rotate_size': ('LOG_ROTATE_SIZE', int),
+    'log_rotate_keep': ('LOG_ROTATE_KEEP', int),
+    'log_store_output': ('LOG_STORE_OUTPUT', noop),
+    'resource_sample_interval': ('RESOURCE_SAMPLE_INTERVAL', float),
+    'resource_guest_sample_every': ('RESOURCE_GUEST_SAMPLE_EVERY', int),
+    'resource_samples_output': ('RESOURCE_SAMPLES_OUTPUT', noop),
+    'timeout_history': ('TIMEOUT_HISTORY', env_bool),
+    'timeout_history_file': ('TIMEOUT_HISTORY_FILE', noop),
+    'timeout_margin': ('TIMEOUT_MARGIN', float),
+    'timeout_min_samples': ('TIMEOUT_MIN_SAMPLES', int),
+    'timeout_regression_factor': ('TIMEOUT_REGRESSION_FACTOR', float),
+    'timeout_calibration_reference': ('TIMEOUT_CALIBRATION_REFERENCE', float),
+    'trace_output': ('TRACE_OUTPUT', noop),
+    'trace_summary': ('TRACE_SUMMARY', env_bool),
+    'trace_summary_output': ('TRACE_SUMMARY_OUTPUT', noop),
 }
 
 
@@ -145,3 +308,55 @@ def get_config() -> dict:
             cfg[item] = converter(os.environ[var])
 
     return cfg
+
+
+# Config entries that point to files and must be made unique when running more than one VM
+_per_instance_paths = (
+    'qemu_serial_socket', 'qemu_monitor_socket', 'qemu_qmp_socket', 'qemu_serial_log', 'qemu_monitor_log',
+    'logcat_output', 'dmesg_output', 'bugreport_output', 'logcat_stream_output', 'dmesg_stream_output',
+    'vnc_recorder_output', 'screen_recorder_output', 'log_store_output', 'resource_samples_output', 'trace_output',
+    'trace_summary_output', 'qemu_debug_log',
+)
+
+# Placeholders that can be used in qemu_args and are replaced with the instance's values
+_qemu_args_placeholders = ('qemu_serial_socket', 'qemu_monitor_socket', 'adb_port', 'vnc_display', 'instance')
+
+
+def instance_path(path: str, index: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f'{root}-{index}{ext}'
+
+
+def instance_config(config: Dict[str, Any], index: int) -> Dict[str, Any]:
+    cfg = config.copy()
+    if config['instances'] > 1 or config['daemon']:
+        for key in _per_instance_paths:
+            if cfg[key]:
+                cfg[key] = instance_path(cfg[key], index)
+        # adb only picks up emulators on even console ports, with the ADB port right after
+        cfg['adb_port'] = config['adb_port'] + 2 * index
+        cfg['vnc_display'] = config['vnc_display'] + index
+        cfg['vnc_recorder_port'] = config['vnc_recorder_port'] + index
+        if config['image_reset_port']:
+            cfg['image_reset_port'] = config['image_reset_port'] + index
+
+        if not any('{' + p + '}' in arg for arg in cfg['qemu_args'] for p in _qemu_args_placeholders):
+            warn("qemu_args doesn't use any per-instance placeholder, multiple VMs will likely collide",
+                 ResourceWarning)
+        if not cfg['image_overlays']:
+            # Writable drives (e.g. usb.img) can only be opened by one QEMU at a time, each VM needs its own copy
+            warn("Running more than one VM, enabling image_overlays", ResourceWarning)
+            cfg['image_overlays'] = True
+    cfg['instance'] = index
+    # The serial adb assigns to emulators is based on the console port, which is the ADB port minus one
+    cfg['adb_serial'] = f"emulator-{cfg['adb_port'] - 1}"
+    return cfg
+
+
+def format_qemu_args(config: Dict[str, Any]) -> List[str]:
+    args = []
+    for arg in config['qemu_args']:
+        for placeholder in _qemu_args_placeholders:
+            arg = arg.replace('{' + placeholder + '}', str(config[placeholder]))
+        args.append(arg)
+    return args
@@ -0,0 +1,106 @@
+import tempfile
+from typing import Optional, Tuple, BinaryIO
+
+
+class ConsoleBuffer:
+    # Fixed size ring buffer holding the most recent console output. Every byte ever written gets a monotonic offset, so
+    # consumers can remember where they stopped reading and ask for "everything since offset N". Bytes that fall off the
+    # ring are spilled to a log file on disk and can still be read back from there.
+
+    def __init__(self, capacity: int = 4 * 1024 * 1024, spill_path: Optional[str] = None) -> None:
+        if capacity <= 0:
+            raise ValueError("Console buffer capacity must be positive")
+        self.capacity = capacity
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._end = 0
+        self._spill: Optional[BinaryIO]
+        if spill_path:
+            self._spill = open(spill_path, 'w+b')
+        else:
+            self._spill = tempfile.TemporaryFile()
+
+    @property
+    def start_offset(self) -> int:
+        # Oldest offset still held in memory
+        return max(0, self._end - self.capacity)
+
+    @property
+    def end_offset(self) -> int:
+        # Offset of the next byte that will be written
+        return self._end
+
+    def __len__(self) -> int:
+        return self._end
+
+    def _spill_ring(self, start: int, end: int) -> None:
+        if start >= end:
+            return
+        if self._spill:
+            self._spill.seek(start)
+            for segment in self._segments(start, end):
+                self._spill.write(segment)
+
+    def write(self, data: bytes) -> None:
+        n = len(data)
+        if n == 0:
+            return
+
+        # Spill whatever is about to be overwritten
+        new_start = max(0, self._end + n - self.capacity)
+        self._spill_ring(self.start_offset, min(new_start, self._end))
+
+        if n > self.capacity:
+            # Data that doesn't even fit in the ring goes straight to disk
+            if self._spill:
+                self._spill.seek(self._end)
+                self._spill.write(data[:n - self.capacity])
+            self._end += n - self.capacity
+            data = data[n - self.capacity:]
+            n = self.capacity
+
+        pos = self._end % self.capacity
+        first = min(n, self.capacity - pos)
+        self._view[pos:pos + first] = data[:first]
+        if first < n:
+            self._view[:n - first] = data[first:]
+        self._end += n
+
+    def _segments(self, start: int, end: int) -> Tuple[memoryview, ...]:
+        if start >= end:
+            return ()
+        pos = start % self.capacity
+        length = end - start
+        if pos + length <= self.capacity:
+            return self._view[pos:pos + length],
+        return self._view[pos:], self._view[:length - (self.capacity - pos)]
+
+    def segments(self, offset: int = 0) -> Tuple[memoryview, ...]:
+        # Zero-copy views over the in-memory data from offset onwards. Views are only valid until the next write.
+        return self._segments(max(offset, self.start_offset), self._end)
+
+    def since(self, offset: int = 0) -> bytes:
+        offset = max(offset, 0)
+        chunks = []
+        if offset < self.start_offset and self._spill:
+            self._spill.flush()
+            self._spill.seek(offset)
+            chunks.append(self._spill.read(self.start_offset - offset))
+        chunks.extend(self.segments(offset))
+        return b''.join(chunks)
+
+    def tail(self, size: int) -> bytes:
+        return b''.join(self.segments(self._end - size))
+
+    def find(self, sub: bytes, offset: int = 0) -> int:
+        # Returns the absolute offset of the first occurrence of sub at or after offset, -1 if not found. Only searches
+        # data that is still in memory.
+        offset = max(offset, self.start_offset)
+        idx = self.since(offset).find(sub)
+        return -1 if idx < 0 else offset + idx
+
+    def close(self) -> None:
+        if self._spill:
+            self._spill_ring(self.start_offset, self._end)
+            self._spill.close()
+            self._spill = None
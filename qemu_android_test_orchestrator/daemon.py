@@ -0,0 +1,192 @@
+import asyncio
+import itertools
+import json
+import os
+import traceback
+from typing import Dict, Any, Set, List, Optional
+
+from qemu_android_test_orchestrator.session import Session
+from qemu_android_test_orchestrator.utils import Color
+
+# Job settings a client is allowed to override
+_job_overrides = ('job_command', 'job_workdir')
+
+
+class VmPool:
+    # Keeps a number of VMs booted up to ADB_UP, ready to be leased. Leased VMs are thrown away once their job is done
+    # and replaced in the background.
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.config = config
+        self.size: int = config['daemon_pool_size']
+        self.ready: 'asyncio.Queue[Session]' = asyncio.Queue()
+        self.booting = 0
+        self.sessions: List[Session] = []
+        self._indexes: Set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._failures = 0
+
+    def _allocate_index(self) -> int:
+        # Ports and socket paths are derived from the index, so it must be unique among live VMs
+        index = next(i for i in itertools.count() if i not in self._indexes)
+        self._indexes.add(index)
+        return index
+
+    async def _boot(self) -> None:
+        index = self._allocate_index()
+        session: Optional[Session] = None
+        try:
+            session = Session(self.config, index)
+            self.sessions.append(session)
+            await session.boot()
+        except Exception:
+            print(Color.RED + f"VM {index} failed to boot, discarding it" + Color.RESET)
+            traceback.print_exc()
+            if session:
+                await self.discard(session)
+            else:
+                self._indexes.discard(index)
+            # Don't hammer the host if VMs keep failing
+            self._failures += 1
+            await asyncio.sleep(min(60, 2 ** self._failures))
+        else:
+            self._failures = 0
+            print(Color.GREEN + f"{session.name} is ready" + Color.RESET)
+            self.ready.put_nowait(session)
+        finally:
+            self.booting -= 1
+            self._wakeup.set()
+
+    async def refill(self) -> None:
+        while True:
+            while self.ready.qsize() + self.booting < self.size:
+                self.booting += 1
+                asyncio.create_task(self._boot())
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+    async def lease(self) -> Session:
+        while True:
+            session = await self.ready.get()
+            self._wakeup.set()
+            qemu = session.shared_state.qemu_proc
+            if qemu and qemu.returncode is None:
+                return session
+            print(Color.RED + f"{session.name} died while parked, discarding it" + Color.RESET)
+            await self.discard(session)
+
+    async def discard(self, session: Session) -> None:
+        try:
+            await session.stop()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._indexes.discard(session.index)
+            if session in self.sessions:
+                self.sessions.remove(session)
+            self._wakeup.set()
+
+    async def shutdown(self) -> None:
+        await asyncio.gather(*(self.discard(s) for s in list(self.sessions)), return_exceptions=True)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'ready': self.ready.qsize(),
+            'booting': self.booting,
+            'size': self.size,
+            'vms': len(self.sessions),
+        }
+
+
+class Daemon:
+    # Serves jobs over a Unix socket. The protocol is one JSON object per line:
+    #   -> {"action": "submit", "job_command": "...", "job_workdir": "...", "wait": true}
+    #   <- {"status": "leased", "job": 1, "vm": "VM 0", "adb_serial": "emulator-5554"}
+    #   <- {"status": "finished", "job": 1, "returncode": 0}      (only if wait is true)
+    #   -> {"action": "status"}
+    #   <- {"status": "ok", "pool": {...}, "jobs": 3}
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.config = config
+        self.pool = VmPool(config)
+        self.jobs: Dict[int, asyncio.Task] = {}
+        self._job_ids = itertools.count(1)
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def run_job(self, job_id: int, session: Session) -> Optional[int]:
+        try:
+            await session.finish()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            await self.pool.discard(session)
+            del self.jobs[job_id]
+        print(Color.CYAN + f"Job {job_id} on {session.name} finished with code {session.returncode}" + Color.RESET)
+        return session.returncode
+
+    @staticmethod
+    async def reply(writer: asyncio.StreamWriter, message: Dict[str, Any]) -> None:
+        writer.write(json.dumps(message).encode() + b'\n')
+        await writer.drain()
+
+    async def submit(self, request: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
+        session = await self.pool.lease()
+        for key in _job_overrides:
+            if key in request:
+                session.config[key] = request[key]
+
+        job_id = next(self._job_ids)
+        task = asyncio.create_task(self.run_job(job_id, session))
+        self.jobs[job_id] = task
+        print(Color.CYAN + f"Job {job_id} leased {session.name}: {session.config['job_command']}" + Color.RESET)
+        await self.reply(writer, {
+            'status': 'leased', 'job': job_id, 'vm': session.name, 'adb_serial': session.config['adb_serial'],
+        })
+
+        if request.get('wait', True):
+            # The job keeps running if the client goes away
+            returncode = await asyncio.shield(task)
+            await self.reply(writer, {'status': 'finished', 'job': job_id, 'returncode': returncode})
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    action = request['action']
+                except (ValueError, KeyError, TypeError):
+                    await self.reply(writer, {'status': 'error', 'error': 'Malformed request'})
+                    continue
+
+                if action == 'submit':
+                    await self.submit(request, writer)
+                elif action == 'status':
+                    await self.reply(writer, {'status': 'ok', 'pool': self.pool.status(), 'jobs': len(self.jobs)})
+                else:
+                    await self.reply(writer, {'status': 'error', 'error': f"Unknown action '{action}'"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        path = self.config['daemon_socket']
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = await asyncio.start_unix_server(self.handle_client, path)
+        print(Color.GREEN + f"Accepting jobs on {path}, keeping {self.pool.size} VMs warm" + Color.RESET)
+        await self.pool.refill()
+
+    async def shutdown(self) -> None:
+        if self._server:
+            self._server.close()
+        tasks = list(self.jobs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.pool.shutdown()
+        if os.path.exists(self.config['daemon_socket']):
+            os.unlink(self.config['daemon_socket'])
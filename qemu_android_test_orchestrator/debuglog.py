@@ -0,0 +1,147 @@
+import asyncio
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple, BinaryIO, TextIO, Deque, List
+
+from qemu_android_test_orchestrator.utils import Color, ansi_escape
+
+# How often the writer thread wakes up while there are lines waiting for the rate limit or half a line sitting around
+FLUSH_INTERVAL = 0.1
+# Half a line is printed anyway once it's been waiting this long, e.g. a shell prompt
+PARTIAL_LINE_TIMEOUT = 0.5
+
+DROP_POLICIES = ('oldest', 'newest')
+
+
+class ConsoleDebugLog:
+    # Where the consoles' qemu_debug output goes. The console readers only hand raw chunks over a queue and a thread
+    # takes care of the rest: every chunk is appended as-is to a raw log per console, which never drops anything, and
+    # the lines are stripped of ANSI escapes and printed with a rate limit, so a chatty boot can't hold up the event
+    # loop on the terminal. Lines over the rate wait in a backlog of at most `backlog` bytes, and once that's full the
+    # oldest (or newest) ones are dropped from the terminal output.
+
+    def __init__(self, path: str, rate: Optional[int] = None, backlog: int = 1024 * 1024, drop: str = 'oldest',
+                 stream: Optional[TextIO] = None) -> None:
+        if drop not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy '{drop}', expected one of {', '.join(DROP_POLICIES)}")
+        self.path = path
+        self.rate = rate
+        self.backlog = backlog
+        self.drop = drop
+        self.stream = stream or sys.stdout
+        # Nothing is printed while muted, it still goes to the raw logs
+        self.muted = 0
+        self.dropped = 0
+        self._reported = 0
+        self._queue: 'queue.SimpleQueue[Optional[Tuple[str, bytes, bool]]]' = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._raw: Dict[str, BinaryIO] = {}
+        # Incomplete last line of each console and when it started
+        self._partial: Dict[str, Tuple[bytes, float]] = {}
+        self._pending: Deque[str] = deque()
+        self._pending_size = 0
+        self._allowance = float(rate or 0)
+        self._refilled = time.monotonic()
+
+    def raw_path(self, tag: str) -> str:
+        root, ext = os.path.splitext(self.path)
+        return f'{root}-{tag.lower()}{ext}'
+
+    def write(self, tag: str, data: bytes) -> None:
+        # Called from the event loop, never blocks
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run, name='qemu-debug-log', daemon=True)
+            self._thread.start()
+        self._queue.put((tag, data, self.muted > 0))
+
+    def _run(self) -> None:
+        closing = False
+        while not closing:
+            timeout = FLUSH_INTERVAL if self._pending or self._partial else None
+            batch: List[Optional[Tuple[str, bytes, bool]]] = []
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+                # Whatever piled up in the meantime is written together
+                while batch[-1] is not None:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch and batch[-1] is None:
+                closing = True
+                batch.pop()
+            for tag, data, muted in batch:  # type: ignore
+                self._feed(tag, data, muted)
+            for raw in self._raw.values():
+                raw.flush()
+            self._flush_partial(closing)
+            self._print(closing)
+        for raw in self._raw.values():
+            raw.close()
+        self._raw.clear()
+
+    def _feed(self, tag: str, data: bytes, muted: bool) -> None:
+        raw = self._raw.get(tag)
+        if not raw:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            raw = self._raw[tag] = open(self.raw_path(tag), 'wb')
+        raw.write(data)
+        if muted:
+            self._partial.pop(tag, None)
+            return
+        partial, since = self._partial.pop(tag, (b'', time.monotonic()))
+        lines = (partial + data).split(b'\n')
+        if lines[-1]:
+            self._partial[tag] = (lines[-1], since)
+        for line in lines[:-1]:
+            self._queue_line(tag, line)
+
+    def _flush_partial(self, force: bool) -> None:
+        now = time.monotonic()
+        for tag, (partial, since) in list(self._partial.items()):
+            if force or now - since >= PARTIAL_LINE_TIMEOUT:
+                del self._partial[tag]
+                self._queue_line(tag, partial)
+
+    def _queue_line(self, tag: str, line: bytes) -> None:
+        text = ansi_escape.sub(b'', line).replace(b'\r', b'').decode(errors='replace')
+        text = Color.YELLOW + f"{tag}:" + Color.RESET + f" {text}\n"
+        if self._pending_size + len(text) > self.backlog:
+            if self.drop == 'newest':
+                self.dropped += 1
+                return
+            while self._pending and self._pending_size + len(text) > self.backlog:
+                self._pending_size -= len(self._pending.popleft())
+                self.dropped += 1
+        self._pending.append(text)
+        self._pending_size += len(text)
+
+    def _print(self, everything: bool) -> None:
+        now = time.monotonic()
+        if self.rate:
+            # Up to a second worth of output can be printed in one go
+            self._allowance = min(float(self.rate), self._allowance + (now - self._refilled) * self.rate)
+        self._refilled = now
+        out = []
+        if self.dropped > self._reported:
+            out.append(Color.RED + f"[{self.dropped - self._reported} console lines not shown, the full output is in "
+                                   f"{', '.join(self.raw_path(tag) for tag in self._raw)}]" + Color.RESET + "\n")
+            self._reported = self.dropped
+        while self._pending and (everything or not self.rate or self._allowance > 0):
+            text = self._pending.popleft()
+            self._pending_size -= len(text)
+            self._allowance -= len(text)
+            out.append(text)
+        if out:
+            self.stream.write(''.join(out))
+            self.stream.flush()
+
+    async def close(self) -> None:
+        if not self._thread:
+            return
+        self._queue.put(None)
+        await asyncio.get_event_loop().run_in_executor(None, self._thread.join)
+        self._thread = None
@@ -0,0 +1,90 @@
+import asyncio
+from typing import Union, Pattern, Optional, List, NamedTuple, Match
+
+from qemu_android_test_orchestrator.console import ConsoleBuffer
+
+ExpectPattern = Union[bytes, Pattern[bytes]]
+
+
+class ExpectMatch(NamedTuple):
+    # Absolute console offsets of the match
+    start: int
+    end: int
+    data: bytes
+    match: Optional[Match[bytes]]
+
+
+class _Waiter:
+    def __init__(self, pattern: ExpectPattern, offset: int, future: asyncio.Future, overlap: int) -> None:
+        self.pattern = pattern
+        self.offset = offset
+        self.future = future
+        self.overlap = overlap
+
+
+class ExpectEngine:
+    # Pexpect-style matcher fed by the console reader. Each expectation is a future that resolves as soon as its pattern
+    # shows up in the console buffer. Only bytes that haven't been scanned yet are looked at, plus a small overlap so
+    # matches straddling two chunks are still found.
+
+    def __init__(self, buffer: ConsoleBuffer, max_match_size: int = 4096) -> None:
+        self.buffer = buffer
+        self.max_match_size = max_match_size
+        self._waiters: List[_Waiter] = []
+        self._closed = False
+
+    def _scan(self, waiter: _Waiter) -> bool:
+        offset = max(waiter.offset, self.buffer.start_offset)
+        data = self.buffer.since(offset)
+        if isinstance(waiter.pattern, bytes):
+            idx = data.find(waiter.pattern)
+            if idx >= 0:
+                result = ExpectMatch(offset + idx, offset + idx + len(waiter.pattern), waiter.pattern, None)
+                waiter.future.set_result(result)
+                return True
+        else:
+            m = waiter.pattern.search(data)
+            if m:
+                waiter.future.set_result(ExpectMatch(offset + m.start(), offset + m.end(), m.group(0), m))
+                return True
+        waiter.offset = max(offset, self.buffer.end_offset - waiter.overlap)
+        return False
+
+    def feed(self) -> None:
+        # Must be called after new data has been written to the buffer
+        pending = []
+        for waiter in self._waiters:
+            if waiter.future.done():
+                continue
+            if not self._scan(waiter):
+                pending.append(waiter)
+        self._waiters = pending
+
+    def expect(self, pattern: ExpectPattern, offset: Optional[int] = None) -> asyncio.Future:
+        # Offset defaults to the current end of the buffer, i.e. only output arriving from now on will match
+        future = asyncio.get_event_loop().create_future()
+        if self._closed:
+            future.set_exception(EOFError("Console is closed"))
+            return future
+        if offset is None:
+            offset = self.buffer.end_offset
+        overlap = len(pattern) - 1 if isinstance(pattern, bytes) else self.max_match_size
+        waiter = _Waiter(pattern, offset, future, overlap)
+        if not self._scan(waiter):
+            self._waiters.append(waiter)
+        return future
+
+    async def wait_for(self, pattern: ExpectPattern, timeout: Optional[float],
+                       offset: Optional[int] = None) -> Optional[ExpectMatch]:
+        # Returns None if the deadline expires before the pattern shows up
+        try:
+            return await asyncio.wait_for(self.expect(pattern, offset), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self) -> None:
+        self._closed = True
+        for waiter in self._waiters:
+            if not waiter.future.done():
+                waiter.future.set_exception(EOFError("Console is closed"))
+        self._waiters = []
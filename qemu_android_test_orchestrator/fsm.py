@@ -2,15 +2,19 @@
 
 import abc
 import asyncio
-import subprocess
 import traceback
 from enum import Enum, auto
-from typing import Optional, Dict, Sequence, List, Union
+from typing import Optional, Dict, Sequence, List, Union, Tuple, Hashable, TYPE_CHECKING
 
 import paco  # type: ignore
 
+from qemu_android_test_orchestrator.milestones import Milestones
 from qemu_android_test_orchestrator.shared_state import SynchronizedObject
-from qemu_android_test_orchestrator.utils import Color, balloon_stat
+from qemu_android_test_orchestrator.tracing import Tracer, NULL_TRACER
+from qemu_android_test_orchestrator.utils import Color
+
+if TYPE_CHECKING:
+    from qemu_android_test_orchestrator.resources import ResourceSampler
 
 
 class State(Enum):
@@ -82,33 +86,121 @@ class AbstractFSM(abc.ABC):
         raise NotImplemented
 
 
+def pretty_result(result: Union[TransitionResult, Exception, None]) -> str:
+    result_names = {
+        TransitionResult.DONE: Color.YELLOW + "Action performed" + Color.RESET,
+        TransitionResult.NOOP: Color.GREEN + "Ok" + Color.RESET,
+        TransitionResult.ERROR: Color.RED + "ERROR" + Color.RESET,
+        None: "Pending"
+    }
+
+    if isinstance(result, Exception):
+        return Color.RED + "ERROR! Shutting down" + Color.RESET
+    return result_names[result]
+
+
 class ManagerFSM(AbstractFSM):
-    def __init__(self) -> None:
+    def __init__(self, tracer: Tracer = NULL_TRACER, resources: Optional['ResourceSampler'] = None,
+                 milestones: Optional[Milestones] = None) -> None:
         super().__init__()
         self.__workers: List['WorkerFSM'] = []
+        self.tracer = tracer
+        self.resources = resources
+        self.milestones = milestones
 
     def register_worker(self, worker: 'WorkerFSM') -> None:
         self.__workers.append(worker)
 
     async def transition(self, wanted_state: State) -> TransitionResult:
+        with self.tracer.span(f'transition {wanted_state.name}', 'manager', track='manager'):
+            return await self._transition(wanted_state)
+
+    async def advance(self, states: Sequence[State]) -> None:
+        # Brings every worker through the given states. Instead of waiting at a barrier after each state, a worker
+        # enters its next state as soon as the milestones it needs are reached, so independent steps overlap. The
+        # manager's own state follows the slowest worker: a state is reached once every worker has entered it.
+        if not self.milestones:
+            for state in states:
+                await self.transition(state)
+            return
+
+        before = self.cur_state
+        for state in states:
+            if state not in _allowed_transitions[before]:
+                raise InvalidTransitionError(before, state)
+            before = state
+
+        milestones = self.milestones
+        milestones.reach(self.cur_state)
+        # Milestones nobody provides (e.g. the network when VirtWifi is disabled) are reached right away
+        provided = {m for w in self.__workers for state in states for m in w.provides.get(state, ())}
+        for worker in self.__workers:
+            for state in states:
+                for m in worker.requires.get(state, ()):
+                    if m not in provided:
+                        milestones.reach(m)
+
+        longest_name_len = max(map(len, (w.name for w in self.__workers))) + 1
+        entered = {state: 0 for state in states}
+
+        def print_reached(state: State) -> None:
+            message = f"Reached state {state}"
+            print(Color.BROWN + ('-' * len(message)))
+            print(message)
+            if self.resources:
+                print("Resource usage:", self.resources.describe())
+            print(('-' * len(message)) + Color.RESET)
+
+        async def run_worker(worker: 'WorkerFSM') -> None:
+            previous = self.cur_state
+            for state in states:
+                needs = worker.requires.get(state, (previous,))
+                if not all(milestones.reached(m) for m in needs):
+                    with self.tracer.span(f'{worker.name}: wait for {state.name} dependencies', 'scheduler',
+                                          track=worker.name):
+                        await milestones.wait(*needs)
+                result = await worker.transition(state)
+                for m in worker.provides.get(state, ()):
+                    milestones.reach(m)
+                print(f"{Color.CYAN}{(worker.name + ':').ljust(longest_name_len)}{Color.RESET} {state.name}: "
+                      f"{pretty_result(result)}")
+                entered[state] += 1
+                if entered[state] == len(self.__workers):
+                    self._cur_state = state
+                    milestones.reach(state)
+                    print_reached(state)
+                previous = state
+
+        message = f"Current state is {self.cur_state}, advancing to {states[-1]}"
+        print(Color.BROWN + ('-' * len(message)))
+        print(message)
+        print("Workers start each step as soon as what they depend on is ready")
+        print(('-' * len(message)) + Color.RESET)
+
+        self._wanted_state = states[-1]
+        tasks = [asyncio.create_task(run_worker(w)) for w in self.__workers]
+        try:
+            with self.tracer.span(f'advance to {states[-1].name}', 'manager', track='manager'):
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    if task.exception():
+                        raise task.exception()
+        except BaseException:
+            self._cur_state = State.UNKNOWN
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self._wanted_state = None
+
+    async def _transition(self, wanted_state: State) -> TransitionResult:
         self.check_transition(wanted_state)
         self._wanted_state = wanted_state
 
         coro_names: List[str] = [i.name for i in self.__workers]
         coro_results: List[Optional[TransitionResult]] = [None for _ in self.__workers]
 
-        def pretty_result(result: Union[TransitionResult, Exception, None]) -> str:
-            result_names = {
-                TransitionResult.DONE: Color.YELLOW + "Action performed" + Color.RESET,
-                TransitionResult.NOOP: Color.GREEN + "Ok" + Color.RESET,
-                TransitionResult.ERROR: Color.RED + "ERROR" + Color.RESET,
-                None: "Pending"
-            }
-
-            if isinstance(result, Exception):
-                return Color.RED + "ERROR! Shutting down" + Color.RESET
-            return result_names[result]
-
         def print_progress_update(task: asyncio.Task = None, result: Optional[TransitionResult] = None) -> None:
             longest_name_len = max(map(len, coro_names)) + 1
             if not task:
@@ -124,9 +216,8 @@ class ManagerFSM(AbstractFSM):
         print(Color.BROWN + ('-' * len(message)))
         print(message)
         print("Trying to reach next state, waiting for worker rendezvous")
-        print("Memory usage:")
-        subprocess.Popen(['free', '-h']).wait()
-        balloon_stat()
+        if self.resources:
+            print("Resource usage:", self.resources.describe())
         print(('-' * len(message)) + Color.RESET)
         print_progress_update()
 
@@ -167,10 +258,20 @@ class ManagerFSM(AbstractFSM):
 
 
 class WorkerFSM(AbstractFSM):
+    # Milestones needed before entering each state when the manager advances through several states at once. States
+    # that aren't listed wait for every worker to have entered the previous state, like a plain transition does.
+    requires: Dict[State, Tuple[Hashable, ...]] = {}
+    # Milestones reached once this worker has entered each state. They may be reached earlier on with reach().
+    provides: Dict[State, Tuple[Hashable, ...]] = {}
+
     def __init__(self, shared_state: SynchronizedObject) -> None:
         super().__init__()
         self.shared_state = shared_state
 
+    def reach(self, milestone: Hashable) -> None:
+        if self.shared_state.milestones:
+            self.shared_state.milestones.reach(milestone)
+
     @property
     @abc.abstractmethod
     def name(self) -> str:
@@ -188,9 +289,12 @@ class WorkerFSM(AbstractFSM):
         self.check_transition(wanted_state)
         self._wanted_state = wanted_state
 
+        tracer = self.shared_state.tracer
         try:
-            exit_result = await self.exit_state(self._cur_state)
-            enter_result = await self.enter_state(wanted_state)
+            with tracer.span(f'{self.name}: exit {self._cur_state.name}', 'worker', track=self.name):
+                exit_result = await self.exit_state(self._cur_state)
+            with tracer.span(f'{self.name}: enter {wanted_state.name}', 'worker', track=self.name):
+                enter_result = await self.enter_state(wanted_state)
             self._cur_state = wanted_state
             return \
                 TransitionResult.DONE if TransitionResult.DONE in (exit_result, enter_result) else \
@@ -0,0 +1,311 @@
+import fcntl
+import json
+import os
+from typing import Dict, Any, List, Optional, Tuple
+
+from qemu_android_test_orchestrator.utils import Color, default_cache_dir
+
+# ioctl(KVM_GET_API_VERSION), the answer has been 12 since Linux 2.6.22
+KVM_GET_API_VERSION = 0xAE00
+KVM_API_VERSION = 12
+
+# Memory left to the host (builds, page cache), as a fraction of the total. The VMs are sized from the total rather
+# than from what's free, since the size ends up in the snapshot and provisioned image keys.
+MEMORY_HEADROOM = 0.5
+
+
+def _read(path: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return ''
+
+
+def parse_cpulist(cpulist: str) -> List[int]:
+    # "0-3,8,10-11"
+    cpus: List[int] = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def check_kvm() -> Tuple[bool, str]:
+    try:
+        fd = os.open('/dev/kvm', os.O_RDWR | os.O_CLOEXEC)
+    except FileNotFoundError:
+        return False, "/dev/kvm doesn't exist"
+    except PermissionError:
+        return False, "no permission to open /dev/kvm"
+    except OSError as e:
+        return False, f"unable to open /dev/kvm: {e.strerror}"
+    try:
+        version = fcntl.ioctl(fd, KVM_GET_API_VERSION)
+    except OSError as e:
+        return False, f"KVM_GET_API_VERSION failed: {e.strerror}"
+    finally:
+        os.close(fd)
+    if version != KVM_API_VERSION:
+        return False, f"unsupported KVM API version {version}"
+    return True, "/dev/kvm"
+
+
+class HostCapabilities:
+    # What the host can offer to the VMs. The parts that can't change until the next reboot (KVM, CPUs, NUMA layout,
+    # memory, hugetlbfs and its pages) are cached, free memory and free hugepages are read every time.
+
+    def __init__(self, cache_path: Optional[str] = None) -> None:
+        self.cache_path = cache_path or os.path.join(default_cache_dir(), 'host.json')
+        static = self.load_cached() or self.probe_static()
+        self.kvm: bool = static['kvm']
+        self.kvm_decider: str = static['kvm_decider']
+        self.cpus: List[int] = static['cpus']
+        self.numa_nodes: Dict[int, List[int]] = {int(k): v for k, v in static['numa_nodes'].items()}
+        self.hugetlbfs: Optional[str] = static['hugetlbfs']
+        self.hugepage_size_mb: float = static['hugepage_size_mb']
+        self.mem_total_mb: int = static['mem_total_mb']
+        self.hugepages_total: int = static['hugepages_total']
+
+        meminfo = {}
+        for line in _read('/proc/meminfo').splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and fields[1].isdigit():
+                meminfo[fields[0].rstrip(':')] = int(fields[1])
+        self.mem_available_mb: int = meminfo.get('MemAvailable', 0) // 1024
+        self.hugepages_free: int = meminfo.get('HugePages_Free', 0)
+
+    @staticmethod
+    def cache_key() -> str:
+        # Group membership decides whether /dev/kvm can be opened
+        boot_id = _read('/proc/sys/kernel/random/boot_id').strip()
+        return f"{boot_id}:{os.geteuid()}:{','.join(map(str, sorted(os.getgroups())))}"
+
+    def load_cached(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('key') != self.cache_key() or 'mem_total_mb' not in cached:
+            return None
+        return cached
+
+    def probe_static(self) -> Dict[str, Any]:
+        kvm, decider = check_kvm()
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(os.cpu_count() or 1))
+        numa_nodes = {}
+        node_dir = '/sys/devices/system/node'
+        if os.path.isdir(node_dir):
+            for name in sorted(os.listdir(node_dir)):
+                if name.startswith('node') and name[4:].isdigit():
+                    # Only the CPUs we're allowed to run on
+                    node_cpus = [c for c in parse_cpulist(_read(f'{node_dir}/{name}/cpulist')) if c in cpus]
+                    if node_cpus:
+                        numa_nodes[int(name[4:])] = node_cpus
+        hugetlbfs = None
+        for line in _read('/proc/mounts').splitlines():
+            fields = line.split()
+            if len(fields) >= 3 and fields[2] == 'hugetlbfs':
+                hugetlbfs = fields[1]
+                break
+        meminfo = {}
+        for line in _read('/proc/meminfo').splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and fields[1].isdigit():
+                meminfo[fields[0].rstrip(':')] = int(fields[1])
+        static = {
+            'key': self.cache_key(),
+            'kvm': kvm,
+            'kvm_decider': decider,
+            'cpus': cpus,
+            'numa_nodes': numa_nodes,
+            'hugetlbfs': hugetlbfs,
+            'hugepage_size_mb': meminfo.get('Hugepagesize', 0) / 1024,
+            'hugepages_total': meminfo.get('HugePages_Total', 0),
+            'mem_total_mb': meminfo.get('MemTotal', 0) // 1024,
+        }
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            tmp = f'{self.cache_path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(static, f)
+            os.replace(tmp, self.cache_path)
+        except OSError:
+            pass
+        return static
+
+
+async def kvm_available() -> Tuple[bool, str]:
+    caps = HostCapabilities()
+    return caps.kvm, caps.kvm_decider
+
+
+def _set_arg(args: List[str], option: str, value: str) -> None:
+    if option in args:
+        args[args.index(option) + 1] = value
+    else:
+        args[0:0] = [option, value]
+
+
+def drive_options(value: str) -> List[Tuple[str, str]]:
+    # Commas in values are escaped by doubling them
+    options = []
+    for part in value.replace(',,', '\0').split(','):
+        key, _, val = part.partition('=')
+        options.append((key, val.replace('\0', ',')))
+    return options
+
+
+def format_drive_options(options: List[Tuple[str, str]]) -> str:
+    return ','.join(f"{k}={v.replace(',', ',,')}" if v or k in ('file',) else k for k, v in options)
+
+
+def direct_io_supported(path: str) -> bool:
+    # tmpfs and some FUSE filesystems refuse O_DIRECT, in which case QEMU fails to open the drive with cache=none
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECT', 0))
+    except OSError:
+        return False
+    os.close(fd)
+    return hasattr(os, 'O_DIRECT')
+
+
+class QemuTuning:
+    # Sizes the VM and picks block device settings from the host capabilities. Every decision is recorded with the
+    # reason behind it so a dry run can show them.
+
+    def __init__(self, config: Dict[str, Any], caps: Optional[HostCapabilities] = None) -> None:
+        self.config = config
+        self.caps = caps or HostCapabilities()
+        self.reasons: List[Tuple[str, str]] = []
+        # Host CPUs QEMU should be pinned to, if any
+        self.affinity: Optional[List[int]] = None
+        self.numa_node: Optional[int] = None
+
+    def reason(self, setting: str, why: str) -> None:
+        self.reasons.append((setting, why))
+
+    def tune_machine(self, qemu_args: List[str]) -> List[str]:
+        # vCPUs, memory and its backing. These change what the guest sees, so they must be applied before the
+        # snapshot key is computed.
+        config = self.config
+        caps = self.caps
+        args = list(qemu_args)
+        instances = max(1, config['daemon_pool_size'] if config['daemon'] else config['instances'])
+
+        cpus = caps.cpus
+        vms_here = instances
+        if len(caps.numa_nodes) > 1:
+            nodes = sorted(caps.numa_nodes)
+            self.numa_node = nodes[config['instance'] % len(nodes)]
+            cpus = caps.numa_nodes[self.numa_node]
+            vms_here = len(range(config['instance'] % len(nodes), instances, len(nodes)))
+            self.affinity = cpus
+            self.reason('NUMA', f"{len(nodes)} nodes, keeping this VM on node {self.numa_node} "
+                                f"(CPUs {cpus[0]}-{cpus[-1]}) so its memory stays local")
+
+        per_vm = max(1, len(cpus) // vms_here)
+        # Leave a CPU for QEMU's own threads and the orchestrator when there's enough of them
+        vcpus = min(config['qemu_max_vcpus'], per_vm - 1 if per_vm > 2 else per_vm)
+        _set_arg(args, '-smp', f'{vcpus},sockets=1,cores={vcpus},threads=1')
+        self.reason('-smp', f"{len(cpus)} usable host CPUs for {vms_here} VM(s): {per_vm} each, "
+                            f"{vcpus} vCPUs (max {config['qemu_max_vcpus']})")
+
+        share = caps.mem_total_mb * (1 - MEMORY_HEADROOM) / instances
+        memory = min(config['qemu_max_memory'], int(share) // 256 * 256)
+        if memory < config['qemu_min_memory']:
+            memory = config['qemu_min_memory']
+            self.reason('-m', f"only {share:.0f} MiB per VM, using the minimum of {memory} MiB anyway")
+        else:
+            self.reason('-m', f"{caps.mem_total_mb} MiB of host memory, {MEMORY_HEADROOM:.0%} left to the host, "
+                              f"{memory} MiB per VM (max {config['qemu_max_memory']})")
+        if caps.mem_available_mb / instances < memory:
+            # Only a warning, changing the size would change the snapshot key from one run to the next
+            self.reason('-m', f"only {caps.mem_available_mb / instances:.0f} MiB free per VM right now, the host "
+                              f"may have to swap")
+        _set_arg(args, '-m', str(memory))
+
+        backend = None
+        # From the size of the pool rather than what's free right now, for the same reason as -m
+        hugepages_mb = caps.hugepages_total * caps.hugepage_size_mb / instances
+        if not config['qemu_hugepages']:
+            self.reason('hugepages', "disabled by qemu_hugepages")
+        elif not caps.hugetlbfs:
+            self.reason('hugepages', "no hugetlbfs mounted")
+        elif hugepages_mb < memory:
+            self.reason('hugepages', f"only {hugepages_mb:.0f} MiB of hugepages per VM, {memory} MiB needed")
+        elif caps.hugepages_free * caps.hugepage_size_mb / instances < memory:
+            # QEMU would fail to preallocate them. This run gets different snapshot and provisioned image keys.
+            self.reason('hugepages', f"{hugepages_mb:.0f} MiB of hugepages per VM but something else is using them, "
+                                     f"not using them this time")
+        else:
+            backend = f'memory-backend-file,id=mem,size={memory}M,mem-path={caps.hugetlbfs},prealloc=on'
+            self.reason('hugepages', f"{hugepages_mb:.0f} MiB of {caps.hugepage_size_mb:g} MiB pages per VM, "
+                                     f"backing guest memory with them saves TLB misses")
+        if self.numa_node is not None:
+            backend = backend or f'memory-backend-ram,id=mem,size={memory}M'
+            backend += f',host-nodes={self.numa_node},policy=bind'
+        if backend:
+            args[0:0] = ['-object', backend]
+            if '-machine' in args:
+                i = args.index('-machine') + 1
+                args[i] += ',memory-backend=mem'
+            else:
+                args[0:0] = ['-machine', 'memory-backend=mem']
+        return args
+
+    def tune_drives(self, qemu_args: List[str]) -> List[str]:
+        # Cache and AIO modes for every drive, plus an iothread for each virtio one so disk I/O doesn't go through the
+        # main loop. virtio drives are turned into explicit devices in their index order, so they keep their names in
+        # the guest.
+        # Drop the decisions of a previous launch, only the machine ones still apply
+        self.reasons = [r for r in self.reasons if not r[0].startswith('drive ') and r[0] != 'iothreads']
+        args: List[str] = []
+        virtio: List[Tuple[int, str, List[Tuple[str, str]]]] = []
+        workdir = self.config['qemu_workdir'] or '.'
+        use_iothreads = len(self.affinity or self.caps.cpus) >= 4
+        if not use_iothreads:
+            self.reason('iothreads', "fewer than 4 host CPUs, not worth the extra threads")
+
+        drives = iter(qemu_args)
+        for arg in drives:
+            if arg != '-drive':
+                args.append(arg)
+                continue
+            options = drive_options(next(drives))
+            keys = dict(options)
+            name = keys.get('id', keys.get('file', '?'))
+            if 'cache' not in keys and 'file' in keys:
+                path = os.path.join(workdir, keys['file'])
+                if 'readonly' in keys and keys['readonly'] in ('', 'on'):
+                    self.reason(f'drive {name}', "read-only, keeping the host page cache, shared by every VM and run")
+                elif direct_io_supported(path):
+                    options += [('cache', 'none'), ('aio', 'native')]
+                    self.reason(f'drive {name}', "writable, cache=none,aio=native to skip double caching")
+                else:
+                    options += [('cache', 'writeback'), ('aio', 'threads')]
+                    self.reason(f'drive {name}', "writable but its filesystem doesn't support O_DIRECT, "
+                                                 "cache=writeback,aio=threads")
+            if use_iothreads and keys.get('if') == 'virtio' and 'id' in keys:
+                virtio.append((int(keys.get('index', len(virtio))), keys['id'], options))
+                continue
+            args += ['-drive', format_drive_options(options)]
+
+        if virtio:
+            for i, (index, drive_id, options) in enumerate(sorted(virtio, key=lambda d: d[0])):
+                options = [(k, v) for k, v in options if k not in ('if', 'index')] + [('if', 'none')]
+                args += ['-object', f'iothread,id=io{i}',
+                         '-drive', format_drive_options(options),
+                         '-device', f'virtio-blk-pci,drive={drive_id},iothread=io{i}']
+            self.reason('iothreads', f"one iothread for each of the {len(virtio)} virtio drives")
+        return args
+
+    def print_reasons(self) -> None:
+        for setting, why in self.reasons:
+            print(Color.CYAN + f"{setting}:" + Color.RESET, why)
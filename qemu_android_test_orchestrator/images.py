@@ -0,0 +1,181 @@
+import asyncio
+import fcntl
+import os
+import re
+import time
+from typing import Dict, Any, List, Optional, Tuple, NamedTuple
+
+from qemu_android_test_orchestrator.host import drive_options, format_drive_options
+from qemu_android_test_orchestrator.qmp import QmpError
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.utils import Color, default_cache_dir
+
+# ioctl(FICLONE), shares the extents of a file with a new one on btrfs, XFS and friends
+FICLONE = 0x40049409
+
+
+class ImageError(Exception):
+    pass
+
+
+class Drive(NamedTuple):
+    id: str
+    # The image the drive started from, never written to
+    source: str
+    format: str
+    # The -device the drive is attached to, to plug it back after a reset
+    device: Optional[str]
+
+
+def reflink(source: str, path: str) -> bool:
+    # Returns False if the filesystem can't do it, the caller then falls back to a qcow2 overlay
+    try:
+        with open(source, 'rb') as src, open(path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+def drive_device(qemu_args: List[str], drive_id: str) -> Optional[str]:
+    for option, value in zip(qemu_args, qemu_args[1:]):
+        if option == '-device' and ('drive', drive_id) in drive_options(value):
+            return value
+    return None
+
+
+class DiskImages:
+    # Gives every run its own copy of the writable drives (e.g. usb.img), so the images in qemu_workdir are never
+    # modified and always start out clean. Copies are reflinks where the filesystem supports them, qcow2 overlays
+    # backed by the original image otherwise; either way they take no time and no space. A drive can also be reset to
+    # its original content while the VM runs, by unplugging it and plugging a new copy back in.
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.config = config
+        self.dir = os.path.abspath(config['image_overlay_dir'] or os.path.join(default_cache_dir(), 'overlays'))
+        self.suffix = f"{os.getpid()}-{config['instance']}"
+        self.drives: Dict[str, Drive] = {}
+        # Copy currently attached to each drive
+        self.current: Dict[str, str] = {}
+        # A copy is made ahead of time for each drive, so resets don't wait for it
+        self.spares: Dict[str, asyncio.Task] = {}
+        self.paths: List[str] = []
+        self.generation = 0
+        self.lock = asyncio.Lock()
+
+    async def copy(self, drive: Drive) -> Tuple[str, str]:
+        # Returns the new image and its format
+        os.makedirs(self.dir, exist_ok=True)
+        self.generation += 1
+        base = os.path.join(self.dir, f'{drive.id}-{self.suffix}-{self.generation}')
+        path = f'{base}.{drive.format}'
+        self.paths.append(path)
+        if reflink(drive.source, path):
+            return path, drive.format
+        path = f'{base}.qcow2'
+        self.paths.append(path)
+        proc = await asyncio.create_subprocess_exec(self.config['qemu_img_bin'], 'create', '-q', '-f', 'qcow2',
+                                                    '-F', drive.format, '-b', drive.source, path,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        output, _ = await proc.communicate()
+        if proc.returncode != 0:
+            raise ImageError(f"Unable to create an overlay for {drive.source}: {output.decode(errors='replace')}")
+        return path, 'qcow2'
+
+    def make_spare(self, drive: Drive) -> None:
+        self.spares[drive.id] = asyncio.ensure_future(self.copy(drive))
+
+    async def take_spare(self, drive: Drive) -> Tuple[str, str]:
+        copy = await self.spares.pop(drive.id)
+        self.make_spare(drive)
+        return copy
+
+    async def qemu_args(self, qemu_args: List[str]) -> List[str]:
+        # Points every writable drive with an id to a fresh copy. Drives with snapshot=on already get a throwaway
+        # overlay from QEMU, but those can't be reset.
+        workdir = self.config['qemu_workdir'] or '.'
+        args = list(qemu_args)
+        for i, (option, value) in enumerate(zip(qemu_args, qemu_args[1:])):
+            if option != '-drive':
+                continue
+            options = drive_options(value)
+            keys = dict(options)
+            if 'id' not in keys or 'file' not in keys or keys.get('readonly') in ('', 'on') \
+                    or keys.get('snapshot') in ('', 'on'):
+                continue
+            drive = Drive(keys['id'], os.path.abspath(os.path.join(workdir, keys['file'])), keys.get('format', 'raw'),
+                          drive_device(qemu_args, keys['id']))
+            self.drives[drive.id] = drive
+            if drive.id not in self.spares:
+                self.make_spare(drive)
+            path, fmt = await self.take_spare(drive)
+            self.current[drive.id] = path
+            options = [(k, path if k == 'file' else fmt if k == 'format' else v) for k, v in options]
+            if 'format' not in keys:
+                options.append(('format', fmt))
+            args[i + 1] = format_drive_options(options)
+            print(Color.GREEN + f"Drive {drive.id} runs on a throwaway copy of {keys['file']}" + Color.RESET)
+        return args
+
+    async def reset(self, shared_state: SynchronizedObject, drive_id: str) -> float:
+        # Swaps the drive for a fresh copy through the monitor and returns how long it took
+        drive = self.drives.get(drive_id)
+        if not drive:
+            raise ImageError(f"Unknown drive '{drive_id}', resettable drives: {', '.join(self.drives) or 'none'}")
+        if not drive.device or 'id' not in dict(drive_options(drive.device)):
+            raise ImageError(f"Drive '{drive_id}' isn't attached to a -device with an id, it can't be replugged")
+        device_id = dict(drive_options(drive.device))['id']
+        async with self.lock:
+            start = time.monotonic()
+            path, fmt = await self.take_spare(drive)
+            await self.unplug(shared_state, device_id, drive_id)
+            self.discard(self.current.pop(drive_id))
+            self.current[drive_id] = path
+            file = path.replace(',', ',,')
+            # drive_add has no QMP counterpart, and device_add in HMP takes the same syntax as -device
+            qmp = shared_state.qmp
+            output = await qmp.hmp(f'drive_add 0 if=none,id={drive_id},file={file},format={fmt}')
+            output += await qmp.hmp(f'device_add {drive.device}')
+            if re.search(r'(?i)error|failed|could not|not found', output):
+                raise ImageError(f"Unable to plug drive '{drive_id}' back: {output.strip()}")
+            return time.monotonic() - start
+
+    @staticmethod
+    async def unplug(shared_state: SynchronizedObject, device_id: str, drive_id: str) -> None:
+        # The drive goes away together with its device, which for USB and virtio happens without the guest's consent
+        qmp = shared_state.qmp
+        deleted = qmp.expect_event('DEVICE_DELETED', lambda e: e.get('data', {}).get('device') == device_id)
+        try:
+            await qmp.execute('device_del', {'id': device_id})
+            await asyncio.wait_for(deleted, 10 * shared_state.vm_timeout_multiplier)
+        except QmpError as e:
+            raise ImageError(f"Unable to unplug '{device_id}': {e}")
+        except asyncio.TimeoutError:
+            raise ImageError(f"'{device_id}' is still there after asking to unplug it")
+        finally:
+            deleted.cancel()
+        # The drive is normally released together with the device, but make sure its id is free again
+        deadline = time.monotonic() + 10 * shared_state.vm_timeout_multiplier
+        while any(block.get('device') == drive_id for block in await qmp.execute('query-block')):
+            if time.monotonic() > deadline:
+                raise ImageError(f"Drive '{drive_id}' is still there after unplugging '{device_id}'")
+            await asyncio.sleep(0.01)
+
+    def discard(self, path: str) -> None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    async def cleanup(self) -> None:
+        for task in self.spares.values():
+            task.cancel()
+        await asyncio.gather(*self.spares.values(), return_exceptions=True)
+        self.spares.clear()
+        for path in self.paths:
+            self.discard(path)
+        self.paths.clear()
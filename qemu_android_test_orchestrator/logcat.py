@@ -0,0 +1,202 @@
+import asyncio
+import re
+from collections import Counter
+from typing import NamedTuple, Optional, List, Set, Tuple, Iterable, Dict, Pattern, Union, AsyncIterator
+
+from qemu_android_test_orchestrator.adb import AdbError
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.utils import Color
+
+# logcat -v threadtime: "MM-DD HH:MM:SS.mmm  PID  TID P TAG     : message"
+threadtime_re = re.compile(
+    rb'^(\d\d-\d\d \d\d:\d\d:\d\d\.\d{3})\s+(\d+)\s+(\d+)\s+([VDIWEFS])\s+(.*?)\s*: (.*?)\r?\n?$', re.DOTALL)
+
+# Backreferences and named groups would clash or point to the wrong group once patterns are merged
+_unmergeable_re = re.compile(rb'\\[1-9]|\(\?P[<=]')
+
+
+def mergeable(pattern: Pattern[bytes]) -> bool:
+    # Flags (including inline ones at the start) apply to the whole regex, so patterns using them can't be merged
+    return pattern.flags == re.compile(b'').flags and not _unmergeable_re.search(pattern.pattern)
+
+
+class LogcatEntry(NamedTuple):
+    # Fields are None for lines that aren't log entries, e.g. "--------- beginning of main"
+    timestamp: Optional[bytes]
+    pid: Optional[int]
+    tid: Optional[int]
+    priority: Optional[str]
+    tag: Optional[str]
+    message: bytes
+    raw: bytes
+
+
+def parse_line(line: bytes) -> LogcatEntry:
+    match = threadtime_re.match(line)
+    if not match:
+        return LogcatEntry(None, None, None, None, None, line.rstrip(b'\r\n'), line)
+    timestamp, pid, tid, priority, tag, message = match.groups()
+    return LogcatEntry(timestamp, int(pid), int(tid), priority.decode(), tag.decode(errors='replace'), message, line)
+
+
+class Subscription:
+    def __init__(self, bus: 'LogcatBus', pattern: Optional[Pattern[bytes]], tags: Optional[Set[str]]) -> None:
+        self.bus = bus
+        self.pattern = pattern
+        self.tags = tags
+        self.queue: 'asyncio.Queue[LogcatEntry]' = asyncio.Queue()
+
+    def matches(self, entry: LogcatEntry) -> bool:
+        if self.tags is not None and entry.tag not in self.tags:
+            return False
+        return self.pattern is None or self.pattern.search(entry.raw) is not None
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[LogcatEntry]:
+        # Returns None on timeout
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def __aiter__(self) -> AsyncIterator[LogcatEntry]:
+        return self
+
+    async def __anext__(self) -> LogcatEntry:
+        return await self.queue.get()
+
+    def close(self) -> None:
+        self.bus.unsubscribe(self)
+
+
+class LogcatBus:
+    # A single logcat stream per device, parsed once and fanned out to whoever subscribed to it. Subscribers can ask
+    # for some tags only and/or for lines matching a pattern. The patterns are merged into one regex that is run once
+    # per line when they allow it, the individual ones only run on the (rare) lines that matched it.
+
+    def __init__(self, shared_state: SynchronizedObject) -> None:
+        self.shared_state = shared_state
+        self.subscriptions: List[Subscription] = []
+        # Subscribers with neither tags nor pattern get everything, the others are indexed by tag (None for any tag)
+        self._everything: List[Subscription] = []
+        self._by_tag: Dict[Optional[str], List[Subscription]] = {}
+        self._combined: Optional[Pattern[bytes]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        # Where to resume from after a reconnection, and the lines we already got from that millisecond
+        self._last_timestamp: Optional[bytes] = None
+        self._last_lines: List[bytes] = []
+        # After resuming with -T, the lines of that millisecond that are printed a second time
+        self._replayed: Optional['Counter[bytes]'] = None
+
+    def subscribe(self, pattern: Union[None, bytes, Pattern[bytes]] = None,
+                  tags: Optional[Iterable[str]] = None) -> Subscription:
+        if isinstance(pattern, bytes):
+            pattern = re.compile(re.escape(pattern))
+        subscription = Subscription(self, pattern, set(tags) if tags is not None else None)
+        self.subscriptions.append(subscription)
+        self._rebuild()
+        if not self._task:
+            self._task = asyncio.create_task(self.run())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+        self._everything = []
+        self._by_tag = {}
+        patterns = []
+        for s in self.subscriptions:
+            if s.pattern is None and s.tags is None:
+                self._everything.append(s)
+                continue
+            for tag in (s.tags if s.tags is not None else (None,)):
+                self._by_tag.setdefault(tag, []).append(s)
+            if s.pattern is None:
+                continue
+            patterns.append(s.pattern)
+        self._combined = None
+        # A tag-only subscriber means every line of that tag must go through, and a pattern that can't be merged means
+        # every line has to be matched against it anyway
+        tag_only = any(s.pattern is None for subs in self._by_tag.values() for s in subs)
+        if patterns and not tag_only and all(mergeable(p) for p in patterns):
+            try:
+                self._combined = re.compile(b'|'.join(b'(?:' + p.pattern + b')' for p in patterns))
+            except re.error:
+                pass
+
+    def resume(self) -> None:
+        # -T also prints the lines logged within the same millisecond as the last one we got, those are skipped once
+        # each. Identical lines logged in the same millisecond are legitimate otherwise.
+        self._replayed = Counter(self._last_lines) if self._last_timestamp else None
+
+    def accept(self, entry: LogcatEntry) -> bool:
+        if entry.timestamp is None:
+            return True
+        if self._replayed is not None:
+            if entry.timestamp == self._last_timestamp and self._replayed[entry.raw] > 0:
+                self._replayed[entry.raw] -= 1
+                return False
+            if entry.timestamp != self._last_timestamp:
+                self._replayed = None
+        if entry.timestamp != self._last_timestamp:
+            self._last_timestamp = entry.timestamp
+            self._last_lines = []
+        self._last_lines.append(entry.raw)
+        return True
+
+    def dispatch(self, entry: LogcatEntry) -> None:
+        for s in self._everything:
+            s.queue.put_nowait(entry)
+        if not self._by_tag:
+            return
+        if self._combined is not None and not self._combined.search(entry.raw):
+            return
+        candidates = self._by_tag.get(None, [])
+        if entry.tag in self._by_tag:
+            candidates = candidates + self._by_tag[entry.tag]
+        for s in candidates:
+            if s.matches(entry):
+                s.queue.put_nowait(entry)
+
+    def command(self) -> Tuple[str, ...]:
+        if self._last_timestamp:
+            return 'logcat', '-v', 'threadtime', '-T', self._last_timestamp.decode()
+        return 'logcat', '-v', 'threadtime'
+
+    async def run(self) -> None:
+        await self.shared_state.adb_ready.wait()
+        adb = self.shared_state.adb
+        serial = self.shared_state.config['adb_serial']
+        while not self._stopping:
+            self.resume()
+            try:
+                reader, writer = await adb.open_shell(serial, *self.command())
+            except (OSError, asyncio.IncompleteReadError, AdbError):
+                await asyncio.sleep(1)
+                continue
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    entry = parse_line(line)
+                    if self.accept(entry):
+                        self.dispatch(entry)
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                writer.close()
+            # Gradle likes to kill the ADB server
+            if not self._stopping:
+                print(Color.YELLOW + "logcat stream interrupted, reconnecting" + Color.RESET)
+                await asyncio.sleep(1)
+
+    async def close(self) -> None:
+        self._stopping = True
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
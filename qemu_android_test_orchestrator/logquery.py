@@ -0,0 +1,45 @@
+import argparse
+import sys
+
+from qemu_android_test_orchestrator.logstore import LogStoreReader, SOURCES, LEVELS
+from qemu_android_test_orchestrator.utils import Color
+
+_level_colors = {
+    'W': Color.YELLOW,
+    'E': Color.RED,
+    'F': Color.LIGHT_RED,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Query a log store written by the orchestrator (log_store_output)")
+    parser.add_argument('store', help="log store path")
+    parser.add_argument('--since', type=float, help="seconds since the first entry")
+    parser.add_argument('--until', type=float, help="seconds since the first entry")
+    parser.add_argument('--source', action='append', choices=SOURCES, help="only show entries from this source")
+    parser.add_argument('--tag', action='append', help="only show logcat entries with this tag")
+    parser.add_argument('--pid', action='append', type=int, help="only show logcat entries from this process")
+    parser.add_argument('--level', choices=list(LEVELS), help="only show logcat entries of this priority or higher")
+    args = parser.parse_args()
+
+    store = LogStoreReader(args.store)
+    start = store.start_time
+    records = store.query(
+        since=start + args.since if args.since is not None else None,
+        until=start + args.until if args.until is not None else None,
+        sources=args.source, tags=args.tag, pids=args.pid, min_level=args.level,
+    )
+    try:
+        for r in records:
+            origin = r.source
+            if r.tag is not None:
+                origin += f" {r.level}/{r.tag}({r.pid})"
+            color = _level_colors.get(r.level, '')
+            print(f"[{r.time - start:10.3f}] {origin}: " + color + r.message.decode(errors='replace') +
+                  (Color.RESET if color else ''))
+    except BrokenPipeError:
+        sys.stderr.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+import gzip
+import os
+from typing import Optional, BinaryIO, List
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Upper bound for the data handed to the executor in one go, so rotation happens at a reasonable granularity
+BATCH_SIZE = 256 * 1024
+
+_suffixes = {
+    None: '',
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+class LogSink:
+    # Writes a stream of bytes to a file, compressed on the fly, starting a new file whenever the current one grows past
+    # max_size and keeping the last `keep` rotated ones around (path.1.gz is the most recent). Compression and disk I/O
+    # happen in the default executor so a chatty producer never stalls the event loop.
+
+    def __init__(self, path: str, compression: Optional[str] = 'gzip', max_size: Optional[int] = None,
+                 keep: int = 5) -> None:
+        if compression not in _suffixes:
+            raise ValueError(f"Unknown log compression '{compression}'")
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd log compression requires the 'zstandard' package")
+        self.compression = compression
+        self.base_path = path
+        self.path = path + _suffixes[compression]
+        self.max_size = max_size
+        self.keep = keep
+        self.written = 0
+        self._queue: 'asyncio.Queue[Optional[bytes]]' = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._raw: Optional[BinaryIO] = None
+        self._file: Optional[BinaryIO] = None
+
+    def write(self, data: bytes) -> None:
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+        self._queue.put_nowait(data)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        closing = False
+        while not closing:
+            # Batch up whatever piled up while the previous batch was being written
+            batch: List[bytes] = [await self._queue.get()]
+            size = len(batch[0] or b'')
+            while not self._queue.empty() and batch[-1] is not None and size < BATCH_SIZE:
+                batch.append(self._queue.get_nowait())
+                size += len(batch[-1] or b'')
+            if None in batch:
+                closing = True
+                batch = batch[:batch.index(None)]
+            if batch:
+                await loop.run_in_executor(None, self._write, b''.join(batch))  # type: ignore
+        await loop.run_in_executor(None, self._close_file)
+
+    def _open(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._raw = open(self.path, 'wb')
+        if self.compression == 'gzip':
+            self._file = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=6)
+        elif self.compression == 'zstd':
+            self._file = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            self._file = self._raw
+
+    def _close_file(self) -> None:
+        if self._file:
+            self._file.close()
+        if self._raw and not self._raw.closed:
+            self._raw.close()
+        self._file = self._raw = None
+
+    def rotated_path(self, i: int) -> str:
+        return f'{self.base_path}.{i}{_suffixes[self.compression]}'
+
+    def _rotate(self) -> None:
+        self._close_file()
+        for i in range(self.keep - 1, 0, -1):
+            if os.path.exists(self.rotated_path(i)):
+                os.replace(self.rotated_path(i), self.rotated_path(i + 1))
+        if self.keep > 0:
+            os.replace(self.path, self.rotated_path(1))
+        else:
+            os.unlink(self.path)
+
+    def _write(self, data: bytes) -> None:
+        if not self._file:
+            self._open()
+        assert self._file and self._raw
+        self._file.write(data)
+        self.written += len(data)
+        # The size on disk lags behind a little because of the compressor's buffers, that's close enough
+        if self.max_size and self._raw.tell() >= self.max_size:
+            self._rotate()
+
+    async def close(self) -> None:
+        if not self._task:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
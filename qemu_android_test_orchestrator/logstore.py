@@ -0,0 +1,150 @@
+import bisect
+import json
+import struct
+import time
+from array import array
+from typing import Optional, List, Dict, Iterator, NamedTuple, Iterable, BinaryIO
+
+# A log store is made of two files:
+#  - <path>: the messages, one after the other, as they came in
+#  - <path>.idx: one column per field (receive time, source, level, pid, tag id, message offset) plus the tag table.
+# Receive times are taken on the host and never go backwards, so serial, logcat and dmesg all end up on the same
+# timeline and time ranges can be found with a binary search. Filters only look at the columns, messages are read just
+# for the entries that match.
+
+INDEX_MAGIC = b'QLOGIDX1'
+
+SOURCES = ('serial', 'logcat', 'dmesg')
+
+# logcat priorities, lowest first. Serial and dmesg lines have no level.
+LEVELS = 'VDIWEF'
+NO_LEVEL = ' '
+
+_columns = {
+    'time': 'd',
+    'source': 'B',
+    'level': 'B',
+    'pid': 'i',
+    'tag': 'I',
+    'offset': 'Q',
+}
+
+
+class LogRecord(NamedTuple):
+    time: float
+    source: str
+    level: str
+    pid: Optional[int]
+    tag: Optional[str]
+    message: bytes
+
+
+class LogStoreWriter:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.columns: Dict[str, array] = {name: array(code) for name, code in _columns.items()}
+        self.tags: List[str] = ['']
+        self._tag_ids: Dict[str, int] = {'': 0}
+        self._blob: Optional[BinaryIO] = open(path, 'wb')
+        self._offset = 0
+        self._last_time = 0.0
+
+    def append(self, source: str, message: bytes, level: str = NO_LEVEL, pid: Optional[int] = None,
+               tag: Optional[str] = None) -> None:
+        if not self._blob:
+            return
+        message = message.rstrip(b'\r\n')
+        now = max(time.time(), self._last_time)
+        self._last_time = now
+        tag = tag or ''
+        if tag not in self._tag_ids:
+            self._tag_ids[tag] = len(self.tags)
+            self.tags.append(tag)
+
+        columns = self.columns
+        columns['time'].append(now)
+        columns['source'].append(SOURCES.index(source))
+        columns['level'].append(ord(level or NO_LEVEL))
+        columns['pid'].append(pid if pid is not None else -1)
+        columns['tag'].append(self._tag_ids[tag])
+        columns['offset'].append(self._offset)
+        self._blob.write(message)
+        self._offset += len(message)
+
+    def close(self) -> None:
+        if not self._blob:
+            return
+        self._blob.close()
+        self._blob = None
+
+        # The end of the last message is stored as one more offset
+        columns = dict(self.columns)
+        columns['offset'] = array('Q', self.columns['offset'])
+        columns['offset'].append(self._offset)
+        layout = {}
+        position = 0
+        for name, column in columns.items():
+            layout[name] = [column.typecode, position, len(column) * column.itemsize]
+            position += len(column) * column.itemsize
+        header = json.dumps({'count': len(self.columns['time']), 'tags': self.tags, 'columns': layout}).encode()
+        with open(self.path + '.idx', 'wb') as f:
+            f.write(INDEX_MAGIC + struct.pack('<I', len(header)) + header)
+            for column in columns.values():
+                column.tofile(f)
+
+
+class LogStoreReader:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path + '.idx', 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError(f"'{path}.idx' is not a log store index")
+            header_size, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_size))
+            data = f.read()
+        self.count: int = header['count']
+        self.tags: List[str] = header['tags']
+        self.columns: Dict[str, array] = {}
+        for name, (code, position, size) in header['columns'].items():
+            column = array(code)
+            column.frombytes(data[position:position + size])
+            self.columns[name] = column
+
+    @property
+    def start_time(self) -> float:
+        return self.columns['time'][0] if self.count else 0.0
+
+    def query(self, since: Optional[float] = None, until: Optional[float] = None,
+              sources: Optional[Iterable[str]] = None, tags: Optional[Iterable[str]] = None,
+              pids: Optional[Iterable[int]] = None, min_level: Optional[str] = None) -> Iterator[LogRecord]:
+        # Times are absolute, as returned by time.time()
+        times = self.columns['time']
+        start = bisect.bisect_left(times, since) if since is not None else 0
+        end = bisect.bisect_right(times, until) if until is not None else self.count
+
+        source_ids = {SOURCES.index(s) for s in sources} if sources is not None else None
+        tag_set = set(tags) if tags is not None else None
+        tag_ids = {i for i, t in enumerate(self.tags) if t in tag_set} if tag_set is not None else None
+        pid_set = set(pids) if pids is not None else None
+        levels = {ord(level) for level in LEVELS[LEVELS.index(min_level):]} if min_level else None
+
+        column_source = self.columns['source']
+        column_level = self.columns['level']
+        column_pid = self.columns['pid']
+        column_tag = self.columns['tag']
+        offsets = self.columns['offset']
+        with open(self.path, 'rb') as blob:
+            for i in range(start, end):
+                if source_ids is not None and column_source[i] not in source_ids:
+                    continue
+                if tag_ids is not None and column_tag[i] not in tag_ids:
+                    continue
+                if pid_set is not None and column_pid[i] not in pid_set:
+                    continue
+                if levels is not None and column_level[i] not in levels:
+                    continue
+                blob.seek(offsets[i])
+                message = blob.read(offsets[i + 1] - offsets[i])
+                pid = column_pid[i]
+                yield LogRecord(times[i], SOURCES[column_source[i]], chr(column_level[i]), pid if pid >= 0 else None,
+                                self.tags[column_tag[i]] or None, message)
@@ -1,61 +1,83 @@
 import asyncio
+import shlex
+import traceback
 
-from qemu_android_test_orchestrator.config import get_config
-from qemu_android_test_orchestrator.fsm import State, ManagerFSM
-from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.config import get_config, instance_config, format_qemu_args
+from qemu_android_test_orchestrator.daemon import Daemon
+from qemu_android_test_orchestrator.host import QemuTuning
+from qemu_android_test_orchestrator.prepare import JobPreparation
+from qemu_android_test_orchestrator.session import Session
+from qemu_android_test_orchestrator.sharding import ShardCoordinator
 from qemu_android_test_orchestrator.utils import Color
-from qemu_android_test_orchestrator.workers.adb_checker import AdbConnectionChecker
-from qemu_android_test_orchestrator.workers.job_manager import JobManager
-from qemu_android_test_orchestrator.workers.permission_checker import PermissionDialogChecker
-from qemu_android_test_orchestrator.workers.qemu_manager import QemuSystemManager
-from qemu_android_test_orchestrator.workers.virtwifi_manager import VirtWifiManager
-from qemu_android_test_orchestrator.workers.vnc_recorder import VncRecorder
-from qemu_android_test_orchestrator.workers.log_collector import LogCollector
+
+
+def run_daemon(config: dict) -> None:
+    daemon = Daemon(config)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(daemon.serve())
+    except (KeyboardInterrupt, EOFError):
+        print(Color.RED + "Shutting down" + Color.RESET)
+    finally:
+        loop.run_until_complete(daemon.shutdown())
+
+
+def tune_dry_run(config: dict) -> None:
+    # Shows what qemu_tune would do to the first VM without starting anything
+    cfg = instance_config(config, 0)
+    tuning = QemuTuning(cfg)
+    print(Color.GREEN + f"KVM: {'yes' if tuning.caps.kvm else 'no'} ({tuning.caps.kvm_decider})" + Color.RESET)
+    cfg['qemu_args'] = tuning.tune_machine(cfg['qemu_args'])
+    qemu_args = tuning.tune_drives(format_qemu_args(cfg))
+    tuning.print_reasons()
+    print(Color.GREEN + "QEMU args:" + Color.RESET, shlex.join([cfg['qemu_bin']] + qemu_args))
 
 
 def main() -> None:
     config = get_config()
-    shared_state = SynchronizedObject()
-    shared_state.config = config
-
-    workers = [
-        QemuSystemManager(shared_state),
-        JobManager(shared_state),
-        AdbConnectionChecker(shared_state)
-    ]
-
-    transitions = [
-        State.QEMU_UP,
-        State.NETWORK_UP,
-        State.ADB_UP,
-        State.JOB
-    ]
-
-    if config['virtwifi_hack']:
-        workers.append(VirtWifiManager(shared_state))
-    if config['permission_approve']:
-        workers.append(PermissionDialogChecker(shared_state))
-    if config['vnc_recorder']:
-        workers.append(VncRecorder(shared_state))
-    if config['logcat_output'] or config['dmesg_output'] or config['bugreport_output']:
-        workers.append(LogCollector(shared_state))
-        transitions.append(State.LOGCAT)
-
-    fsm = ManagerFSM()
-    for w in workers:
-        fsm.register_worker(w)
+    if config['qemu_tune_dry_run']:
+        tune_dry_run(config)
+        return
+    if config['daemon']:
+        run_daemon(config)
+        return
+
+    shard_coordinator = ShardCoordinator(config) if config['job_sharding'] else None
+    # Shared by all VMs so the APKs are only built once
+    job_preparation = JobPreparation(config) if config['job_prepare_command'] else None
+    sessions = [Session(config, i, shard_coordinator, job_preparation) for i in range(config['instances'])]
 
     loop = asyncio.get_event_loop()
 
-    print("Running with enabled worker:", ', '.join(map(lambda x: f"'{x.name}'", workers)))
+    print("Running with enabled worker:", ', '.join(map(lambda x: f"'{x.name}'", sessions[0].workers)))
+    if len(sessions) > 1:
+        print(f"Running {len(sessions)} VMs in parallel")
 
+    # Each session stops its own VM when it's done or fails, so one broken VM doesn't take the others down
+    tasks = [loop.create_task(s.run()) for s in sessions]
     try:
-        for state in transitions:
-            loop.run_until_complete(fsm.transition(state))
+        results = loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
     except (KeyboardInterrupt, EOFError):
         print(Color.RED + "Shutting down" + Color.RESET)
+        for task in tasks:
+            task.cancel()
+        results = loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        # Make sure sessions whose task died with the interrupt are stopped too
+        loop.run_until_complete(asyncio.gather(*(s.stop() for s in sessions), return_exceptions=True))
     finally:
-        loop.run_until_complete(asyncio.wait_for(fsm.transition(State.STOP), 30))
-        
-    if shared_state.job_proc:
-        exit(shared_state.job_proc.returncode)
+        if job_preparation:
+            # Don't leave a build running behind if every VM failed to boot
+            loop.run_until_complete(job_preparation.stop())
+
+    failed = False
+    for session, result in zip(sessions, results):
+        if isinstance(result, BaseException) and not isinstance(result, asyncio.CancelledError):
+            print(Color.RED + f"{session.name} failed:" + Color.RESET)
+            traceback.print_exception(type(result), result, result.__traceback__)
+            failed = True
+
+    returncodes = [s.returncode for s in sessions if s.returncode is not None]
+    if failed and not returncodes:
+        exit(1)
+    if returncodes:
+        exit(next((rc for rc in returncodes if rc != 0), 0))
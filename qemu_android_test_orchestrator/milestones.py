@@ -0,0 +1,52 @@
+import asyncio
+import time
+from typing import Dict, Hashable
+
+from qemu_android_test_orchestrator.tracing import Tracer, NULL_TRACER
+
+# Fine grained boot milestones. Workers declare which ones they need before entering a state and which ones they
+# provide, so the scheduler can start each of them as soon as possible instead of waiting for every other worker to be
+# done with the previous state. States themselves are milestones too: one is reached once every worker has entered it.
+
+# QEMU was launched and its consoles are connected
+QEMU_RUNNING = 'qemu running'
+# A root shell is available on the serial console
+SHELL_READY = 'shell ready'
+# The package manager service is running
+PACKAGE_MANAGER_UP = 'package manager up'
+# Boot is over and the serial shell is no longer busy: debloated, no dex2oat, no boot animation
+SYSTEM_READY = 'system ready'
+# The guest is connected to the network
+NETWORK_UP = 'network up'
+# The device shows up in adb
+ADB_ONLINE = 'adb online'
+# The device is usable through adb, package verifier out of the way
+ADB_READY = 'adb ready'
+
+
+class Milestones:
+    def __init__(self, tracer: Tracer = NULL_TRACER) -> None:
+        self.tracer = tracer
+        self.events: Dict[Hashable, asyncio.Event] = {}
+        # When each milestone was reached, from time.monotonic()
+        self.times: Dict[Hashable, float] = {}
+
+    def event(self, name: Hashable) -> asyncio.Event:
+        if name not in self.events:
+            self.events[name] = asyncio.Event()
+        return self.events[name]
+
+    def reached(self, name: Hashable) -> bool:
+        return self.event(name).is_set()
+
+    def reach(self, name: Hashable) -> None:
+        event = self.event(name)
+        if event.is_set():
+            return
+        self.times[name] = time.monotonic()
+        self.tracer.instant(f'milestone: {getattr(name, "name", name)}', track='milestones')
+        event.set()
+
+    async def wait(self, *names: Hashable) -> None:
+        for name in names:
+            await self.event(name).wait()
@@ -0,0 +1,60 @@
+import asyncio
+import os
+from subprocess import CalledProcessError
+from typing import Dict, Any, Optional
+
+from qemu_android_test_orchestrator.utils import Color
+
+
+class JobPreparation:
+    # Runs job_prepare_command (e.g. building the APKs) in the background while the VMs boot, so the device-bound
+    # job_command only has to install and run. It only runs once per orchestrator run, however many VMs wait for it.
+    # It's niced and optionally pinned to a few CPUs so it doesn't starve the booting VMs.
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.command: str = config['job_prepare_command']
+        self.workdir: Optional[str] = config['job_workdir']
+        self.nice: int = config['job_prepare_nice']
+        self.cpus: Optional[int] = config['job_prepare_cpus']
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def limit_resources(self) -> None:
+        # Runs in the child before exec
+        if self.nice:
+            os.nice(self.nice)
+        if self.cpus and hasattr(os, 'sched_getaffinity'):
+            available = sorted(os.sched_getaffinity(0))
+            # Take the last ones, QEMU's vCPU threads are usually scheduled from the first ones
+            os.sched_setaffinity(0, available[-self.cpus:])
+
+    def start(self) -> None:
+        if not self._task:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self) -> None:
+        print(Color.GREEN + f"Running prepare command: {self.command}" + Color.RESET)
+        self.proc = await asyncio.create_subprocess_shell(self.command, cwd=self.workdir,
+                                                          preexec_fn=self.limit_resources)
+        await self.proc.wait()
+        if self.proc.returncode != 0:
+            raise CalledProcessError(self.proc.returncode, self.command)
+        print(Color.GREEN + "Prepare command done" + Color.RESET)
+
+    async def wait(self) -> None:
+        self.start()
+        assert self._task
+        # Several VMs may be waiting, one of them giving up must not cancel it for the others
+        await asyncio.shield(self._task)
+
+    async def stop(self) -> None:
+        if not self._task:
+            return
+        if self.proc and self.proc.returncode is None:
+            try:
+                self.proc.terminate()
+            except ProcessLookupError:
+                pass
+        else:
+            self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
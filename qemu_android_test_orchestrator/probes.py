@@ -0,0 +1,113 @@
+import asyncio
+import random
+import time
+from typing import Optional, Callable, Awaitable
+
+from qemu_android_test_orchestrator.qmp import QemuGone
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.utils import Color, ansi_escape, step_timeout
+
+# Readiness probes: instead of sleeping for however long things usually take, check the real condition over the serial
+# shell and move on as soon as it holds. Checks are retried with exponential backoff until a deadline. Every probe ends
+# up in the trace as 'probe: <name>', so how long each condition took to come true is recorded.
+
+
+# Runs a command in the guest and returns its output, None if it failed
+Shell = Callable[[SynchronizedObject, str], Awaitable[Optional[bytes]]]
+
+
+async def run_shell(shared_state: SynchronizedObject, command: str, timeout: float = 30) -> Optional[bytes]:
+    # Runs a command on the serial shell and returns its output, or None if it didn't complete in time. The end marker
+    # is computed by the shell so the echoed command line can't match it.
+    engine = shared_state.qemu_serial_expect
+    n = random.randint(0, 0x07FFFFFF)
+    marker = f'<<{n + 1}>>'.encode()
+    offset = engine.buffer.end_offset
+    shared_state.qemu_serial_writer.write(f'{command}; echo "<<$(({n} + 1))>>"\n'.encode(errors='replace'))
+    await shared_state.qemu_serial_writer.drain()
+    match = await engine.wait_for(marker, timeout * shared_state.vm_timeout_multiplier, offset)
+    if match is None:
+        return None
+    output = engine.buffer.since(offset)[:match.start - offset]
+    # Drop the echoed command line
+    output = output.split(b'\n', 1)[1] if b'\n' in output else b''
+    return ansi_escape.sub(b'', output).replace(b'\r', b'')
+
+
+async def wait_until(shared_state: SynchronizedObject, name: str, check: Callable[[], Awaitable[bool]],
+                     timeout: float = 300, initial_interval: float = 0.25, max_interval: float = 5,
+                     warn: bool = True) -> bool:
+    # Returns True as soon as check() does, False if it didn't before the deadline. The deadline comes from the probe's
+    # history if there's enough of it, intervals are scaled with the VM speed.
+    multiplier = shared_state.vm_timeout_multiplier
+    start = time.monotonic()
+    deadline = start + step_timeout(shared_state, f'probe: {name}', timeout)
+    interval = initial_interval * multiplier
+    attempts = 0
+    with shared_state.tracer.span(f'probe: {name}', 'probe'):
+        while True:
+            # No point in waiting for a VM that isn't there anymore
+            if shared_state.qmp and shared_state.qmp.gone:
+                raise QemuGone(shared_state.qmp.gone)
+            attempts += 1
+            if await check():
+                print(Color.GREEN + f"{name}: ready after {time.monotonic() - start:.1f}s ({attempts} checks)" +
+                      Color.RESET)
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if warn:
+                    print(Color.RED + f"Warning: {name}: not ready after {time.monotonic() - start:.1f}s "
+                                  f"({attempts} checks)" + Color.RESET)
+                return False
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval * multiplier)
+
+
+async def getprop(shared_state: SynchronizedObject, prop: str) -> Optional[str]:
+    output = await run_shell(shared_state, f'getprop {prop}', timeout=10)
+    return output.decode(errors='replace').strip() if output is not None else None
+
+
+async def property_is(shared_state: SynchronizedObject, prop: str, *values: str) -> bool:
+    return await getprop(shared_state, prop) in values
+
+
+async def package_installed(shared_state: SynchronizedObject, package: str) -> bool:
+    output = await run_shell(shared_state, f'pm path {package}', timeout=30)
+    return output is not None and b'package:' in output
+
+
+async def focused_window(shared_state: SynchronizedObject, shell: Shell = run_shell) -> Optional[bytes]:
+    # Over the serial shell unless told otherwise, e.g. ui.adb_shell once ADB is up
+    output = await shell(shared_state, 'dumpsys window windows | grep -E "mCurrentFocus|mFocusedApp"')
+    return output.strip() if output is not None else None
+
+
+async def activity_focused(shared_state: SynchronizedObject, name: str, shell: Shell = run_shell) -> bool:
+    # name can be a package or a window (activity) name
+    focus = await focused_window(shared_state, shell)
+    return focus is not None and name.encode() in focus
+
+
+async def wifi_connected(shared_state: SynchronizedObject) -> bool:
+    output = await run_shell(shared_state, 'dumpsys wifi | grep -m 1 mWifiInfo', timeout=30)
+    return output is not None and b'Supplicant state: COMPLETED' in output
+
+
+# Common probes
+
+async def wait_zygote(shared_state: SynchronizedObject) -> bool:
+    return await wait_until(shared_state, 'zygote running',
+                            lambda: property_is(shared_state, 'init.svc.zygote', 'running'), timeout=120)
+
+
+async def wait_boot_animation(shared_state: SynchronizedObject) -> bool:
+    # Images without a boot animation don't have the service at all
+    return await wait_until(shared_state, 'boot animation stopped',
+                            lambda: property_is(shared_state, 'init.svc.bootanim', 'stopped', ''), timeout=600)
+
+
+async def wait_boot_completed(shared_state: SynchronizedObject) -> bool:
+    return await wait_until(shared_state, 'boot completed',
+                            lambda: property_is(shared_state, 'sys.boot_completed', '1'), timeout=600)
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Dict, Any, List
+
+from qemu_android_test_orchestrator.snapshot import FileDigestCache, image_files
+from qemu_android_test_orchestrator.utils import default_cache_dir
+
+PROVISION_FORMAT_VERSION = 1
+
+
+class ProvisionError(Exception):
+    pass
+
+
+class ProvisionCache:
+    # Keeps /data images with the provisioning steps (debloat, VirtWifi install) already applied, keyed by everything
+    # that goes into them. Each run gets a throwaway qcow2 overlay on top of the cached image, so the image itself never
+    # changes once it's been baked. On a cache miss the overlay sits on top of a blank image instead, and the changes
+    # are committed into it once the VM is fully set up.
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.config = config
+        self.dir = os.path.abspath(os.path.join(config['provision_dir'] or default_cache_dir(), 'provisioned'))
+        os.makedirs(self.dir, exist_ok=True)
+        self.key = self.compute_key(config)
+        suffix = f"{os.getpid()}-{config['instance']}"
+        self.overlay_path = os.path.join(self.dir, f'run-{suffix}.qcow2')
+        self.tmp_path = os.path.join(self.dir, f'{self.key}.{suffix}.tmp.qcow2')
+        # Whether this run is baking a new image
+        self.provisioning = False
+
+    def compute_key(self, config: Dict[str, Any]) -> str:
+        digests = FileDigestCache(os.path.join(self.dir, 'digests.json'))
+        h = hashlib.sha256()
+        h.update(json.dumps({
+            'version': PROVISION_FORMAT_VERSION,
+            'kernel_cmdline': [b for a, b in zip(config['qemu_args'], config['qemu_args'][1:]) if a == '-append'],
+            'disable_packages': config['disable_packages'],
+            'virtwifi_hack': config['virtwifi_hack'],
+            'provision_data_size': config['provision_data_size'],
+        }, sort_keys=True).encode())
+        files = image_files(config['qemu_args'], config['qemu_workdir'])
+        if config['virtwifi_hack']:
+            files.append(config['virtwificonnector_apk'])
+        for file in files:
+            h.update(file.encode() + b'\0' + digests.digest(file).encode())
+        digests.save()
+        return h.hexdigest()[:32]
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.dir, f'{self.key}.qcow2')
+
+    def exists(self) -> bool:
+        return os.access(self.path, os.R_OK)
+
+    @staticmethod
+    async def _run(*args: str) -> None:
+        proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.STDOUT)
+        output, _ = await proc.communicate()
+        if proc.returncode != 0:
+            raise ProvisionError(f"'{' '.join(args)}' failed: {output.decode(errors='replace').strip()}")
+
+    async def create_blank(self) -> None:
+        # Android-x86 expects the data partition to be formatted already
+        qemu_img = self.config['qemu_img_bin']
+        raw = self.tmp_path + '.raw'
+        try:
+            await self._run(qemu_img, 'create', '-q', '-f', 'raw', raw, self.config['provision_data_size'])
+            await self._run('mkfs.ext4', '-q', '-F', '-L', 'data', raw)
+            await self._run(qemu_img, 'convert', '-f', 'raw', '-O', 'qcow2', raw, self.tmp_path)
+        finally:
+            if os.path.exists(raw):
+                os.unlink(raw)
+
+    async def prepare(self) -> None:
+        if self.exists():
+            backing = self.path
+        else:
+            self.provisioning = True
+            await self.create_blank()
+            backing = self.tmp_path
+        await self._run(self.config['qemu_img_bin'], 'create', '-q', '-f', 'qcow2', '-F', 'qcow2', '-b', backing,
+                        self.overlay_path)
+
+    def qemu_args(self, qemu_args: List[str]) -> List[str]:
+        # Attach the overlay and tell Android-x86's init to mount it as /data
+        device = self.config['provision_data_device']
+        args = list(qemu_args)
+        if '-append' in args:
+            i = args.index('-append') + 1
+            args[i] = f"{args[i]} DATA={device}"
+        index = ord(device[-1]) - ord('a')
+        args += ['-drive', f"index={index},if=virtio,id=data,file={self.overlay_path.replace(',', ',,')},format=qcow2"]
+        return args
+
+    @staticmethod
+    def commit_command() -> str:
+        # Merges what the guest wrote so far down into the backing image
+        return 'commit data'
+
+    def commit(self) -> None:
+        # QEMU keeps the backing file open, so it can be moved into place right away
+        os.replace(self.tmp_path, self.path)
+        self.provisioning = False
+
+    def cleanup(self) -> None:
+        paths = [self.overlay_path]
+        if self.provisioning:
+            paths.append(self.tmp_path)
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
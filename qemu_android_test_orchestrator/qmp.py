@@ -0,0 +1,181 @@
+import asyncio
+import itertools
+import json
+from collections import deque
+from typing import Dict, Any, Optional, List, Tuple, Callable, Union, Deque, Sequence
+
+from qemu_android_test_orchestrator.utils import Color
+
+# QMP messages can be big (query-block, query-migrate with stats), the default 64K line limit isn't enough
+READ_LIMIT = 16 * 1024 * 1024
+# Events kept around for debugging and for waiters that want to look at what already happened
+EVENT_HISTORY = 100
+
+EventPredicate = Callable[[Dict[str, Any]], bool]
+
+
+class QmpError(Exception):
+    pass
+
+
+class QemuGone(Exception):
+    # QEMU shut down, crashed or the guest panicked while it was still needed
+    pass
+
+
+class QmpClient:
+    # Client for the QEMU machine protocol. Unlike the human monitor, every command gets a reply matched to it by id,
+    # and QEMU tells us about things happening to the VM (shutdown, reset, I/O errors) as events.
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._event_waiters: List[Tuple[Tuple[str, ...], Optional[EventPredicate], asyncio.Future]] = []
+        self.events: Deque[Dict[str, Any]] = deque(maxlen=EVENT_HISTORY)
+        # Why QEMU is no longer usable, if it isn't
+        self.gone: Optional[str] = None
+        self._reader_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    async def connect(cls, path: str) -> 'QmpClient':
+        reader, writer = await asyncio.open_unix_connection(path, limit=READ_LIMIT)
+        client = cls(reader, writer)
+        greeting = json.loads(await reader.readline())
+        if 'QMP' not in greeting:
+            writer.close()
+            raise QmpError(f"Unexpected QMP greeting: {greeting}")
+        client._reader_task = asyncio.ensure_future(client.read_loop())
+        await client.execute('qmp_capabilities')
+        return client
+
+    async def read_loop(self) -> None:
+        reason = "QEMU monitor connection closed"
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if 'event' in message:
+                    self.dispatch_event(message)
+                elif message.get('id') in self._pending:
+                    future = self._pending.pop(message['id'])
+                    if not future.done():
+                        future.set_result(message)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            reason = f"QEMU monitor connection lost: {e}"
+        finally:
+            self.gone = self.gone or reason
+            for future in list(self._pending.values()) + [w[2] for w in self._event_waiters]:
+                if not future.done():
+                    future.set_exception(QemuGone(self.gone))
+            self._pending.clear()
+            self._event_waiters.clear()
+
+    def dispatch_event(self, event: Dict[str, Any]) -> None:
+        self.events.append(event)
+        if event['event'] == 'SHUTDOWN':
+            self.gone = f"QEMU shut down ({event.get('data', {}).get('reason', 'unknown reason')})"
+        elif event['event'] == 'GUEST_PANICKED':
+            self.gone = "The guest kernel panicked"
+        waiters = []
+        for waiter in self._event_waiters:
+            names, predicate, future = waiter
+            if future.done():
+                continue
+            if event['event'] in names and (predicate is None or predicate(event)):
+                future.set_result(event)
+            else:
+                waiters.append(waiter)
+        self._event_waiters = waiters
+
+    async def execute(self, command: str, arguments: Optional[Dict[str, Any]] = None,
+                      timeout: Optional[float] = 30) -> Any:
+        # Returns the command's return value, or raises QmpError with QEMU's description of what went wrong
+        if self.gone:
+            raise QemuGone(self.gone)
+        request_id = next(self._ids)
+        request: Dict[str, Any] = {'execute': command, 'id': request_id}
+        if arguments:
+            request['arguments'] = arguments
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        self.writer.write(json.dumps(request).encode() + b'\n')
+        try:
+            await self.writer.drain()
+            reply = await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+        if 'error' in reply:
+            raise QmpError(f"{command}: {reply['error'].get('desc', reply['error'])}")
+        return reply.get('return')
+
+    async def hmp(self, command_line: str, timeout: Optional[float] = 30) -> str:
+        # For the few things that only exist in the human monitor. The output comes back in the reply, so there's no
+        # need to guess when it's done.
+        return await self.execute('human-monitor-command', {'command-line': command_line}, timeout)
+
+    def expect_event(self, names: Union[str, Sequence[str]],
+                     predicate: Optional[EventPredicate] = None) -> 'asyncio.Future[Dict[str, Any]]':
+        # Registers interest right away, so it must be called before whatever triggers the event to not miss it
+        future = asyncio.get_event_loop().create_future()
+        if self.gone:
+            future.set_exception(QemuGone(self.gone))
+            return future
+        names = (names,) if isinstance(names, str) else tuple(names)
+        self._event_waiters.append((names, predicate, future))
+        return future
+
+    async def wait_event(self, names: Union[str, Sequence[str]], timeout: Optional[float] = None,
+                         predicate: Optional[EventPredicate] = None) -> Dict[str, Any]:
+        return await asyncio.wait_for(self.expect_event(names, predicate), timeout)
+
+    @staticmethod
+    def key_events(keys: Sequence[str], down: bool) -> List[Dict[str, Any]]:
+        return [{'type': 'key', 'data': {'down': down, 'key': {'type': 'qcode', 'data': key}}} for key in keys]
+
+    async def send_keys(self, *combos: str, hold: float = 0.05, gap: float = 0.05) -> None:
+        # combos use the sendkey syntax, e.g. 'esc' or 'ctrl-alt-f1'. Each one is held for hold seconds, the way a
+        # person would press it, and all of its keys go down and up in a single command.
+        for i, combo in enumerate(combos):
+            keys = combo.split('-')
+            await self.execute('input-send-event', {'events': self.key_events(keys, True)})
+            await asyncio.sleep(hold)
+            await self.execute('input-send-event', {'events': self.key_events(list(reversed(keys)), False)})
+            if i < len(combos) - 1:
+                await asyncio.sleep(gap)
+
+    async def close(self) -> None:
+        self.writer.close()
+        if self._reader_task:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+
+
+def describe_event(event: Dict[str, Any]) -> str:
+    data = event.get('data', {})
+    details = ', '.join(f'{k}={v}' for k, v in data.items() if not isinstance(v, (dict, list)))
+    return f"{event['event']} ({details})" if details else event['event']
+
+
+async def watch_events(qmp: QmpClient, stopping: Callable[[], bool], on_gone: Callable[[str], None]) -> None:
+    # Reports what happens to the VM behind our back, and calls on_gone as soon as QEMU is no longer usable
+    while True:
+        try:
+            event = await qmp.wait_event(('SHUTDOWN', 'GUEST_PANICKED', 'RESET', 'BLOCK_IO_ERROR'))
+        except QemuGone as e:
+            if not stopping():
+                print(Color.RED + f"{e}" + Color.RESET)
+                on_gone(str(e))
+            return
+        if stopping():
+            return
+        print(Color.RED + f"QEMU event: {describe_event(event)}" + Color.RESET)
+        if qmp.gone:
+            on_gone(qmp.gone)
+            return
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import math
+import os
+import struct
+import time
+from typing import Dict, Optional, List, Tuple, BinaryIO
+
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.utils import Color
+
+# Time series file: magic, header length, JSON header with the field names, then one record of little endian doubles
+# per sample. Missing values are NaN. Records are flushed as they're taken, so a crashed run still leaves its samples.
+SAMPLES_MAGIC = b'QRES0001'
+
+FIELDS = (
+    'time',
+    'host_mem_available_mb',
+    'host_swap_used_mb',
+    'host_load1',
+    'host_cpu_percent',
+    'balloon_mb',
+    'qemu_rss_mb',
+    'qemu_cpu_percent',
+    'qemu_read_mb',
+    'qemu_write_mb',
+    'guest_load1',
+    'guest_mem_available_mb',
+)
+
+_record = struct.Struct('<' + 'd' * len(FIELDS))
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+MB = 1024 * 1024
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def parse_key_values(text: str) -> Dict[str, int]:
+    # /proc/meminfo, /proc/vmstat, /proc/<pid>/io: "key[:] value [kB]" per line, parsed in a single pass
+    values = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[1].isdigit():
+            values[fields[0].rstrip(':')] = int(fields[1])
+    return values
+
+
+def read_samples(path: str) -> Tuple[List[str], List[Tuple[float, ...]]]:
+    with open(path, 'rb') as f:
+        if f.read(len(SAMPLES_MAGIC)) != SAMPLES_MAGIC:
+            raise ValueError(f"'{path}' is not a resource samples file")
+        header_size, = struct.unpack('<I', f.read(4))
+        fields = json.loads(f.read(header_size))['fields']
+        record = struct.Struct('<' + 'd' * len(fields))
+        data = f.read()
+    usable = len(data) - len(data) % record.size
+    return fields, [record.unpack_from(data, i) for i in range(0, usable, record.size)]
+
+
+class ResourceSampler:
+    # Samples host, QEMU and guest resource usage in the background by reading /proc directly. The guest is asked
+    # through ADB, less often since that's more expensive.
+
+    def __init__(self, shared_state: SynchronizedObject) -> None:
+        config = shared_state.config
+        self.shared_state = shared_state
+        self.interval: float = config['resource_sample_interval']
+        self.guest_every: int = config['resource_guest_sample_every']
+        self.output: Optional[str] = config['resource_samples_output']
+        self.latest: Dict[str, float] = {}
+        self.peaks: Dict[str, float] = {}
+        self.lows: Dict[str, float] = {}
+        self._file: Optional[BinaryIO] = None
+        self._task: Optional[asyncio.Task] = None
+        self._guest_task: Optional[asyncio.Task] = None
+        self._last_cpu: Optional[Tuple[float, int, int]] = None
+        self._last_host_cpu: Optional[Tuple[int, int]] = None
+        self._count = 0
+        self._guest: Dict[str, float] = {}
+
+    def start(self) -> None:
+        if self._task or not self.interval:
+            return
+        if self.output:
+            self._file = open(self.output, 'wb')
+            header = json.dumps({'fields': FIELDS}).encode()
+            self._file.write(SAMPLES_MAGIC + struct.pack('<I', len(header)) + header)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        for task in (self._task, self._guest_task):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = self._guest_task = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    async def run(self) -> None:
+        while True:
+            sample = self.sample_host()
+            # A slow ADB call must not hold up the host samples, the guest values are picked up once they're in. 0 or
+            # less turns the guest sampling off
+            if self.guest_every > 0 and self._count % self.guest_every == 0 and not self._guest_task and \
+                    self.shared_state.adb_ready and self.shared_state.adb_ready.is_set():
+                self._guest_task = asyncio.create_task(self.sample_guest())
+                self._guest_task.add_done_callback(self._guest_done)
+            sample.update(self._guest)
+            self.record(sample)
+            self._count += 1
+            await asyncio.sleep(self.interval)
+
+    def _guest_done(self, task: asyncio.Task) -> None:
+        if task is self._guest_task:
+            self._guest_task = None
+
+    def record(self, sample: Dict[str, float]) -> None:
+        self.latest = sample
+        for key, value in sample.items():
+            if key == 'time' or math.isnan(value):
+                continue
+            self.peaks[key] = max(self.peaks.get(key, value), value)
+            self.lows[key] = min(self.lows.get(key, value), value)
+        if self._file:
+            self._file.write(_record.pack(*(sample.get(f, math.nan) for f in FIELDS)))
+            self._file.flush()
+
+    def sample_host(self) -> Dict[str, float]:
+        now = time.time()
+        sample: Dict[str, float] = {'time': now}
+
+        meminfo = parse_key_values(_read('/proc/meminfo') or '')
+        if 'MemAvailable' in meminfo:
+            sample['host_mem_available_mb'] = meminfo['MemAvailable'] / 1024
+        if 'SwapTotal' in meminfo:
+            sample['host_swap_used_mb'] = (meminfo['SwapTotal'] - meminfo.get('SwapFree', 0)) / 1024
+
+        loadavg = _read('/proc/loadavg')
+        if loadavg:
+            sample['host_load1'] = float(loadavg.split()[0])
+
+        stat = _read('/proc/stat')
+        if stat:
+            # First line: aggregate jiffies, idle and iowait are the 4th and 5th
+            jiffies = [int(v) for v in stat.splitlines()[0].split()[1:]]
+            total, idle = sum(jiffies), jiffies[3] + jiffies[4]
+            if self._last_host_cpu and total > self._last_host_cpu[0]:
+                busy = (total - self._last_host_cpu[0]) - (idle - self._last_host_cpu[1])
+                sample['host_cpu_percent'] = 100 * busy / (total - self._last_host_cpu[0])
+            self._last_host_cpu = (total, idle)
+
+        # Only meaningful when the orchestrator itself runs in a VM, which is the norm on CI
+        vmstat = parse_key_values(_read('/proc/vmstat') or '')
+        if 'balloon_inflate' in vmstat:
+            sample['balloon_mb'] = (vmstat['balloon_inflate'] - vmstat.get('balloon_deflate', 0)) * PAGE_SIZE / MB
+
+        qemu = self.shared_state.qemu_proc
+        if qemu and qemu.returncode is None:
+            sample.update(self.sample_process(qemu.pid, now))
+        return sample
+
+    def sample_process(self, pid: int, now: float) -> Dict[str, float]:
+        sample: Dict[str, float] = {}
+        stat = _read(f'/proc/{pid}/stat')
+        if stat:
+            # The command name may contain spaces, fields are counted from the closing parenthesis
+            fields = stat[stat.rindex(')') + 2:].split()
+            cpu_ticks = int(fields[11]) + int(fields[12])
+            if self._last_cpu and self._last_cpu[1] == pid and now > self._last_cpu[0]:
+                sample['qemu_cpu_percent'] = \
+                    100 * (cpu_ticks - self._last_cpu[2]) / CLOCK_TICKS / (now - self._last_cpu[0])
+            self._last_cpu = (now, pid, cpu_ticks)
+            sample['qemu_rss_mb'] = int(fields[21]) * PAGE_SIZE / MB
+
+        io = parse_key_values(_read(f'/proc/{pid}/io') or '')
+        if 'read_bytes' in io:
+            sample['qemu_read_mb'] = io['read_bytes'] / MB
+            sample['qemu_write_mb'] = io.get('write_bytes', 0) / MB
+        return sample
+
+    async def sample_guest(self) -> None:
+        adb = self.shared_state.adb
+        try:
+            output = await asyncio.wait_for(
+                adb.shell(self.shared_state.config['adb_serial'], 'cat', '/proc/loadavg', '/proc/meminfo'), 5)
+        except Exception:
+            # The device may be busy or ADB restarting, just skip this one
+            self._guest = {}
+            return
+        text = output.decode(errors='replace')
+        lines = text.splitlines()
+        guest: Dict[str, float] = {}
+        if lines and lines[0].split() and not lines[0].startswith('Mem'):
+            try:
+                guest['guest_load1'] = float(lines[0].split()[0])
+            except ValueError:
+                pass
+        meminfo = parse_key_values(text)
+        if 'MemAvailable' in meminfo:
+            guest['guest_mem_available_mb'] = meminfo['MemAvailable'] / 1024
+        self._guest = guest
+
+    def describe(self) -> str:
+        s = self.latest
+        parts = []
+        if 'host_mem_available_mb' in s:
+            parts.append(f"host available {s['host_mem_available_mb']:.0f} MiB")
+        if s.get('host_swap_used_mb'):
+            parts.append(f"swap used {s['host_swap_used_mb']:.0f} MiB")
+        if 'host_load1' in s:
+            parts.append(f"load {s['host_load1']:.2f}")
+        if 'qemu_rss_mb' in s:
+            parts.append(f"QEMU RSS {s['qemu_rss_mb']:.0f} MiB")
+        if 'qemu_cpu_percent' in s:
+            parts.append(f"QEMU CPU {s['qemu_cpu_percent']:.0f}%")
+        if s.get('balloon_mb'):
+            parts.append(f"balloon {s['balloon_mb']:.0f} MiB")
+        if 'guest_mem_available_mb' in s:
+            parts.append(f"guest available {s['guest_mem_available_mb']:.0f} MiB")
+        return ', '.join(parts) or "no samples yet"
+
+    def print_summary(self) -> None:
+        if not self.peaks:
+            return
+        print(Color.CYAN + "Resource usage:" + Color.RESET)
+        lows = ('host_mem_available_mb', 'guest_mem_available_mb')
+        for key in FIELDS[1:]:
+            if key in lows and key in self.lows:
+                print(f"  {key:<24} min {self.lows[key]:10.1f}")
+            elif key in self.peaks:
+                print(f"  {key:<24} max {self.peaks[key]:10.1f}")
@@ -0,0 +1,53 @@
+import argparse
+import os
+import struct
+import sys
+import zlib
+
+from qemu_android_test_orchestrator.screenrec import read_recording, Frame
+from qemu_android_test_orchestrator.utils import Color
+
+
+def write_png(path: str, frame: Frame) -> None:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    stride = frame.width * 3
+    # Filter type 0 (none) in front of every row
+    raw = b''.join(b'\0' + frame.pixels[y * stride:(y + 1) * stride] for y in range(frame.height))
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' +
+                chunk(b'IHDR', struct.pack('>IIBBBBB', frame.width, frame.height, 8, 2, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(raw, 6)) +
+                chunk(b'IEND', b''))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Turn a screen recording (screen_recorder_output) into PNG frames "
+                                                 "and an ffmpeg concat list with their durations")
+    parser.add_argument('recording', help="screen recording path")
+    parser.add_argument('outdir', help="directory to write the frames to")
+    args = parser.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    entries = []
+    for i, (timestamp, frame) in enumerate(read_recording(args.recording)):
+        name = f'frame{i:06d}.png'
+        write_png(os.path.join(args.outdir, name), frame)
+        entries.append((name, timestamp))
+    if not entries:
+        print(Color.RED + "The recording is empty" + Color.RESET, file=sys.stderr)
+        sys.exit(1)
+
+    # Frames are only recorded when something changed, each one stays on screen until the next
+    with open(os.path.join(args.outdir, 'frames.txt'), 'w') as f:
+        for (name, timestamp), (_, next_timestamp) in zip(entries, entries[1:] + entries[-1:]):
+            f.write(f"file '{name}'\nduration {max(next_timestamp - timestamp, 0.04):.3f}\n")
+        # The concat demuxer ignores the last duration unless the file is repeated
+        f.write(f"file '{entries[-1][0]}'\n")
+    print(Color.GREEN + f"Wrote {len(entries)} frames, make a video with:" + Color.RESET)
+    print(f"ffmpeg -f concat -i {os.path.join(args.outdir, 'frames.txt')} -vsync vfr -pix_fmt yuv420p recording.mp4")
+
+
+if __name__ == '__main__':
+    main()
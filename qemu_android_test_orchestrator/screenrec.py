@@ -0,0 +1,324 @@
+import asyncio
+import json
+import os
+import struct
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, List, Tuple, BinaryIO, NamedTuple, Iterator
+
+from qemu_android_test_orchestrator.qmp import QmpError, QemuGone
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.utils import Color
+
+# Screen recordings are a header followed by one record per frame that changed. Each record only holds the tiles that
+# differ from the previous frame, except keyframes which hold all of them so playback can start there.
+#   magic, u32 header size, JSON header ({"tile": 64, "start": unix time})
+#   record: f64 unix time, u16 width, u16 height, u16 tile count, u8 keyframe
+#     tile: u16 x, u16 y, u16 width, u16 height, u32 size, zlib compressed RGB
+# A .timing sidecar has a JSON line per record with its time and file offset, for seeking without decoding.
+RECORDING_MAGIC = b'QSCR0001'
+TILE_SIZE = 64
+# A keyframe is recorded at least this often, in seconds
+KEYFRAME_INTERVAL = 10
+
+_record = struct.Struct('<dHHHB')
+_tile = struct.Struct('<HHHHI')
+
+
+class Frame(NamedTuple):
+    width: int
+    height: int
+    pixels: bytes
+
+
+class Record(NamedTuple):
+    time: float
+    keyframe: bool
+    tiles: int
+    data: bytes
+
+
+def parse_ppm(data: bytes) -> Frame:
+    # What QEMU's screendump writes: "P6\n<width> <height>\n255\n" followed by RGB
+    fields: List[bytes] = []
+    pos = 0
+    while len(fields) < 4:
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b'#':
+            pos = data.index(b'\n', pos)
+            continue
+        end = pos
+        while not data[end:end + 1].isspace():
+            end += 1
+        fields.append(data[pos:end])
+        pos = end
+    if fields[0] != b'P6' or fields[3] != b'255':
+        raise ValueError("Unsupported screendump format")
+    width, height = int(fields[1]), int(fields[2])
+    return Frame(width, height, data[pos + 1:pos + 1 + width * height * 3])
+
+
+class TileDiffer:
+    # Finds the tiles that changed since the previous frame by comparing checksums. Whole bands of tiles are checked
+    # first, so a static screen costs one checksum per band.
+
+    def __init__(self, tile: int = TILE_SIZE) -> None:
+        self.tile = tile
+        self.size: Tuple[int, int] = (0, 0)
+        self.bands: List[int] = []
+        self.tiles: Dict[Tuple[int, int], int] = {}
+
+    def tile_pixels(self, frame: Frame, x: int, y: int) -> Tuple[int, int, bytes]:
+        stride = frame.width * 3
+        w = min(self.tile, frame.width - x)
+        h = min(self.tile, frame.height - y)
+        start = x * 3
+        return w, h, b''.join(frame.pixels[row * stride + start:row * stride + start + w * 3]
+                              for row in range(y, y + h))
+
+    def diff(self, frame: Frame, keyframe: bool = False) -> Tuple[List[Tuple[int, int, int, int, bytes]], int]:
+        # Returns the tiles to record as (x, y, width, height, RGB), which is all of them for a keyframe, and how many
+        # of them really changed
+        if (frame.width, frame.height) != self.size:
+            self.size = (frame.width, frame.height)
+            self.bands = []
+            self.tiles = {}
+            keyframe = True
+        stride = frame.width * 3
+        tiles = []
+        changed = 0
+        for band, y in enumerate(range(0, frame.height, self.tile)):
+            checksum = zlib.crc32(frame.pixels[y * stride:(y + self.tile) * stride])
+            if band < len(self.bands) and self.bands[band] == checksum and not keyframe:
+                continue
+            if band < len(self.bands):
+                self.bands[band] = checksum
+            else:
+                self.bands.append(checksum)
+            for x in range(0, frame.width, self.tile):
+                w, h, pixels = self.tile_pixels(frame, x, y)
+                checksum = zlib.crc32(pixels)
+                if self.tiles.get((x, y)) != checksum:
+                    changed += 1
+                elif not keyframe:
+                    continue
+                self.tiles[(x, y)] = checksum
+                tiles.append((x, y, w, h, pixels))
+        return tiles, changed
+
+    @property
+    def tile_count(self) -> int:
+        return len(self.tiles)
+
+
+def encode_record(timestamp: float, frame: Frame, tiles: List[Tuple[int, int, int, int, bytes]],
+                  keyframe: bool) -> bytes:
+    parts = [_record.pack(timestamp, frame.width, frame.height, len(tiles), keyframe)]
+    for x, y, w, h, pixels in tiles:
+        data = zlib.compress(pixels, 1)
+        parts += [_tile.pack(x, y, w, h, len(data)), data]
+    return b''.join(parts)
+
+
+class RecordingWriter:
+    def __init__(self, path: str) -> None:
+        self.file: BinaryIO = open(path, 'wb')
+        self.timing = open(path + '.timing', 'w')
+        self.start = time.time()
+        header = json.dumps({'tile': TILE_SIZE, 'start': self.start}).encode()
+        self.file.write(RECORDING_MAGIC + struct.pack('<I', len(header)) + header)
+
+    def write(self, record: Record) -> None:
+        self.timing.write(json.dumps({'time': round(record.time - self.start, 3), 'offset': self.file.tell(),
+                                      'tiles': record.tiles, 'keyframe': record.keyframe}) + '\n')
+        self.file.write(record.data)
+
+    def flush(self) -> None:
+        self.file.flush()
+        self.timing.flush()
+
+    def close(self) -> None:
+        self.file.close()
+        self.timing.close()
+
+
+def read_recording(path: str) -> Iterator[Tuple[float, Frame]]:
+    # Yields every recorded frame, fully drawn
+    with open(path, 'rb') as f:
+        if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f"'{path}' is not a screen recording")
+        header_size, = struct.unpack('<I', f.read(4))
+        f.read(header_size)
+        canvas = bytearray()
+        size = (0, 0)
+        while True:
+            head = f.read(_record.size)
+            if len(head) < _record.size:
+                return
+            timestamp, width, height, count, keyframe = _record.unpack(head)
+            if (width, height) != size:
+                size = (width, height)
+                canvas = bytearray(width * height * 3)
+            stride = width * 3
+            for _ in range(count):
+                x, y, w, h, data_size = _tile.unpack(f.read(_tile.size))
+                pixels = zlib.decompress(f.read(data_size))
+                for row in range(h):
+                    start = (y + row) * stride + x * 3
+                    canvas[start:start + w * 3] = pixels[row * w * 3:(row + 1) * w * 3]
+            yield timestamp, Frame(width, height, bytes(canvas))
+
+
+class ScreenCapture:
+    # Grabs the screen with QMP's screendump and only keeps the frames where something changed. The capture interval
+    # goes down to min_interval while the screen changes a lot and backs off up to max_interval while it's static,
+    # so a VM sitting on the home screen during a long build costs next to nothing.
+    # With a failure window, frames are only kept in memory for that many seconds and written out when a test fails,
+    # along with the next failure window seconds.
+    # Reading, diffing, compressing and writing frames happens on a thread of its own, one frame at a time, so the
+    # event loop only waits for QEMU to take the screenshot.
+
+    def __init__(self, shared_state: SynchronizedObject) -> None:
+        config = shared_state.config
+        self.shared_state = shared_state
+        self.output: str = config['screen_recorder_output']
+        self.min_interval: float = config['screen_recorder_min_interval']
+        self.max_interval: float = config['screen_recorder_max_interval']
+        self.window: Optional[float] = config['screen_recorder_failure_window']
+        # The window has to start with a keyframe, more frequent ones keep less than the window around in memory
+        self.keyframe_interval = min(KEYFRAME_INTERVAL, self.window / 2) if self.window else KEYFRAME_INTERVAL
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.dump_path = os.path.join(shm, f"qemu-screen-{os.getpid()}-{config['instance']}.ppm")
+        self.differ = TileDiffer()
+        self.buffer: List[Record] = []
+        self.writer: Optional[RecordingWriter] = None
+        self.record_until = 0.0
+        self.last_keyframe = 0.0
+        self.frames = 0
+        self.recorded = 0
+        self.failures = 0
+        self._task: Optional[asyncio.Task] = None
+        # Everything touching the frames, the buffer and the writer runs there
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='screen-recorder')
+        self.stopped = False
+
+    def start(self) -> None:
+        if self._task:
+            return
+        if not self.window:
+            self.writer = RecordingWriter(self.output)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.stopped:
+            return
+        self.stopped = True
+        # After whatever the thread still has to do, e.g. saving a failure
+        await asyncio.get_event_loop().run_in_executor(self.executor, self.close_writer)
+        self.executor.shutdown()
+        if os.path.exists(self.dump_path):
+            os.unlink(self.dump_path)
+        if self.frames:
+            print(Color.CYAN + f"Screen recorder: {self.recorded} of {self.frames} frames changed and were kept" +
+                  Color.RESET)
+
+    def close_writer(self) -> None:
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def read_dump(self) -> Frame:
+        with open(self.dump_path, 'rb') as f:
+            return parse_ppm(f.read())
+
+    async def grab(self) -> Optional[Frame]:
+        try:
+            await self.shared_state.qmp.execute('screendump', {'filename': self.dump_path})
+        except QmpError:
+            # No display yet
+            return None
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.read_dump)
+
+    async def run(self) -> None:
+        interval = self.min_interval
+        while True:
+            started = time.monotonic()
+            try:
+                frame = await self.grab()
+            except QemuGone:
+                return
+            if frame:
+                self.frames += 1
+                changed = await asyncio.get_event_loop().run_in_executor(self.executor, self.capture, frame)
+                if not changed:
+                    interval = min(self.max_interval, interval * 1.5)
+                else:
+                    # A quarter of the screen changing is as fast as it gets
+                    fraction = min(1.0, 4 * changed / max(1, self.differ.tile_count))
+                    interval = self.max_interval - (self.max_interval - self.min_interval) * fraction
+            # Grabbing and diffing count towards the interval
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def capture(self, frame: Frame) -> int:
+        # Returns how many tiles changed, a keyframe records all of them but only the changed ones count towards the
+        # capture rate
+        now = time.time()
+        keyframe = now - self.last_keyframe >= self.keyframe_interval
+        tiles, changed = self.differ.diff(frame, keyframe)
+        if not tiles:
+            return 0
+        keyframe = keyframe or len(tiles) == self.differ.tile_count
+        if keyframe:
+            self.last_keyframe = now
+        self.recorded += 1
+        record = Record(now, keyframe, len(tiles), encode_record(now, frame, tiles, keyframe))
+        if self.writer:
+            self.writer.write(record)
+            self.writer.flush()
+            if self.window and now > self.record_until:
+                # Back to keeping frames in memory only, they have to start with a keyframe
+                self.writer.close()
+                self.writer = None
+                self.last_keyframe = 0
+        else:
+            self.buffer.append(record)
+            self.trim(now)
+        return changed
+
+    def trim(self, now: float) -> None:
+        # Drops what's older than the window, but keeps it starting with a keyframe
+        assert self.window
+        cutoff = now - self.window
+        keyframes = [i for i, r in enumerate(self.buffer) if r.keyframe and r.time <= cutoff]
+        if keyframes and keyframes[-1] > 0:
+            del self.buffer[:keyframes[-1]]
+
+    def failure(self, reason: str) -> None:
+        # Writes out what's in memory and keeps recording to disk for another window
+        if not self.window or self.stopped:
+            return
+        self.executor.submit(self.save_failure, reason)
+
+    def save_failure(self, reason: str) -> None:
+        assert self.window
+        print(Color.CYAN + f"Screen recorder: saving the last {self.window:g}s ({reason})" + Color.RESET)
+        if not self.writer:
+            # Appending would need the header to be skipped, every failure gets its own file instead
+            self.writer = RecordingWriter(self.next_output())
+        for record in self.buffer:
+            self.writer.write(record)
+        self.writer.flush()
+        self.buffer = []
+        self.record_until = time.time() + self.window
+
+    def next_output(self) -> str:
+        self.failures += 1
+        root, ext = os.path.splitext(self.output)
+        return f'{root}-failure{self.failures}{ext}'
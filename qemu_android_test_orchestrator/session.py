@@ -0,0 +1,148 @@
+import asyncio
+from typing import Dict, Any, List, Optional
+
+from qemu_android_test_orchestrator.adb import AdbClient
+from qemu_android_test_orchestrator.config import instance_config
+from qemu_android_test_orchestrator.fsm import State, ManagerFSM, WorkerFSM
+from qemu_android_test_orchestrator.logcat import LogcatBus
+from qemu_android_test_orchestrator.logstore import LogStoreWriter
+from qemu_android_test_orchestrator.milestones import Milestones, ADB_READY
+from qemu_android_test_orchestrator.prepare import JobPreparation
+from qemu_android_test_orchestrator.resources import ResourceSampler
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.sharding import ShardCoordinator
+from qemu_android_test_orchestrator.timeouts import TimeoutModel
+from qemu_android_test_orchestrator.tracing import Tracer
+from qemu_android_test_orchestrator.utils import Color
+from qemu_android_test_orchestrator.workers.adb_checker import AdbConnectionChecker
+from qemu_android_test_orchestrator.workers.drive_reset import DriveResetServer
+from qemu_android_test_orchestrator.workers.job_manager import JobManager
+from qemu_android_test_orchestrator.workers.log_collector import LogCollector
+from qemu_android_test_orchestrator.workers.log_streamer import LogStreamer
+from qemu_android_test_orchestrator.workers.permission_checker import PermissionDialogChecker
+from qemu_android_test_orchestrator.workers.qemu_manager import QemuSystemManager
+from qemu_android_test_orchestrator.workers.screen_recorder import ScreenRecorder
+from qemu_android_test_orchestrator.workers.virtwifi_manager import VirtWifiManager
+from qemu_android_test_orchestrator.workers.vnc_recorder import VncRecorder
+
+
+class Session:
+    # One orchestrated VM: its shared state, its workers and the manager FSM that drives them
+
+    def __init__(self, config: Dict[str, Any], index: int = 0,
+                 shard_coordinator: Optional[ShardCoordinator] = None,
+                 job_preparation: Optional[JobPreparation] = None) -> None:
+        self.index = index
+        self.stopped = False
+        self.config = instance_config(config, index)
+        self.shared_state = SynchronizedObject()
+        self.shared_state.config = self.config
+        self.shared_state.tracer = Tracer()
+        self.shared_state.adb = AdbClient()
+        self.shared_state.milestones = Milestones(self.shared_state.tracer)
+        self.shared_state.adb_ready = self.shared_state.milestones.event(ADB_READY)
+        self.shared_state.logcat = LogcatBus(self.shared_state)
+        if self.config['log_store_output']:
+            self.shared_state.log_store = LogStoreWriter(self.config['log_store_output'])
+        self.shared_state.shard_coordinator = shard_coordinator
+        self.shared_state.job_preparation = job_preparation
+        self.shared_state.timeouts = TimeoutModel(self.shared_state)
+
+        shared_state = self.shared_state
+        self.workers: List[WorkerFSM] = [
+            QemuSystemManager(shared_state),
+            JobManager(shared_state),
+            AdbConnectionChecker(shared_state)
+        ]
+
+        self.transitions = [
+            State.QEMU_UP,
+            State.NETWORK_UP,
+            State.ADB_UP,
+            State.JOB
+        ]
+
+        if self.config['virtwifi_hack']:
+            self.workers.append(VirtWifiManager(shared_state))
+        if self.config['permission_approve']:
+            self.workers.append(PermissionDialogChecker(shared_state))
+        if self.config['image_reset_port']:
+            if self.config['image_overlays']:
+                self.workers.append(DriveResetServer(shared_state))
+            else:
+                print(Color.YELLOW + "Drive resets need image_overlays, ignoring image_reset_port" + Color.RESET)
+        if self.config['vnc_recorder']:
+            self.workers.append(VncRecorder(shared_state))
+        if self.config['screen_recorder']:
+            self.workers.append(ScreenRecorder(shared_state))
+        if any(self.config[k] for k in ('logcat_stream_output', 'dmesg_stream_output', 'log_store_output')):
+            self.workers.append(LogStreamer(shared_state))
+        if self.config['logcat_output'] or self.config['dmesg_output'] or self.config['bugreport_output']:
+            self.workers.append(LogCollector(shared_state))
+            self.transitions.append(State.LOGCAT)
+
+        self.resources = ResourceSampler(shared_state)
+        self.fsm = ManagerFSM(shared_state.tracer, self.resources, shared_state.milestones)
+        for w in self.workers:
+            self.fsm.register_worker(w)
+
+    @property
+    def name(self) -> str:
+        return f"VM {self.index}"
+
+    @property
+    def returncode(self) -> Optional[int]:
+        if self.shared_state.prepare_returncode:
+            return self.shared_state.prepare_returncode
+        if self.shared_state.shard_coordinator:
+            return self.shared_state.shard_coordinator.returncode
+        if self.shared_state.job_proc:
+            return self.shared_state.job_proc.returncode
+        return None
+
+    async def boot(self) -> None:
+        # Bring the VM up to the point where it can accept a job
+        self.resources.start()
+        await self.fsm.advance([state for state in self.transitions if state.value <= State.ADB_UP.value])
+
+    async def finish(self) -> None:
+        for state in self.transitions:
+            if state.value > State.ADB_UP.value:
+                await self.fsm.transition(state)
+
+    async def start(self) -> None:
+        await self.boot()
+        await self.finish()
+
+    async def stop(self) -> None:
+        if self.stopped:
+            return
+        self.stopped = True
+        try:
+            await asyncio.wait_for(self.fsm.transition(State.STOP), 30)
+        finally:
+            await self.shared_state.logcat.close()
+            await self.resources.stop()
+            if self.shared_state.log_store:
+                self.shared_state.log_store.close()
+            self.write_trace()
+            self.shared_state.timeouts.finish(self.shared_state.tracer)
+
+    async def run(self) -> Optional[int]:
+        try:
+            await self.start()
+        finally:
+            await self.stop()
+        return self.returncode
+
+    def write_trace(self) -> None:
+        tracer = self.shared_state.tracer
+        if self.config['trace_output']:
+            tracer.write_chrome_trace(self.config['trace_output'])
+        if self.config['trace_summary_output']:
+            tracer.write_summary(self.config['trace_summary_output'])
+        if self.config['trace_summary']:
+            suffix = f" ({self.name})" if self.config['instances'] > 1 or self.config['daemon'] else ""
+            print(Color.CYAN + f"Time spent per step{suffix}:" + Color.RESET)
+            tracer.print_summary()
+            self.resources.print_summary()
@@ -0,0 +1,301 @@
+import asyncio
+import heapq
+import json
+import os
+import time
+from typing import Dict, Any, List, Optional, Tuple, NamedTuple, AsyncIterator
+
+from qemu_android_test_orchestrator.adb import AdbClient
+from qemu_android_test_orchestrator.utils import Color, default_cache_dir
+
+# am instrument status codes, see android.app.Instrumentation and AndroidJUnitRunner
+STATUS_START = 1
+STATUS_OK = 0
+STATUS_ERROR = -1
+STATUS_FAILURE = -2
+STATUS_IGNORED = -3
+STATUS_ASSUMPTION_FAILURE = -4
+
+_status_names = {
+    STATUS_OK: 'PASS',
+    STATUS_ERROR: 'ERROR',
+    STATUS_FAILURE: 'FAIL',
+    STATUS_IGNORED: 'SKIP',
+    STATUS_ASSUMPTION_FAILURE: 'SKIP',
+}
+
+# INSTRUMENTATION_CODE reported when the runner finished normally (Activity.RESULT_OK)
+INSTRUMENTATION_OK = -1
+
+# Used to balance tests we have never seen before
+DEFAULT_TEST_DURATION = 2.0
+
+
+class TestResult(NamedTuple):
+    name: str
+    status: int
+    duration: float
+    device: str
+
+
+class Shard:
+    def __init__(self, index: int, args: List[str]) -> None:
+        self.index = index
+        # Extra 'am instrument' arguments selecting the tests of this shard
+        self.args = args
+        self.attempts = 0
+        self.results: List[TestResult] = []
+        self.completed = False
+
+    def __repr__(self) -> str:
+        return f"shard {self.index}"
+
+
+class InstrumentationParser:
+    # Incremental parser for 'am instrument -r' output
+
+    def __init__(self) -> None:
+        self.status: Dict[str, str] = {}
+        self.instrumentation_code: Optional[int] = None
+        self.failed_to_run = False
+
+    def feed(self, line: str) -> Optional[Tuple[str, int]]:
+        # Returns (test name, status code) whenever a test status is complete
+        line = line.rstrip('\r\n')
+        if line.startswith('INSTRUMENTATION_STATUS: '):
+            key, _, value = line[len('INSTRUMENTATION_STATUS: '):].partition('=')
+            self.status[key] = value
+        elif line.startswith('INSTRUMENTATION_STATUS_CODE: '):
+            code = int(line.split(':', 1)[1])
+            name = f"{self.status.get('class', '')}#{self.status.get('test', '')}"
+            self.status = {}
+            return name, code
+        elif line.startswith('INSTRUMENTATION_CODE: '):
+            self.instrumentation_code = int(line.split(':', 1)[1])
+        elif line.startswith('INSTRUMENTATION_FAILED'):
+            self.failed_to_run = True
+        return None
+
+    @property
+    def finished(self) -> bool:
+        return not self.failed_to_run and self.instrumentation_code == INSTRUMENTATION_OK
+
+
+class TestTimings:
+    # Per-test durations recorded by previous runs, used to balance shards
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.durations: Dict[str, float] = {}
+        if os.access(path, os.R_OK):
+            try:
+                with open(path) as f:
+                    self.durations = json.load(f)
+            except ValueError:
+                pass
+
+    def update(self, results: List[TestResult]) -> None:
+        for result in results:
+            if result.status not in (STATUS_OK, STATUS_FAILURE, STATUS_ERROR):
+                continue
+            previous = self.durations.get(result.name)
+            # Exponential moving average, so a single slow run doesn't skew the balancing too much
+            self.durations[result.name] = result.duration if previous is None else (previous + result.duration) / 2
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.durations, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def balance_classes(tests: List[str], timings: Dict[str, float], shards: int) -> List[List[str]]:
+    # Longest processing time first: assign classes by decreasing duration to the least loaded shard. Classes are kept
+    # together so their setup and teardown only run once.
+    known = [timings[t] for t in tests if t in timings]
+    default = sorted(known)[len(known) // 2] if known else DEFAULT_TEST_DURATION
+    class_durations: Dict[str, float] = {}
+    for test in tests:
+        cls = test.split('#')[0]
+        class_durations[cls] = class_durations.get(cls, 0.0) + timings.get(test, default)
+
+    heap = [(0.0, i) for i in range(shards)]
+    assignment: List[List[str]] = [[] for _ in range(shards)]
+    for cls, duration in sorted(class_durations.items(), key=lambda i: (-i[1], i[0])):
+        load, i = heapq.heappop(heap)
+        assignment[i].append(cls)
+        heapq.heappush(heap, (load + duration, i))
+    return [a for a in assignment if a]
+
+
+class ShardCoordinator:
+    # Shared by all sessions: hands out shards to whichever device is ready and merges the results
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        if not config['job_instrumentation']:
+            raise ValueError("job_instrumentation must be set to the test runner (package/runner) to shard tests")
+        self.config = config
+        self.adb = AdbClient()
+        self.num_shards: int = config['job_shards'] or config['instances']
+        self.timings = TestTimings(config['job_timings_file'] or
+                                   os.path.join(default_cache_dir(), 'test_timings.json'))
+        self.queue: 'asyncio.Queue[Shard]' = asyncio.Queue()
+        self.shards: List[Shard] = []
+        self.outstanding = 0
+        self.all_done = asyncio.Event()
+        self._planned = False
+        self._plan_lock = asyncio.Lock()
+
+    def instrument_command(self, *args: str) -> Tuple[str, ...]:
+        extra: List[str] = []
+        for key, value in self.config['job_instrumentation_args'].items():
+            extra += ['-e', key, str(value)]
+        return 'am', 'instrument', '-w', '-r', *extra, *args, self.config['job_instrumentation']
+
+    async def run_instrumentation(self, serial: str, *args: str) -> AsyncIterator[Tuple[str, int, float]]:
+        # Yields (test name, status code, duration) as tests finish. Raises if the run didn't complete.
+        reader, writer = await self.adb.open_shell(serial, *self.instrument_command(*args))
+        parser = InstrumentationParser()
+        started: Dict[str, float] = {}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                event = parser.feed(line.decode(errors='replace'))
+                if not event:
+                    continue
+                name, code = event
+                if code == STATUS_START:
+                    started[name] = time.monotonic()
+                else:
+                    yield name, code, time.monotonic() - started.pop(name, time.monotonic())
+        finally:
+            # Hangs up the instrumentation if we're bailing out early
+            writer.close()
+        if not parser.finished:
+            raise RuntimeError(f"Instrumentation did not complete (code {parser.instrumentation_code})")
+
+    async def list_tests(self, serial: str) -> List[str]:
+        # In log-only mode the runner reports every test without running it
+        tests = []
+        async for name, code, _ in self.run_instrumentation(serial, '-e', 'log', 'true'):
+            if code == STATUS_OK:
+                tests.append(name)
+        return tests
+
+    async def plan(self, serial: str) -> None:
+        async with self._plan_lock:
+            if self._planned:
+                return
+            self._planned = True
+
+            tests: List[str] = []
+            if self.timings.durations:
+                try:
+                    tests = await self.list_tests(serial)
+                except Exception as e:
+                    print(Color.RED + f"Unable to list tests, falling back to hash sharding: {e}" + Color.RESET)
+
+            if tests:
+                groups = balance_classes(tests, self.timings.durations, self.num_shards)
+                print(Color.GREEN + f"Split {len(tests)} tests into {len(groups)} duration-balanced shards" +
+                      Color.RESET)
+                for i, classes in enumerate(groups):
+                    self.shards.append(Shard(i, ['-e', 'class', ','.join(classes)]))
+            else:
+                print(Color.GREEN + f"Split tests into {self.num_shards} shards" + Color.RESET)
+                for i in range(self.num_shards):
+                    self.shards.append(Shard(i, ['-e', 'numShards', str(self.num_shards), '-e', 'shardIndex', str(i)]))
+
+            self.outstanding = len(self.shards)
+            for shard in self.shards:
+                self.queue.put_nowait(shard)
+
+    async def run_shard(self, shard: Shard, serial: str) -> None:
+        shard.attempts += 1
+        shard.results = []
+        async for name, code, duration in self.run_instrumentation(serial, *shard.args):
+            shard.results.append(TestResult(name, code, duration, serial))
+            color = Color.GREEN if code in (STATUS_OK, STATUS_IGNORED, STATUS_ASSUMPTION_FAILURE) else Color.RED
+            print(color + f"[{serial}] {_status_names.get(code, code)} {name} ({duration:.1f}s)" + Color.RESET)
+        shard.completed = True
+
+    async def work(self, serial: str) -> bool:
+        # Runs shards on the given device until there are none left. Returns False if any of them failed.
+        await self.plan(serial)
+        ok = True
+        while self.outstanding > 0:
+            get = asyncio.ensure_future(self.queue.get())
+            done = asyncio.ensure_future(self.all_done.wait())
+            await asyncio.wait((get, done), return_when=asyncio.FIRST_COMPLETED)
+            done.cancel()
+            if not get.done():
+                get.cancel()
+                break
+            shard = get.result()
+
+            print(Color.CYAN + f"Running {shard} on {serial}" + Color.RESET)
+            try:
+                await self.run_shard(shard, serial)
+            except Exception as e:
+                # The device itself is likely gone, it would burn through the attempts of every shard in no time
+                print(Color.RED + f"{shard} crashed on {serial}, not giving it any more shards: {e}" + Color.RESET)
+                if shard.attempts < 2:
+                    # Give it another chance on another device
+                    self.queue.put_nowait(shard)
+                else:
+                    self.shard_done()
+                return False
+            except BaseException:
+                # Stopped in the middle of it (e.g. the session is shutting down), it's up to the other devices now
+                shard.attempts -= 1
+                self.queue.put_nowait(shard)
+                raise
+            if any(r.status in (STATUS_FAILURE, STATUS_ERROR) for r in shard.results):
+                ok = False
+            self.shard_done()
+        return ok
+
+    def shard_done(self) -> None:
+        self.outstanding -= 1
+        if self.outstanding == 0:
+            self.finish()
+            self.all_done.set()
+
+    @property
+    def results(self) -> List[TestResult]:
+        return [r for shard in self.shards for r in shard.results]
+
+    @property
+    def returncode(self) -> int:
+        if not self.shards or not all(s.completed for s in self.shards):
+            return 1
+        return 1 if any(r.status in (STATUS_FAILURE, STATUS_ERROR) for r in self.results) else 0
+
+    def finish(self) -> None:
+        results = self.results
+        self.timings.update(results)
+        self.timings.save()
+
+        failed = [r for r in results if r.status in (STATUS_FAILURE, STATUS_ERROR)]
+        incomplete = [s for s in self.shards if not s.completed]
+        print(Color.CYAN + f"Ran {len(results)} tests in {len(self.shards)} shards, {len(failed)} failed" + Color.RESET)
+        for r in failed:
+            print(Color.RED + f"  {_status_names[r.status]} {r.name} on {r.device}" + Color.RESET)
+        for s in incomplete:
+            print(Color.RED + f"  {s} did not complete" + Color.RESET)
+
+        if self.config['job_results_output']:
+            with open(self.config['job_results_output'], 'w') as f:
+                json.dump({
+                    'returncode': self.returncode,
+                    'shards': [{
+                        'index': s.index,
+                        'args': s.args,
+                        'completed': s.completed,
+                        'attempts': s.attempts,
+                    } for s in self.shards],
+                    'tests': [r._asdict() for r in results],
+                }, f, indent=2)
@@ -1,6 +1,22 @@
 import asyncio
 from threading import Lock
-from typing import Iterable, Dict, Any, Optional
+from typing import Iterable, Dict, Any, Optional, TYPE_CHECKING
+
+from qemu_android_test_orchestrator.console import ConsoleBuffer
+from qemu_android_test_orchestrator.expect import ExpectEngine
+from qemu_android_test_orchestrator.tracing import Tracer, NULL_TRACER
+
+if TYPE_CHECKING:
+    from qemu_android_test_orchestrator.adb import AdbClient
+    from qemu_android_test_orchestrator.debuglog import ConsoleDebugLog
+    from qemu_android_test_orchestrator.images import DiskImages
+    from qemu_android_test_orchestrator.logcat import LogcatBus
+    from qemu_android_test_orchestrator.logstore import LogStoreWriter
+    from qemu_android_test_orchestrator.milestones import Milestones
+    from qemu_android_test_orchestrator.qmp import QmpClient
+    from qemu_android_test_orchestrator.prepare import JobPreparation
+    from qemu_android_test_orchestrator.sharding import ShardCoordinator
+    from qemu_android_test_orchestrator.timeouts import TimeoutModel
 
 
 # The synchronized access was implemented because I had initially planned to use threads for some operations.
@@ -16,17 +32,39 @@ class SynchronizedObject:
     config: Optional[Dict[str, Any]] = None
     qemu_proc: Optional[asyncio.subprocess.Process] = None
     job_proc: Optional[asyncio.subprocess.Process] = None
-    adb_proc: Optional[asyncio.subprocess.Process] = None
+    prepare_returncode: Optional[int] = None
     vnc_recorder_proc: Optional[asyncio.subprocess.Process] = None
     qemu_serial_reader: Optional[asyncio.StreamReader] = None
     qemu_serial_writer: Optional[asyncio.StreamWriter] = None
     qemu_monitor_reader: Optional[asyncio.StreamReader] = None
     qemu_monitor_writer: Optional[asyncio.StreamWriter] = None
-    qemu_serial_buffer: Optional[bytes] = None
-    qemu_monitor_buffer: Optional[bytes] = None
+    qemu_serial_buffer: Optional[ConsoleBuffer] = None
+    qemu_monitor_buffer: Optional[ConsoleBuffer] = None
+    qemu_serial_expect: Optional[ExpectEngine] = None
+    qemu_monitor_expect: Optional[ExpectEngine] = None
     qemu_sock_stopdebug: Optional[bool] = None
+    qemu_debug_log: Optional['ConsoleDebugLog'] = None
+    qmp: Optional['QmpClient'] = None
+    snapshot_restored: bool = False
+    provisioned: bool = False
+    adb: Optional['AdbClient'] = None
+    milestones: Optional['Milestones'] = None
+    adb_ready: Optional[asyncio.Event] = None
+    logcat: Optional['LogcatBus'] = None
+    log_store: Optional['LogStoreWriter'] = None
+    shard_coordinator: Optional['ShardCoordinator'] = None
+    job_preparation: Optional['JobPreparation'] = None
+    disk_images: Optional['DiskImages'] = None
+
+    timeouts: Optional['TimeoutModel'] = None
+
+    # Guest slowness compared to a KVM guest, set by the timeout model's calibration
+    vm_timeout_multiplier: float = 1
+    tracer: Tracer = NULL_TRACER
 
-    vm_timeout_multiplier = 1
+    def __init__(self) -> None:
+        # Each orchestrated VM gets its own shared state, so the storage must not be shared between instances
+        self.__vars = {}
 
     def __getattribute__(self, item: str) -> Any:
         if not item.startswith('_'):
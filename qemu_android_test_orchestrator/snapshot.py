@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import shlex
+from typing import List, Optional, Dict, Any
+
+from qemu_android_test_orchestrator.utils import default_cache_dir
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+def _drive_options(value: str) -> Dict[str, str]:
+    options = {}
+    for item in value.split(','):
+        key, _, val = item.partition('=')
+        options[key] = val
+    return options
+
+
+def image_files(qemu_args: List[str], workdir: Optional[str]) -> List[str]:
+    # Files whose contents end up in the VM state: kernel, initrd and read-only drives. Writable drives (i.e. the USB
+    # stick) are expected to change between runs and are not part of the snapshot.
+    files = []
+    for opt, value in zip(qemu_args, qemu_args[1:]):
+        if opt in ('-kernel', '-initrd'):
+            files.append(value)
+        elif opt == '-drive':
+            options = _drive_options(value)
+            if 'file' in options and ('readonly' in options and options['readonly'] in ('', 'on')):
+                files.append(options['file'])
+    return [os.path.join(workdir or '.', f) for f in files]
+
+
+class FileDigestCache:
+    # Hashing multi-gigabyte system images on every run would defeat the purpose, so digests are cached and only
+    # recomputed when the file size or modification time changes.
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.digests: Dict[str, Any] = {}
+        if os.access(path, os.R_OK):
+            try:
+                with open(path) as f:
+                    self.digests = json.load(f)
+            except ValueError:
+                pass
+
+    def digest(self, file: str) -> str:
+        file = os.path.abspath(file)
+        st = os.stat(file)
+        cached = self.digests.get(file)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        h = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        self.digests[file] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+    def save(self) -> None:
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.digests, f)
+        os.replace(tmp, self.path)
+
+
+class SnapshotStore:
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.dir = os.path.join(config['snapshot_dir'] or default_cache_dir(), 'snapshots')
+        os.makedirs(self.dir, exist_ok=True)
+        self.key = self.compute_key(config)
+        # VMs running in the same process share the key, their snapshots must not be written to the same file
+        self.instance = config['instance']
+
+    def compute_key(self, config: Dict[str, Any]) -> str:
+        digests = FileDigestCache(os.path.join(self.dir, 'digests.json'))
+        h = hashlib.sha256()
+        h.update(json.dumps({
+            'version': SNAPSHOT_FORMAT_VERSION,
+            'qemu_bin': config['qemu_bin'],
+            'qemu_args': config['qemu_args'],
+            'disable_packages': config['disable_packages'],
+            'virtwifi_hack': config['virtwifi_hack'],
+        }, sort_keys=True).encode())
+        files = image_files(config['qemu_args'], config['qemu_workdir'])
+        if config['virtwifi_hack']:
+            files.append(config['virtwificonnector_apk'])
+        for file in files:
+            h.update(file.encode() + b'\0' + digests.digest(file).encode())
+        digests.save()
+        return h.hexdigest()[:32]
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.dir, f'{self.key}.vmstate')
+
+    @property
+    def tmp_path(self) -> str:
+        return f'{self.path}.{os.getpid()}-{self.instance}.tmp'
+
+    def exists(self) -> bool:
+        return os.access(self.path, os.R_OK)
+
+    def incoming_args(self) -> List[str]:
+        return ['-incoming', f'exec:cat {shlex.quote(self.path)}']
+
+    def migrate_uri(self) -> str:
+        return f'exec:cat > {shlex.quote(self.tmp_path)}'
+
+    def commit(self) -> None:
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self) -> None:
+        for path in (self.tmp_path, self.path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import math
+import os
+import platform
+import time
+from typing import Dict, Any, List, Optional
+
+from qemu_android_test_orchestrator.probes import run_shell
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.snapshot import image_files
+from qemu_android_test_orchestrator.tracing import Tracer
+from qemu_android_test_orchestrator.utils import Color, default_cache_dir
+
+# How many runs worth of durations are kept per step
+HISTORY_SIZE = 50
+
+# Busy loop run in the guest shell to measure how fast it is
+CALIBRATION_COMMAND = 'i=0; while [ $i -lt 20000 ]; do i=$((i + 1)); done'
+# The speed factor is clamped to this range. It never goes below 1 so the hardcoded timeouts, which were written for
+# KVM, are never made shorter by a lucky calibration.
+MIN_SPEED = 1.0
+MAX_SPEED = 20.0
+
+
+def percentile(values: List[float], p: float) -> float:
+    # Nearest rank
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p * len(ordered)) - 1))]
+
+
+class StepHistory:
+    # Durations of the steps of previous runs, per host and image. Durations are stored divided by the speed factor of
+    # the run they come from, so runs on a busy or KVM-less host can be compared to the others.
+
+    def __init__(self, path: str, key: str) -> None:
+        self.path = path
+        self.key = key
+        self.entry: Dict[str, Any] = self.load().get(key, {})
+
+    def load(self) -> Dict[str, Any]:
+        if not os.access(self.path, os.R_OK):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def samples(self, step: str) -> List[float]:
+        return self.entry.get('steps', {}).get(step, [])
+
+    def save(self, steps: Dict[str, float], calibration: Optional[float]) -> None:
+        # Other VMs of the same run may have saved theirs in the meantime
+        data = self.load()
+        entry = data.setdefault(self.key, {})
+        for step, duration in steps.items():
+            samples = entry.setdefault('steps', {}).setdefault(step, [])
+            samples.append(round(duration, 3))
+            del samples[:-HISTORY_SIZE]
+        if calibration is not None:
+            calibrations = entry.setdefault('calibration', [])
+            calibrations.append(round(calibration, 4))
+            del calibrations[:-HISTORY_SIZE]
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+class TimeoutModel:
+    # Replaces the fixed "5 times longer without KVM" rule. A short busy loop run in the guest measures how slow it is
+    # compared to a KVM guest, which gives the speed factor used to scale timeouts and polling intervals
+    # (vm_timeout_multiplier). Steps that have enough history get a deadline of p99 x margin instead of their hardcoded
+    # timeout, and steps taking well over their usual time are reported at the end.
+
+    def __init__(self, shared_state: SynchronizedObject) -> None:
+        config = shared_state.config
+        self.shared_state = shared_state
+        self.margin: float = config['timeout_margin']
+        self.min_samples: int = config['timeout_min_samples']
+        self.regression_factor: float = config['timeout_regression_factor']
+        self.reference: float = config['timeout_calibration_reference']
+        self.calibration: Optional[float] = None
+        self.history: Optional[StepHistory] = None
+        if config['timeout_history']:
+            path = config['timeout_history_file'] or os.path.join(default_cache_dir(), 'step_history.json')
+            self.history = StepHistory(path, self.history_key(config))
+
+    @staticmethod
+    def history_key(config: Dict[str, Any]) -> str:
+        h = hashlib.sha256(platform.node().encode())
+        # Runs that can warm start take a different path through the boot even when they end up cold booting
+        h.update(json.dumps({k: config[k] for k in ('snapshot', 'provision')}, sort_keys=True).encode())
+        for file in image_files(config['qemu_args'], config['qemu_workdir']):
+            try:
+                st = os.stat(file)
+            except OSError:
+                continue
+            h.update(f'{file}\0{st.st_size}\0{st.st_mtime_ns}'.encode())
+        return h.hexdigest()[:16]
+
+    @property
+    def speed(self) -> float:
+        return self.shared_state.vm_timeout_multiplier
+
+    def history_step(self, step: str) -> str:
+        # A restored snapshot makes the boot steps a lot shorter than a cold boot, their durations are kept apart. Until
+        # the VM is up the boot counts as cold, so a failed restore still gets cold boot deadlines.
+        if self.shared_state.snapshot_restored:
+            return f'{step} [snapshot]'
+        if self.shared_state.provisioned:
+            return f'{step} [provisioned]'
+        return f'{step} [cold]'
+
+    def deadline(self, step: str, default: float) -> float:
+        # default is what the step was given on a KVM host before there was any history
+        samples = self.history.samples(self.history_step(step)) if self.history else []
+        if len(samples) < self.min_samples:
+            return default * self.speed
+        # Never less than a minute, a handful of quick runs shouldn't make the next one fail for a hiccup
+        return max(percentile(samples, 0.99) * self.margin, 60) * self.speed
+
+    async def calibrate(self) -> None:
+        # Needs the serial shell. Runs once; the guest doesn't get any faster afterwards.
+        if self.calibration is not None:
+            return
+        start = time.monotonic()
+        with self.shared_state.tracer.span('speed calibration'):
+            output = await run_shell(self.shared_state, CALIBRATION_COMMAND, timeout=60)
+        if output is None:
+            print(Color.YELLOW + "Guest speed calibration timed out, keeping the default timeouts" + Color.RESET)
+            return
+        self.calibration = time.monotonic() - start
+        speed = min(MAX_SPEED, max(MIN_SPEED, self.calibration / self.reference))
+        print(Color.GREEN + f"Guest speed calibration: {self.calibration:.2f}s, timeouts scaled by {speed:.1f} "
+                            f"(was {self.speed:.1f})" + Color.RESET)
+        self.shared_state.vm_timeout_multiplier = speed
+
+    def step_durations(self, tracer: Tracer) -> Dict[str, float]:
+        # Total time per span name, leaving out the ones that failed since they tell nothing about how long it takes
+        durations: Dict[str, float] = {}
+        for event in tracer.events:
+            if event['ph'] != 'X' or 'error' in event['args']:
+                continue
+            durations[event['name']] = durations.get(event['name'], 0.0) + event['dur'] / 1e6
+        return durations
+
+    def finish(self, tracer: Tracer) -> None:
+        if not self.history:
+            return
+        normalized = {step: duration / self.speed for step, duration in self.step_durations(tracer).items()}
+        regressions = []
+        for step, duration in normalized.items():
+            samples = self.history.samples(self.history_step(step))
+            if len(samples) < self.min_samples:
+                continue
+            usual = percentile(samples, 0.95)
+            # Sub-second steps are too noisy to complain about
+            if duration > 1 and duration > usual * self.regression_factor:
+                regressions.append((step, duration * self.speed, usual * self.speed))
+        if regressions:
+            print(Color.YELLOW + "Steps that took much longer than usual:" + Color.RESET)
+            for step, duration, usual in sorted(regressions, key=lambda r: -r[1] / r[2]):
+                print(Color.YELLOW + f"  {step}: {duration:.1f}s (p95 {usual:.1f}s)" + Color.RESET)
+        self.history.save({self.history_step(step): duration for step, duration in normalized.items()},
+                          self.calibration)
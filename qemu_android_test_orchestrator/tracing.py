@@ -0,0 +1,102 @@
+import contextvars
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+
+# Spans opened without an explicit track end up on the track of the enclosing span, so waits performed by a worker are
+# drawn on that worker's row in the trace viewer
+_current_track: contextvars.ContextVar[str] = contextvars.ContextVar('trace_track', default='main')
+
+
+class Tracer:
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.events: List[Dict[str, Any]] = []
+        self._tids: Dict[str, int] = {}
+        self._origin = time.perf_counter()
+
+    def _now_us(self) -> float:
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def _tid(self, track: str) -> int:
+        if track not in self._tids:
+            self._tids[track] = len(self._tids) + 1
+        return self._tids[track]
+
+    @contextmanager
+    def span(self, name: str, cat: str = 'step', track: Optional[str] = None, **args: Any) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+
+        token = _current_track.set(track) if track else None
+        track = _current_track.get()
+        start = self._now_us()
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = type(e).__name__
+            raise
+        finally:
+            if token:
+                _current_track.reset(token)
+            self.events.append({
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': round(start, 1),
+                'dur': round(self._now_us() - start, 1),
+                'pid': os.getpid(),
+                'tid': self._tid(track),
+                'args': {k: str(v) for k, v in args.items()},
+            })
+
+    def instant(self, name: str, cat: str = 'milestone', track: Optional[str] = None) -> None:
+        if not self.enabled:
+            return
+        self.events.append({
+            'name': name,
+            'cat': cat,
+            'ph': 'i',
+            's': 't',
+            'ts': round(self._now_us(), 1),
+            'pid': os.getpid(),
+            'tid': self._tid(track or _current_track.get()),
+        })
+
+    def write_chrome_trace(self, path: str) -> None:
+        metadata = [{
+            'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': track}
+        } for track, tid in self._tids.items()]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        # Per span name: count, total and longest duration in seconds
+        result: Dict[str, Dict[str, float]] = {}
+        for event in self.events:
+            if event['ph'] != 'X':
+                continue
+            entry = result.setdefault(event['name'], {'count': 0, 'total': 0.0, 'max': 0.0})
+            entry['count'] += 1
+            entry['total'] += event['dur'] / 1e6
+            entry['max'] = max(entry['max'], event['dur'] / 1e6)
+        return result
+
+    def write_summary(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def print_summary(self) -> None:
+        rows: List[Tuple[str, Dict[str, float]]] = sorted(self.summary().items(), key=lambda i: -i[1]['total'])
+        if not rows:
+            return
+        width = max(len(name) for name, _ in rows)
+        print(f"{'Step'.ljust(width)}  {'Count':>5}  {'Total':>9}  {'Max':>9}")
+        for name, entry in rows:
+            print(f"{name.ljust(width)}  {entry['count']:>5}  {entry['total']:>8.2f}s  {entry['max']:>8.2f}s")
+
+
+NULL_TRACER = Tracer(enabled=False)
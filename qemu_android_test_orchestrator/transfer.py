@@ -0,0 +1,146 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+from typing import Optional
+
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.utils import Color, SHELL_PROMPT, wait_shell_prompt, wait_shell_available
+
+# Lines sent over the serial console must stay well below the 4K canonical mode line limit of the guest tty
+SERIAL_LINE_SIZE = 768
+# Number of lines sent before waiting for the guest to acknowledge them
+SERIAL_WINDOW = 16
+
+
+class TransferError(Exception):
+    pass
+
+
+async def _write(shared_state: SynchronizedObject, data: bytes) -> None:
+    writer = shared_state.qemu_serial_writer
+    assert writer
+    writer.write(data)
+    await writer.drain()
+
+
+async def interrupt(shared_state: SynchronizedObject) -> None:
+    # Ctrl+C whatever is running in the foreground
+    await _write(shared_state, b'\x03\n')
+    await wait_shell_prompt(shared_state, timeout=10)
+
+
+async def verify(shared_state: SynchronizedObject, remote_path: str, data: bytes) -> bool:
+    # The digest isn't part of the command, so the echoed command line can't match it
+    digest = hashlib.md5(data).hexdigest().encode()
+    engine = shared_state.qemu_serial_expect
+    offset = engine.buffer.end_offset
+    await _write(shared_state, f'md5sum {remote_path}\n'.encode())
+    match = await engine.wait_for(digest, 30 * shared_state.vm_timeout_multiplier, offset)
+    await wait_shell_prompt(shared_state)
+    return match is not None
+
+
+async def push_tcp(shared_state: SynchronizedObject, data: bytes, remote_path: str) -> None:
+    # Serve the file once on a random local port. QEMU's user networking maps the host's loopback interface to the
+    # gateway address in the guest, which pulls it with netcat.
+    config = shared_state.config
+    served: 'asyncio.Future[None]' = asyncio.get_event_loop().create_future()
+
+    async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            writer.write(data)
+            await writer.drain()
+            writer.close()
+            if not served.done():
+                served.set_result(None)
+        except ConnectionError as e:
+            if not served.done():
+                served.set_exception(e)
+
+    server = await asyncio.start_server(serve, '127.0.0.1', 0)
+    # The prompt coming back before the file was served means netcat gave up, e.g. because the network isn't up yet
+    exited = shared_state.qemu_serial_expect.expect(SHELL_PROMPT)
+    try:
+        port = server.sockets[0].getsockname()[1]
+        await _write(shared_state, f"nc {config['transfer_host_address']} {port} > {remote_path}\n".encode())
+        await asyncio.wait((served, exited), timeout=60 * shared_state.vm_timeout_multiplier,
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not served.done() and exited.done():
+            # The prompt can win the race against the server noticing it's done
+            await asyncio.wait((served,), timeout=1)
+        if not served.done():
+            if exited.done():
+                raise TransferError("netcat exited without fetching the file")
+            raise asyncio.TimeoutError()
+        served.result()
+        if not await wait_shell_prompt(shared_state, timeout=10):
+            # Some netcat builds keep waiting on stdin after the server hangs up, the checksum will tell if we're good
+            await interrupt(shared_state)
+    except Exception:
+        await interrupt(shared_state)
+        raise
+    finally:
+        exited.cancel()
+        server.close()
+
+
+async def push_serial(shared_state: SynchronizedObject, data: bytes, remote_path: str) -> None:
+    # Fallback for guests without networking: base64 over the serial console, with flow control based on the guest
+    # acknowledging each window of lines instead of fixed sleeps
+    config = shared_state.config
+    engine = shared_state.qemu_serial_expect
+    compress = config['transfer_serial_compress']
+    payload = base64.standard_b64encode(gzip.compress(data) if compress else data)
+    tmp_path = remote_path + '.b64'
+    lines = [payload[i:i + SERIAL_LINE_SIZE] for i in range(0, len(payload), SERIAL_LINE_SIZE)]
+
+    # Keep the echoed payload out of the terminal, it still ends up in the raw console log
+    debug_log = shared_state.qemu_debug_log
+    if debug_log:
+        debug_log.muted += 1
+    try:
+        await _write(shared_state, f'rm -f {tmp_path}\n'.encode())
+        await wait_shell_prompt(shared_state)
+        for window, start in enumerate(range(0, len(lines), SERIAL_WINDOW)):
+            offset = engine.buffer.end_offset
+            chunk = b'\n'.join(lines[start:start + SERIAL_WINDOW])
+            # The guest computes the marker, so the echoed command line doesn't match it
+            await _write(shared_state, f"cat >> {tmp_path} << 'EOF'\n".encode() + chunk +
+                         f"\nEOF\necho @ACK$(({window} + 1))@\n".encode())
+            ack = f'@ACK{window + 1}@'.encode()
+            if not await engine.wait_for(ack, 30 * shared_state.vm_timeout_multiplier, offset):
+                raise TransferError(f"Guest did not acknowledge window {window}")
+
+        decompress = ' | gzip -d' if compress else ''
+        await _write(shared_state, f'base64 -d {tmp_path}{decompress} > {remote_path}; rm -f {tmp_path}\n'.encode())
+        await wait_shell_prompt(shared_state)
+    finally:
+        if debug_log:
+            debug_log.muted -= 1
+
+
+async def push_file(shared_state: SynchronizedObject, local_path: str, remote_path: str,
+                    method: Optional[str] = None) -> None:
+    assert shared_state.config
+    with open(local_path, 'rb') as f:
+        data = f.read()
+    method = method or shared_state.config['transfer_method']
+    tracer = shared_state.tracer
+
+    if method == 'tcp':
+        try:
+            with tracer.span('transfer', method='tcp', size=len(data)):
+                await push_tcp(shared_state, data, remote_path)
+            if await verify(shared_state, remote_path, data):
+                return
+            print(Color.RED + f"Checksum mismatch after TCP transfer of '{local_path}'" + Color.RESET)
+        except (OSError, asyncio.TimeoutError, TransferError) as e:
+            print(Color.RED + f"TCP transfer of '{local_path}' failed: {e}" + Color.RESET)
+        print(Color.YELLOW + "Falling back to the serial console" + Color.RESET)
+        await wait_shell_available(shared_state)
+
+    with tracer.span('transfer', method='serial', size=len(data)):
+        await push_serial(shared_state, data, remote_path)
+    if not await verify(shared_state, remote_path, data):
+        raise TransferError(f"Checksum mismatch after serial transfer of '{local_path}'")
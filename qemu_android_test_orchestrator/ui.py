@@ -0,0 +1,58 @@
+import re
+import xml.etree.ElementTree as ElementTree
+from typing import Optional, Tuple
+
+from qemu_android_test_orchestrator.adb import AdbError
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+
+# Looking at and poking the guest's UI over ADB, which unlike key presses doesn't depend on where the focus is
+
+_bounds_re = re.compile(r'\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]')
+
+
+async def adb_shell(shared_state: SynchronizedObject, command: str) -> Optional[bytes]:
+    try:
+        return await shared_state.adb.shell(shared_state.config['adb_serial'], 'sh', '-c', command)
+    except (AdbError, ConnectionError):
+        return None
+
+
+async def dump_hierarchy(shared_state: SynchronizedObject) -> Optional[ElementTree.Element]:
+    # uiautomator prints the dump followed by a "dumped to" line when asked to write it to the tty
+    output = await adb_shell(shared_state, 'uiautomator dump /dev/tty')
+    if not output:
+        return None
+    start, end = output.find(b'<?xml'), output.rfind(b'>')
+    if start < 0 or end < start:
+        return None
+    try:
+        return ElementTree.fromstring(output[start:end + 1])
+    except ElementTree.ParseError:
+        return None
+
+
+def node_center(node: ElementTree.Element) -> Optional[Tuple[int, int]]:
+    match = _bounds_re.fullmatch(node.get('bounds', ''))
+    if not match:
+        return None
+    x1, y1, x2, y2 = map(int, match.groups())
+    return (x1 + x2) // 2, (y1 + y2) // 2
+
+
+async def find_node(shared_state: SynchronizedObject, resource_id: Optional[str] = None,
+                    text: Optional[str] = None) -> Optional[ElementTree.Element]:
+    root = await dump_hierarchy(shared_state)
+    if root is None:
+        return None
+    for node in root.iter('node'):
+        if resource_id is not None and node.get('resource-id') != resource_id:
+            continue
+        if text is not None and node.get('text', '').lower() != text.lower():
+            continue
+        if node.get('enabled', 'true') == 'true':
+            return node
+    return None
+
+
+async def tap(shared_state: SynchronizedObject, x: int, y: int) -> bool:
+    return await adb_shell(shared_state, f'input tap {x} {y}') is not None
@@ -1,110 +1,160 @@
 import asyncio
+import functools
 import os
 import random
-import shutil
+import re
 from os.path import exists
-from typing import Tuple
+from typing import Callable, Any, TypeVar
 
 from qemu_android_test_orchestrator.shared_state import SynchronizedObject
 
 
-async def kvm_available() -> Tuple[bool, str]:
-    # If libvirt's tool is available it should return a better answer than we can
-    if shutil.which('virt-host-validate'):
-        p = await asyncio.subprocess.create_subprocess_exec('virt-host-validate', '-q', 'qemu',
-                                                            stdout=asyncio.subprocess.PIPE)
-        stdout = await p.stdout.read()
-        await p.wait()
-        return b"FAIL" not in stdout, "libvirt"
-
-    # If it's not available, check CPU flags
-    if not os.access("/proc/cpuinfo", os.R_OK):
-        print(Color.RED + "Unable to read CPU flags" + Color.RESET)
-        return False, "cpu flags"
-    flaglines = set()
-    flags = set()
-    with open("/proc/cpuinfo") as f:
-        for line in f.readlines():
-            if line.startswith('flags:'):
-                flaglines.add(line)
-    for line in flaglines:
-        flags.update(line.split(':')[1].strip().split())
-
-    return 'svm' in flags or 'vmx' in flags, "cpu flags"
-
-
-async def wait_kms(shared_state: SynchronizedObject) -> bool:
-    count = 1000 * shared_state.vm_timeout_multiplier
-    while count > 0:
-        if not shared_state.qemu_serial_buffer or b'Detecting Android-x86...' not in shared_state.qemu_serial_buffer:
-            await asyncio.sleep(0.5)
-        else:
-            return True
-        count -= 1
-    return False
+F = TypeVar('F', bound=Callable[..., Any])
 
 
-async def wait_shell_prompt(shared_state: SynchronizedObject) -> bool:
-    # Send an additional new line to ensure the prompt shows
-    shared_state.qemu_serial_writer.write(b'\n')
-    await shared_state.qemu_serial_writer.drain()
+def traced(name: str) -> Callable[[F], F]:
+    # Wraps a coroutine that takes the shared state somewhere in its arguments in a tracing span
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            shared_state = next(a for a in (*args, *kwargs.values()) if isinstance(a, SynchronizedObject))
+            with shared_state.tracer.span(name, 'wait'):
+                return await func(*args, **kwargs)
 
-    count = 200 * shared_state.vm_timeout_multiplier
-    while count > 0:
-        # Give it an encouragement push every ten times in case it's shy
-        if count % 10 == 0:
-            shared_state.qemu_serial_writer.write(b'\n')
-            await shared_state.qemu_serial_writer.drain()
-        # Check the last few bytes for a shell prompt
-        if len(shared_state.qemu_serial_buffer) < 15 or b":/ # " not in shared_state.qemu_serial_buffer[:-15]:
-            await asyncio.sleep(0.5)
-        else:
-            return True
-        count -= 1
-    return False
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def step_timeout(shared_state: SynchronizedObject, step: str, default: float) -> float:
+    # Deadline for a step, from its history when there's enough of it. default is meant for a KVM host.
+    if shared_state.timeouts:
+        return shared_state.timeouts.deadline(step, default)
+    return default * shared_state.vm_timeout_multiplier
+
+
+def default_cache_dir() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'qemu_android_test_orchestrator')
+
+
+SHELL_PROMPT = b":/ # "
+
+ansi_escape = re.compile(br'(?:\x1B[@-Z\\-_]|[\x80-\x9A\x9C-\x9F]|(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-~])')
+
+
+@traced('wait KMS')
+async def wait_kms(shared_state: SynchronizedObject, timeout: float = 500) -> bool:
+    deadline = asyncio.get_event_loop().time() + timeout * shared_state.vm_timeout_multiplier
+    # The serial console may not be connected yet
+    while not shared_state.qemu_serial_expect:
+        if asyncio.get_event_loop().time() >= deadline:
+            return False
+        await asyncio.sleep(0.5)
+    remaining = deadline - asyncio.get_event_loop().time()
+    match = await shared_state.qemu_serial_expect.wait_for(b'Detecting Android-x86...', remaining, offset=0)
+    return match is not None
 
 
-async def run_and_expect(command: bytes, expect: bytes, within: int, shared_state: SynchronizedObject) -> bool:
+@traced('wait shell prompt')
+async def wait_shell_prompt(shared_state: SynchronizedObject, timeout: float = 100) -> bool:
+    expect = shared_state.qemu_serial_expect
+    offset = expect.buffer.end_offset
+    prompt = expect.expect(SHELL_PROMPT, offset)
+    deadline = asyncio.get_event_loop().time() + timeout * shared_state.vm_timeout_multiplier
+
+    try:
+        while True:
+            # Send a new line to ensure the prompt shows, and an encouragement push every few seconds in case it's shy
+            shared_state.qemu_serial_writer.write(b'\n')
+            await shared_state.qemu_serial_writer.drain()
+            remaining = deadline - asyncio.get_event_loop().time()
+            if remaining <= 0:
+                return False
+            done, _ = await asyncio.wait((prompt,), timeout=min(5.0, remaining))
+            if done:
+                prompt.result()
+                return True
+    finally:
+        prompt.cancel()
+
+
+@traced('run and expect')
+async def run_and_expect(command: bytes, expect: bytes, within: int, shared_state: SynchronizedObject,
+                         timeout: float = 300, retry_interval: float = 5) -> bool:
+    # Keep re-running the command until its output contains the expected string. within is the maximum distance
+    # between the command being sent and the expected output.
+    engine = shared_state.qemu_serial_expect
+    deadline = asyncio.get_event_loop().time() + timeout * shared_state.vm_timeout_multiplier
     while True:
+        offset = engine.buffer.end_offset
         shared_state.qemu_serial_writer.write(command)
         await shared_state.qemu_serial_writer.drain()
-        await asyncio.sleep(5)
-        if expect in shared_state.qemu_serial_buffer[-within:]:
+        remaining = deadline - asyncio.get_event_loop().time()
+        match = await engine.wait_for(expect, max(0.0, min(retry_interval, remaining)), offset)
+        if match is not None and match.end - offset <= within + len(command):
             return True
+        if deadline <= asyncio.get_event_loop().time():
+            return False
 
 
+@traced('run and not expect')
 async def run_and_not_expect(command: bytes, not_expect: bytes, within: int, shared_state: SynchronizedObject,
-                             test_times=5) -> bool:
+                             test_times=5, timeout: float = 600, probe_interval: float = 1) -> bool:
+    # Returns True once not_expect has been absent from the command output for test_times consecutive probes. Each probe
+    # ends as soon as the shell prompt comes back after the command.
+    engine = shared_state.qemu_serial_expect
+    deadline = asyncio.get_event_loop().time() + timeout * shared_state.vm_timeout_multiplier
     not_occurrences = 0
     while True:
+        offset = engine.buffer.end_offset
         shared_state.qemu_serial_writer.write(command)
         await shared_state.qemu_serial_writer.drain()
-        await asyncio.sleep(3)
-        if not_expect not in shared_state.qemu_serial_buffer[-within:]:
+        remaining = deadline - asyncio.get_event_loop().time()
+        if remaining <= 0:
+            return False
+        prompt = await engine.wait_for(SHELL_PROMPT, min(remaining, 30 * shared_state.vm_timeout_multiplier),
+                                       offset + len(command))
+        if prompt is None:
+            # No prompt means we can't tell, just try again
+            continue
+        output = engine.buffer.since(offset)[:prompt.end - offset][-within - len(SHELL_PROMPT):]
+        if not_expect not in output:
             not_occurrences += 1
         else:
             not_occurrences = 0
         if not_occurrences >= test_times:
             return True
+        await asyncio.sleep(probe_interval)
 
 
-async def wait_shell_available(shared_state: SynchronizedObject) -> None:
-    count = 0
-    n1, n2 = 0, 0
+@traced('wait shell available')
+async def wait_shell_available(shared_state: SynchronizedObject, timeout: float = 300) -> None:
+    engine = shared_state.qemu_serial_expect
+    deadline = asyncio.get_event_loop().time() + timeout * shared_state.vm_timeout_multiplier
     while True:
-        # Resend challenge every 10 attempts
-        if count % 10 == 0:
-            n1 = random.randint(0, 0x07FFFFFF)
-            n2 = random.randint(0, 0x07FFFFFF)
+        # The answer isn't part of the challenge, so the echoed command line can't match it
+        n1 = random.randint(0, 0x07FFFFFF)
+        n2 = random.randint(0, 0x07FFFFFF)
+        offset = engine.buffer.end_offset
+        answer = engine.expect(str(n1 + n2).encode(), offset)
+        try:
             shared_state.qemu_serial_writer.write(f'let "n = {n1} + {n2}"; echo $n'.encode())
             await shared_state.qemu_serial_writer.drain()
             await wait_shell_prompt(shared_state)
-        if str(n1 + n2).encode() in shared_state.qemu_serial_buffer[-200:]:
-            return
-        count += 1
-        await asyncio.sleep(2)
-
-
+            remaining = deadline - asyncio.get_event_loop().time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError("Timeout waiting for the shell to become available")
+            # Resend challenge every 20 seconds
+            done, _ = await asyncio.wait((answer,), timeout=min(20.0, remaining))
+            if done:
+                answer.result()
+                return
+        finally:
+            answer.cancel()
+
+
+@traced('wait package manager')
 async def detect_package_manager(shared_state: SynchronizedObject) -> bool:
     return await run_and_expect(b'pm list packages | grep "package.com" | tail -n 5\n', b'package:com', 200,
                                 shared_state)
@@ -119,50 +169,14 @@ async def wait_exists(file: str):
         await asyncio.sleep(1)
 
 
-async def keypress(shared_state: SynchronizedObject, key: str) -> None:
-    monitor = shared_state.qemu_monitor_writer
-    assert monitor
-    monitor.write(f'sendkey {key}\n'.encode(errors='replace'))
-    await monitor.drain()
-    await asyncio.sleep(2)
-
-
-def balloon_stat() -> None:
-    # noinspection PyBroadException
-    try:
-        with open("/proc/vmstat") as f:
-            vmstat = f.read()
-        if "balloon" not in vmstat:
-            return
-        with open("/proc/meminfo") as f:
-            meminfo = f.read()
-
-        # Calculate balloon inflation
-        balloon_infl = int(
-            filter(lambda line: line.startswith("balloon_inflate"), vmstat.splitlines()).__next__().split()[1].strip())
-        balloon_defl = int(
-            filter(lambda line: line.startswith("balloon_deflate"), vmstat.splitlines()).__next__().split()[1].strip())
-
-        balloon_pages = balloon_infl - balloon_defl
-
-        if balloon_pages == 0:
-            print("Memory balloon is not inflated")
-            return
-
-        # Calculate approx page size
-        mapped_kb_str = filter(lambda line: line.startswith("Mapped:"), meminfo.splitlines()).__next__()
-        mapped_bytes = int(mapped_kb_str.split(":")[1].replace("kB", "").strip()) * 1024
-
-        nr_mapped = int(
-            filter(lambda line: line.startswith("nr_mapped"), vmstat.splitlines()).__next__().split()[1].strip())
-        pagesize = int(round(mapped_bytes / nr_mapped, 0))
-
-        balloon_mbytes = round(balloon_pages * pagesize / 1024 ** 2, 1)
-
-        print(f"Memory balloon inflated to {balloon_pages} pages (approx {balloon_mbytes}MB)")
-
-    except Exception:
-        return
+@traced('keypress')
+async def keypress(shared_state: SynchronizedObject, *keys: str, settle: float = 2) -> None:
+    # Presses the keys one after the other. settle gives the UI time to react once they're all sent, callers that can
+    # probe for the outcome instead should pass 0.
+    assert shared_state.qmp
+    await shared_state.qmp.send_keys(*keys)
+    if settle:
+        await asyncio.sleep(settle)
 
 
 class Color:
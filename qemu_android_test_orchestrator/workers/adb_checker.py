@@ -1,53 +1,77 @@
 import asyncio
 import warnings
 
+from qemu_android_test_orchestrator import milestones
+from qemu_android_test_orchestrator.adb import AdbError
 from qemu_android_test_orchestrator.fsm import WorkerFSM, State, TransitionResult
+from qemu_android_test_orchestrator.utils import step_timeout
 
 
 class AdbConnectionChecker(WorkerFSM):
+    # adbd comes up early during boot, no need to wait for the rest of it or for the network
+    requires = {
+        State.QEMU_UP: (),
+        State.NETWORK_UP: (),
+        State.ADB_UP: (milestones.QEMU_RUNNING,),
+    }
+    provides = {
+        State.ADB_UP: (milestones.ADB_ONLINE, milestones.ADB_READY),
+    }
+
     @property
     def name(self) -> str:
         return 'ADB connection checker'
 
+    async def register_emulator(self) -> None:
+        # adb only scans for emulators when the server starts. Rather than restarting the server, which would disrupt
+        # any other VM it's talking to, tell it where to find ours, the same way the Android emulator does.
+        try:
+            await self.shared_state.adb.register_emulator(self.shared_state.config['adb_port'] - 1)
+        except OSError:
+            pass
+
     async def ensure_adb(self) -> None:
-        count = 0
+        serial = self.shared_state.config['adb_serial']
         while True:
-            proc = await asyncio.create_subprocess_exec('adb', 'devices', stdout=asyncio.subprocess.PIPE,
-                                                        stderr=asyncio.subprocess.DEVNULL)
-            assert proc.stdout
-
-            while True:
-                line = await proc.stdout.readline()
-                if not line:
-                    break
-                if line.strip().startswith(b'emulator-') and not line.strip().endswith(b"offline"):
-                    return
-
-            # Restart adb every 3 attempts
-            if count % 3 == 2:
-                proc = await asyncio.create_subprocess_exec('adb', 'kill-server')
-                await proc.wait()
-
-            await asyncio.sleep(0.5 * self.shared_state.vm_timeout_multiplier)
-            count += 1
-
-    async def run_oneshot(self, *cmd):
-        proc = await asyncio.create_subprocess_exec(*cmd)
-        await proc.wait()
+            await self.register_emulator()
+            # The server tells us as soon as the device comes online. adbd may not be listening yet when we register
+            # it though, in which case the server gives up on it, so register it again every now and then.
+            try:
+                await self.shared_state.adb.wait_for_device(serial, timeout=5 * self.shared_state.vm_timeout_multiplier)
+                return
+            except asyncio.TimeoutError:
+                pass
+            except (OSError, asyncio.IncompleteReadError, AdbError):
+                # The server went away, possibly killed by someone else
+                await asyncio.sleep(0.5 * self.shared_state.vm_timeout_multiplier)
 
     async def kill_package_verifier(self):
+        settings = (
+            ('secure', 'user_setup_complete', '1'),
+            ('global', 'package_verifier_enable', '0'),
+            ('secure', 'package_verifier_enable', '0'),
+            ('system', 'package_verifier_enable', '0'),
+        )
+        command = '; '.join(f'settings put {namespace} {key} {value}' for namespace, key, value in settings)
         try:
-            await self.run_oneshot('adb', 'shell', 'settings', 'put', 'secure', 'user_setup_complete', '1')
-            await self.run_oneshot('adb', 'shell', 'settings', 'put', 'global', 'package_verifier_enable', '0')
-            await self.run_oneshot('adb', 'shell', 'settings', 'put', 'secure', 'package_verifier_enable', '0')
-            await self.run_oneshot('adb', 'shell', 'settings', 'put', 'system', 'package_verifier_enable', '0')
+            await self.shared_state.adb.shell(self.shared_state.config['adb_serial'], 'sh', '-c', command)
         except Exception:
             warnings.warn('Unable to kill Google package verifier, app installation may be blocked later on')
 
     async def enter_state(self, state: State) -> TransitionResult:
         if state == State.ADB_UP:
-            await asyncio.wait_for(self.ensure_adb(), 1200 * self.shared_state.vm_timeout_multiplier)
-            await asyncio.wait_for(self.kill_package_verifier(), 120 * self.shared_state.vm_timeout_multiplier)
+            tracer = self.shared_state.tracer
+            with tracer.span('ADB handshake'):
+                await asyncio.wait_for(self.ensure_adb(), step_timeout(self.shared_state, 'ADB handshake', 1200))
+            self.reach(milestones.ADB_ONLINE)
+            # Settings survive in the snapshot, only the connection needs to be checked again
+            if not self.shared_state.snapshot_restored:
+                # Settings can only be changed once the system services are up
+                await self.shared_state.milestones.wait(milestones.PACKAGE_MANAGER_UP)
+                with tracer.span('kill package verifier'):
+                    await asyncio.wait_for(self.kill_package_verifier(),
+                                           step_timeout(self.shared_state, 'kill package verifier', 120))
+            self.reach(milestones.ADB_READY)
             return TransitionResult.DONE
         return TransitionResult.NOOP
 
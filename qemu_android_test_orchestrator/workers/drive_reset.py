@@ -0,0 +1,63 @@
+import asyncio
+from typing import Optional
+
+from qemu_android_test_orchestrator.fsm import WorkerFSM, State, TransitionResult
+from qemu_android_test_orchestrator.images import ImageError
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.utils import Color
+
+
+class DriveResetServer(WorkerFSM):
+    # Lets tests ask for a pristine copy of a drive, e.g. a blank USB stick before each test, without rebooting. It
+    # listens on the host's loopback so tests can reach it from the guest too, at QEMU's gateway address:
+    #   -> reset usbstick
+    #   <- ok 0.042
+    ensure_coro = None
+
+    @property
+    def name(self) -> str:
+        return 'Drive reset server'
+
+    def __init__(self, shared_state: SynchronizedObject) -> None:
+        super().__init__(shared_state)
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command, _, drive_id = line.decode(errors='replace').strip().partition(' ')
+                if command != 'reset' or not drive_id:
+                    writer.write(b'error usage: reset <drive id>\n')
+                    await writer.drain()
+                    continue
+                try:
+                    with self.shared_state.tracer.span(f'reset drive {drive_id}'):
+                        elapsed = await self.shared_state.disk_images.reset(self.shared_state, drive_id)
+                except ImageError as e:
+                    print(Color.RED + f"Unable to reset drive {drive_id}: {e}" + Color.RESET)
+                    writer.write(f'error {e}\n'.encode())
+                else:
+                    print(Color.CYAN + f"Drive {drive_id} reset in {elapsed * 1000:.0f}ms" + Color.RESET)
+                    writer.write(f'ok {elapsed:.3f}\n'.encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def enter_state(self, state: State) -> TransitionResult:
+        if state == State.ADB_UP:
+            port = self.shared_state.config['image_reset_port']
+            self.server = await asyncio.start_server(self.handle_client, '127.0.0.1', port)
+            print(Color.GREEN + f"Accepting drive resets on port {port}" + Color.RESET)
+            return TransitionResult.DONE
+        elif state == State.STOP and self.server:
+            self.server.close()
+            return TransitionResult.DONE
+        return TransitionResult.NOOP
+
+    async def exit_state(self, state: State) -> TransitionResult:
+        return TransitionResult.NOOP
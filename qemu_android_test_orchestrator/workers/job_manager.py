@@ -1,7 +1,10 @@
 import asyncio
+import os
 from subprocess import CalledProcessError
 
 from qemu_android_test_orchestrator.fsm import WorkerFSM, State, TransitionResult
+from qemu_android_test_orchestrator.prepare import JobPreparation
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
 
 
 class JobManager(WorkerFSM):
@@ -9,25 +12,74 @@ class JobManager(WorkerFSM):
     def name(self) -> str:
         return 'Job manager'
 
+    def __init__(self, shared_state: SynchronizedObject) -> None:
+        super().__init__(shared_state)
+        self.preparation = shared_state.job_preparation
+        # Without a shared one (e.g. in daemon mode) each VM runs its own
+        self.owns_preparation = False
+        if not self.preparation and shared_state.config['job_prepare_command']:
+            self.preparation = JobPreparation(shared_state.config)
+            self.owns_preparation = True
+
     async def run_job(self) -> None:
         assert self.shared_state.config
+        # Gradle and adb only talk to our VM even if more are running
+        env = dict(os.environ, ANDROID_SERIAL=self.shared_state.config['adb_serial'])
+        if self.shared_state.disk_images and self.shared_state.config['image_reset_port']:
+            env['ORCHESTRATOR_DRIVE_RESET_PORT'] = str(self.shared_state.config['image_reset_port'])
         self.shared_state.job_proc = await asyncio.create_subprocess_shell(
-            self.shared_state.config['job_command'], cwd=self.shared_state.config['job_workdir']
+            self.shared_state.config['job_command'], cwd=self.shared_state.config['job_workdir'], env=env
         )
         await self.shared_state.job_proc.wait()
         if self.shared_state.job_proc.returncode != 0:
             raise CalledProcessError(self.shared_state.job_proc.returncode, self.shared_state.config['job_command'])
 
+    async def install_apks(self) -> None:
+        config = self.shared_state.config
+        for apk in config['job_install_apks']:
+            path = os.path.join(config['job_workdir'] or '.', apk)
+            await self.shared_state.adb.install(config['adb_serial'], path, '-r', '-t')
+
+    async def run_shards(self) -> None:
+        coordinator = self.shared_state.shard_coordinator
+        assert coordinator
+        with self.shared_state.tracer.span('install APKs'):
+            await self.install_apks()
+        with self.shared_state.tracer.span('test shards'):
+            ok = await coordinator.work(self.shared_state.config['adb_serial'])
+        if not ok:
+            raise RuntimeError("Some test shards failed on this device")
+
     async def enter_state(self, state: State) -> TransitionResult:
-        if state == State.JOB:
-            await self.run_job()
+        if state == State.QEMU_UP and self.preparation:
+            # Build while the VM boots, it's mostly waiting anyway
+            self.preparation.start()
+            return TransitionResult.DONE
+        elif state == State.JOB:
+            if self.preparation:
+                with self.shared_state.tracer.span('wait for prepare command'):
+                    try:
+                        await self.preparation.wait()
+                    except CalledProcessError as e:
+                        # There's no job to take the exit code from, a broken build must not end up as a success
+                        self.shared_state.prepare_returncode = e.returncode
+                        raise
+            if self.shared_state.shard_coordinator:
+                await self.run_shards()
+            else:
+                await self.run_job()
             return TransitionResult.DONE
-        elif state == State.STOP and self.shared_state.job_proc:
-            try:
-                self.shared_state.job_proc.kill()
-                return TransitionResult.DONE
-            except ProcessLookupError:
-                pass
+        elif state == State.STOP:
+            ret = TransitionResult.NOOP
+            if self.owns_preparation:
+                await self.preparation.stop()
+            if self.shared_state.job_proc:
+                try:
+                    self.shared_state.job_proc.kill()
+                    ret = TransitionResult.DONE
+                except ProcessLookupError:
+                    pass
+            return ret
         return TransitionResult.NOOP
 
     async def exit_state(self, state: State) -> TransitionResult:
@@ -1,38 +1,126 @@
 import asyncio
-import subprocess
+import os
+import time
+from typing import List, Optional, Awaitable
 
 from qemu_android_test_orchestrator.fsm import WorkerFSM, State, TransitionResult
+from qemu_android_test_orchestrator.logsink import LogSink
 from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.utils import Color
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class Artifact:
+    def __init__(self, name: str, path: str) -> None:
+        self.name = name
+        self.path = path
+        # 'ok', 'timeout', 'truncated' or 'failed'. Anything but 'failed' may still have left a partial file behind.
+        self.status = 'running'
+        self.size = 0
+        self.elapsed = 0.0
+        self.error: Optional[str] = None
 
 
 class LogCollector(WorkerFSM):
+    # Collects the post-mortem artifacts concurrently, each with its own timeout and size budget, so the LOGCAT state
+    # only lasts as long as the slowest of them
+
     @property
     def name(self) -> str:
         return 'Log collector'
 
     def __init__(self, shared_state: SynchronizedObject) -> None:
         super().__init__(shared_state)
-        self.processes = []
-        self.files = []
+        self.artifacts: List[Artifact] = []
 
-    @staticmethod
-    def run_and_log(outfile: str, *command: str):
-        with open(outfile, "w") as f:
-            p = subprocess.Popen(command, stdout=f, stderr=subprocess.STDOUT)
-            p.wait()
+    async def stream_to_file(self, artifact: Artifact, *command: str) -> None:
+        config = self.shared_state.config
+        budget = config['artifact_max_size']
+        sink = LogSink(artifact.path, config['artifact_compression'])
+        artifact.path = sink.path
+        reader, writer = await self.shared_state.adb.open_shell(config['adb_serial'], *command)
+        try:
+            while True:
+                chunk = await reader.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if budget and artifact.size + len(chunk) > budget:
+                    sink.write(chunk[:budget - artifact.size])
+                    sink.write(b'\n[truncated: size budget exceeded]\n')
+                    artifact.size = budget
+                    artifact.status = 'truncated'
+                    return
+                sink.write(chunk)
+                artifact.size += len(chunk)
+        finally:
+            writer.close()
+            await sink.close()
+
+    async def bugreport(self, artifact: Artifact) -> None:
+        # Bugreports are zipped on the device and pulled by the adb client, not worth reimplementing
+        proc = await asyncio.create_subprocess_exec('adb', '-s', self.shared_state.config['adb_serial'], 'bugreport',
+                                                    artifact.path, stdout=asyncio.subprocess.DEVNULL)
+        try:
+            await proc.wait()
+        finally:
+            if proc.returncode is None:
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+        if proc.returncode != 0:
+            raise RuntimeError(f"adb bugreport exited with code {proc.returncode}")
+        artifact.size = os.path.getsize(artifact.path) if os.path.exists(artifact.path) else 0
+        budget = self.shared_state.config['artifact_max_size']
+        if budget and artifact.size > budget:
+            # A truncated zip is useless, just keep it and complain
+            artifact.status = 'truncated'
+
+    async def collect(self, artifact: Artifact, collector: Awaitable[None]) -> None:
+        timeout = self.shared_state.config['artifact_timeouts'].get(artifact.name, 300)
+        start = time.monotonic()
+        try:
+            with self.shared_state.tracer.span(f'collect {artifact.name}'):
+                await asyncio.wait_for(collector, timeout * self.shared_state.vm_timeout_multiplier)
+            if artifact.status == 'running':
+                artifact.status = 'ok'
+        except asyncio.TimeoutError:
+            artifact.status = 'timeout'
+        except Exception as e:
+            artifact.status = 'failed'
+            artifact.error = str(e)
+        finally:
+            artifact.elapsed = time.monotonic() - start
 
     async def collect_logs(self) -> None:
         config = self.shared_state.config
         assert config
+        collectors = []
         if config['logcat_output']:
-            self.run_and_log(config['logcat_output'], 'adb', 'logcat', '-d')
+            artifact = Artifact('logcat', config['logcat_output'])
+            collectors.append(self.collect(artifact, self.stream_to_file(artifact, 'logcat', '-d')))
+            self.artifacts.append(artifact)
         if config['dmesg_output']:
-            self.run_and_log(config['dmesg_output'], 'adb', 'shell', 'su', '-c', 'dmesg')
+            artifact = Artifact('dmesg', config['dmesg_output'])
+            collectors.append(self.collect(artifact, self.stream_to_file(artifact, 'su', '-c', 'dmesg')))
+            self.artifacts.append(artifact)
         if config['bugreport_output']:
-            proc = await asyncio.create_subprocess_exec('adb', 'bugreport', config['bugreport_output'])
-            await proc.wait()
+            artifact = Artifact('bugreport', config['bugreport_output'])
+            collectors.append(self.collect(artifact, self.bugreport(artifact)))
+            self.artifacts.append(artifact)
+
+        await asyncio.gather(*collectors)
+        self.report()
+
+    def report(self) -> None:
+        print(Color.CYAN + "Collected artifacts:" + Color.RESET)
+        for a in self.artifacts:
+            color = Color.GREEN if a.status == 'ok' else Color.RED
+            detail = f": {a.error}" if a.error else ""
+            print(color + f"  {a.name:<10} {a.status:<10} {a.size / 1024:10.1f} KiB {a.elapsed:7.1f}s  "
+                          f"{a.path}{detail}" + Color.RESET)
 
-    # noinspection PyBroadException
     async def enter_state(self, state: State) -> TransitionResult:
         if state == State.LOGCAT:
             await self.collect_logs()
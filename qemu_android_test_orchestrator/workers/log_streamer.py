@@ -0,0 +1,137 @@
+import asyncio
+import re
+from typing import List, Optional, Tuple, Callable
+
+from qemu_android_test_orchestrator import milestones
+from qemu_android_test_orchestrator.adb import AdbError
+from qemu_android_test_orchestrator.fsm import WorkerFSM, State, TransitionResult
+from qemu_android_test_orchestrator.logcat import Subscription, LogcatEntry
+from qemu_android_test_orchestrator.logsink import LogSink
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.utils import Color
+
+dmesg_timestamp = re.compile(rb'^(?:<\d+>)?\[\s*(\d+\.\d+)\]')
+
+
+class LogStreamer(WorkerFSM):
+    # Follows logcat and dmesg from the moment ADB is up until the job is over, so nothing gets lost when the device's
+    # ring buffers wrap around during long test runs. Lines go to the compressed stream files and/or the log store.
+
+    requires = {
+        State.QEMU_UP: (),
+        State.NETWORK_UP: (),
+        State.ADB_UP: (milestones.ADB_READY,),
+    }
+
+    @property
+    def name(self) -> str:
+        return 'Log streamer'
+
+    def __init__(self, shared_state: SynchronizedObject) -> None:
+        super().__init__(shared_state)
+        self.stopping = False
+        self.tasks: List[asyncio.Task] = []
+        self.sinks: List[LogSink] = []
+        self.logcat: Optional[Subscription] = None
+        self.logcat_sink: Optional[LogSink] = None
+        # Where to resume from after a reconnection
+        self.dmesg_last = -1.0
+
+    def make_sink(self, path: str) -> LogSink:
+        config = self.shared_state.config
+        sink = LogSink(path, config['log_compression'], config['log_rotate_size'], config['log_rotate_keep'])
+        self.sinks.append(sink)
+        return sink
+
+    def accept_dmesg(self, line: bytes) -> bool:
+        # dmesg -w starts over from the beginning of the kernel log every time
+        match = dmesg_timestamp.match(line)
+        if not match:
+            return True
+        timestamp = float(match.group(1))
+        if timestamp <= self.dmesg_last:
+            return False
+        self.dmesg_last = timestamp
+        return True
+
+    async def follow(self, what: str, sink: Optional[LogSink], command: Callable[[], Tuple[str, ...]],
+                     accept: Callable[[bytes], bool]) -> None:
+        store = self.shared_state.log_store
+        adb = self.shared_state.adb
+        serial = self.shared_state.config['adb_serial']
+        while not self.stopping:
+            try:
+                reader, writer = await adb.open_shell(serial, *command())
+            except (OSError, asyncio.IncompleteReadError, AdbError):
+                await asyncio.sleep(1)
+                continue
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    if not accept(line):
+                        continue
+                    if sink:
+                        sink.write(line)
+                    if store:
+                        store.append(what, dmesg_timestamp.sub(b'', line).lstrip())
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                writer.close()
+            # Gradle likes to kill the ADB server
+            if not self.stopping:
+                print(Color.YELLOW + f"{what} stream interrupted, reconnecting" + Color.RESET)
+                await asyncio.sleep(1)
+
+    def write_logcat(self, entry: LogcatEntry) -> None:
+        if self.logcat_sink:
+            self.logcat_sink.write(entry.raw)
+        if self.shared_state.log_store:
+            self.shared_state.log_store.append('logcat', entry.message, entry.priority, entry.pid, entry.tag)
+
+    async def follow_logcat(self) -> None:
+        assert self.logcat
+        async for entry in self.logcat:
+            self.write_logcat(entry)
+
+    async def start(self) -> None:
+        config = self.shared_state.config
+        await self.shared_state.adb_ready.wait()
+        if config['logcat_stream_output'] or config['log_store_output']:
+            # The shared logcat reader takes care of reconnecting
+            self.logcat = self.shared_state.logcat.subscribe()
+            if config['logcat_stream_output']:
+                self.logcat_sink = self.make_sink(config['logcat_stream_output'])
+            self.tasks.append(asyncio.create_task(self.follow_logcat()))
+        if config['dmesg_stream_output'] or config['log_store_output']:
+            sink = self.make_sink(config['dmesg_stream_output']) if config['dmesg_stream_output'] else None
+            self.tasks.append(asyncio.create_task(self.follow('dmesg', sink, lambda: ('su', '-c', 'dmesg -w'),
+                                                              self.accept_dmesg)))
+
+    async def stop(self) -> bool:
+        if self.stopping:
+            return False
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.logcat:
+            self.logcat.close()
+            # Flush whatever was still queued up
+            while not self.logcat.queue.empty():
+                self.write_logcat(self.logcat.queue.get_nowait())
+        await asyncio.gather(*(sink.close() for sink in self.sinks))
+        return bool(self.tasks)
+
+    async def enter_state(self, state: State) -> TransitionResult:
+        if state == State.ADB_UP:
+            await asyncio.wait_for(self.start(), 1200 * self.shared_state.vm_timeout_multiplier)
+            return TransitionResult.DONE
+        elif state in (State.LOGCAT, State.STOP):
+            return TransitionResult.DONE if await self.stop() else TransitionResult.NOOP
+        return TransitionResult.NOOP
+
+    async def exit_state(self, state: State) -> TransitionResult:
+        return TransitionResult.NOOP
@@ -1,6 +1,10 @@
 import asyncio
+from typing import Optional
 
+from qemu_android_test_orchestrator import ui
 from qemu_android_test_orchestrator.fsm import WorkerFSM, State, TransitionResult
+from qemu_android_test_orchestrator.logcat import Subscription
+from qemu_android_test_orchestrator.probes import wait_until, activity_focused
 from qemu_android_test_orchestrator.shared_state import SynchronizedObject
 from qemu_android_test_orchestrator.utils import keypress, Color
 
@@ -15,48 +19,63 @@ class PermissionDialogChecker(WorkerFSM):
     def __init__(self, shared_state: SynchronizedObject) -> None:
         super().__init__(shared_state)
         self.should_stop = False
+        self.logcat: Optional[Subscription] = None
+        self.requests = 0
 
-    async def approve_permission(self) -> None:
-        # /me *shrugs*
-        assert self.shared_state.config
-        for key in self.shared_state.config['permission_approve_buttons']:
-            await keypress(self.shared_state, key)
+    async def dialog_focused(self) -> bool:
+        return await activity_focused(self.shared_state, self.shared_state.config['permission_dialog_window'],
+                                      ui.adb_shell)
 
-    async def ensure_perms_approved(self) -> None:
-        # Gradle likes to kill ADB. Wait a little, and restart if dead
-        await asyncio.sleep(5)
-        self.shared_state.adb_proc = await asyncio.create_subprocess_exec('adb', 'logcat',
-                                                                          stdout=asyncio.subprocess.PIPE,
-                                                                          stderr=asyncio.subprocess.STDOUT)
-        assert self.shared_state.adb_proc.stdout  # so that mypy is happy
-        while not self.should_stop and self.shared_state.job_proc.returncode is None:
-            line = None
-            try:
-                line = await asyncio.wait_for(self.shared_state.adb_proc.stdout.readline(), 1)
-            except asyncio.exceptions.TimeoutError:
-                pass
-
-            if self.shared_state.adb_proc.returncode is not None:
-                self.shared_state.adb_proc = await asyncio.create_subprocess_exec('adb', 'logcat',
-                                                                                  stdout=asyncio.subprocess.PIPE,
-                                                                                  stderr=asyncio.subprocess.STDOUT)
+    async def dialog_gone(self) -> bool:
+        return not await self.dialog_focused()
 
-            if not line:
-                continue
+    async def approve_permission(self) -> bool:
+        # Returns whether the dialog was there and went away after pressing its positive button
+        config = self.shared_state.config
+        if not await wait_until(self.shared_state, 'permission dialog shown', self.dialog_focused, timeout=30):
+            return False
+        node = await ui.find_node(self.shared_state, resource_id=config['permission_positive_button'])
+        center = ui.node_center(node) if node is not None else None
+        if center:
+            await ui.tap(self.shared_state, *center)
+        else:
+            # /me *shrugs*
+            print(Color.YELLOW + "Positive button not found in the permission dialog, pressing keys instead" +
+                  Color.RESET)
+            await keypress(self.shared_state, *config['permission_approve_buttons'], settle=0)
+        return await wait_until(self.shared_state, 'permission dialog dismissed', self.dialog_gone, timeout=10)
 
-            if b'USB-PERMISSION' in line:
-                if b'USB-PERMISSION-REQUESTED' in line:
-                    print(Color.GREEN + "Permission request detected, granting in 5 seconds...")
-                    await asyncio.sleep(5)
-                    await self.approve_permission()
-                # Approve perms only once
-                try:
-                    self.shared_state.adb_proc.kill()
-                except ProcessLookupError:
-                    pass
-                return
+    def job_running(self) -> bool:
+        # There's no job process when running test shards
+        coordinator = self.shared_state.shard_coordinator
+        if coordinator:
+            return not coordinator.all_done.is_set()
+        job_proc = self.shared_state.job_proc
+        return job_proc is None or job_proc.returncode is None
 
-        await self.shared_state.adb_proc.wait()
+    async def ensure_perms_approved(self) -> None:
+        # Keeps going for the whole job, tests may ask for the permission more than once
+        self.logcat = self.shared_state.logcat.subscribe(b'USB-PERMISSION')
+        try:
+            while not self.should_stop and self.job_running():
+                entry = await self.logcat.get(timeout=1)
+                if not entry:
+                    continue
+                if b'USB-PERMISSION-REQUESTED' in entry.raw:
+                    self.requests += 1
+                    print(Color.GREEN + f"Permission request {self.requests} detected, approving" + Color.RESET)
+                    with self.shared_state.tracer.span('approve permission'):
+                        approved = await self.approve_permission()
+                    if not approved:
+                        print(Color.RED + f"Warning: unable to approve permission request {self.requests}" +
+                              Color.RESET)
+                elif b'USB-PERMISSION-GRANTED' in entry.raw:
+                    print(Color.GREEN + "Permission granted" + Color.RESET)
+                elif b'USB-PERMISSION-DENIED' in entry.raw:
+                    print(Color.RED + "Warning: permission denied" + Color.RESET)
+        finally:
+            self.logcat.close()
+            self.logcat = None
 
     async def enter_state(self, state: State) -> TransitionResult:
         if state == State.JOB:
@@ -67,12 +86,6 @@ class PermissionDialogChecker(WorkerFSM):
         elif state in (State.LOGCAT, State.STOP):
             ret = TransitionResult.NOOP
             self.should_stop = True
-            if self.shared_state.adb_proc and self.shared_state.adb_proc.returncode is None:
-                try:
-                    self.shared_state.adb_proc.kill()
-                    ret = TransitionResult.DONE
-                except ProcessLookupError:
-                    pass
             if self.ensure_coro:
                 self.ensure_coro.cancel()
                 ret = TransitionResult.DONE
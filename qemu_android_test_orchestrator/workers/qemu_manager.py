@@ -1,28 +1,87 @@
 import asyncio
+import os
 import re
+from typing import List, Optional
 
+from qemu_android_test_orchestrator import milestones
+from qemu_android_test_orchestrator.config import format_qemu_args
+from qemu_android_test_orchestrator.console import ConsoleBuffer
+from qemu_android_test_orchestrator.debuglog import ConsoleDebugLog
+from qemu_android_test_orchestrator.expect import ExpectEngine
 from qemu_android_test_orchestrator.fsm import WorkerFSM, State, TransitionResult
-from qemu_android_test_orchestrator.utils import kvm_available, Color, wait_shell_prompt, run_and_not_expect, \
-    wait_exists, detect_package_manager, wait_shell_available
+from qemu_android_test_orchestrator.host import QemuTuning, kvm_available
+from qemu_android_test_orchestrator.images import DiskImages
+from qemu_android_test_orchestrator.provision import ProvisionCache
+from qemu_android_test_orchestrator.qmp import QmpClient, QmpError, QemuGone, watch_events
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+from qemu_android_test_orchestrator.snapshot import SnapshotStore
+from qemu_android_test_orchestrator.probes import wait_zygote, wait_boot_animation, wait_boot_completed, run_shell
+from qemu_android_test_orchestrator.utils import Color, wait_shell_prompt, run_and_not_expect, \
+    wait_exists, detect_package_manager, wait_shell_available, ansi_escape, step_timeout
 
-ansi_escape = re.compile(br'(?:\x1B[@-Z\\-_]|[\x80-\x9A\x9C-\x9F]|(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-~])')
+READ_CHUNK_SIZE = 64 * 1024
 
 
 class QemuSystemManager(WorkerFSM):
+    requires = {
+        State.QEMU_UP: (),
+        State.NETWORK_UP: (),
+        # Snapshots and provisioned images are saved with the network set up
+        State.ADB_UP: (milestones.NETWORK_UP,),
+    }
+    provides = {
+        State.QEMU_UP: (milestones.QEMU_RUNNING, milestones.SHELL_READY, milestones.PACKAGE_MANAGER_UP,
+                        milestones.SYSTEM_READY),
+    }
+
     @property
     def name(self) -> str:
         return 'QEMU manager'
 
-    async def qemu_log_reader(self, log_tag: str, reader: asyncio.StreamReader, bufname: str):
+    def __init__(self, shared_state: SynchronizedObject) -> None:
+        super().__init__(shared_state)
+        assert shared_state.config
+        self.tuning: Optional[QemuTuning] = None
+        if shared_state.config['qemu_tune']:
+            # The machine is sized first since the snapshot and provision keys depend on qemu_args
+            self.tuning = QemuTuning(shared_state.config)
+            shared_state.config['qemu_args'] = self.tuning.tune_machine(shared_state.config['qemu_args'])
+        self.snapshots: Optional[SnapshotStore] = SnapshotStore(shared_state.config) \
+            if shared_state.config['snapshot'] else None
+        self.images: Optional[DiskImages] = None
+        if shared_state.config['image_overlays']:
+            self.images = DiskImages(shared_state.config)
+            shared_state.disk_images = self.images
+        self.provision: Optional[ProvisionCache] = None
+        if shared_state.config['provision']:
+            if self.snapshots:
+                # A restored snapshot expects the disks to be exactly as they were when it was taken
+                print(Color.YELLOW + "Provisioned images can't be used together with snapshots, ignoring them" +
+                      Color.RESET)
+            else:
+                self.provision = ProvisionCache(shared_state.config)
+
+    async def qemu_log_reader(self, log_tag: str, reader: asyncio.StreamReader, expect: ExpectEngine,
+                              store: bool = False):
+        buffer = expect.buffer
+        log_store = self.shared_state.log_store if store else None
+        partial = b''
         while not self.shared_state.qemu_sock_stopdebug:
-            try:
-                line = await asyncio.wait_for(reader.readline(), 1)
-            except asyncio.exceptions.TimeoutError:
-                continue
-            setattr(self.shared_state, bufname, getattr(self.shared_state, bufname) + line)
-            if self.shared_state.config['qemu_debug']:
-                print(Color.YELLOW + f"{log_tag}:" + Color.RESET, ansi_escape.sub(b'', line).decode(errors="replace"),
-                      end='')
+            chunk = await reader.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            buffer.write(chunk)
+            expect.feed()
+            if log_store:
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    log_store.append('serial', ansi_escape.sub(b'', line))
+            # Printing happens on another thread, the terminal can be a lot slower than the guest
+            if self.shared_state.qemu_debug_log:
+                self.shared_state.qemu_debug_log.write(log_tag, chunk)
+        # Wake up whoever is still waiting on this console
+        expect.close()
 
     async def run_oneshot(self, command: str):
         writer = self.shared_state.qemu_serial_writer
@@ -44,8 +103,7 @@ class QemuSystemManager(WorkerFSM):
     async def ensure_qemu(self) -> None:
         assert self.shared_state.config
 
-        qemu_debug = self.shared_state.config['qemu_debug']
-        qemu_args = list(self.shared_state.config['qemu_args'])
+        qemu_args = format_qemu_args(self.shared_state.config)
         kvm, decider = await kvm_available()
         if kvm:
             print(Color.GREEN + f"KVM is available (decider: {decider})" + Color.RESET)
@@ -60,42 +118,110 @@ class QemuSystemManager(WorkerFSM):
             if '-enable-kvm' not in qemu_args:
                 qemu_args.insert(0, '-enable-kvm')
         else:
-            # Make all timeouts 5 times longer
+            # Assume the guest is 5 times slower until it can be calibrated
             self.shared_state.vm_timeout_multiplier = 5
             if '-enable-kvm' in qemu_args:
                 qemu_args.remove('-enable-kvm')
 
-        if qemu_debug:
+        if self.images:
+            qemu_args = await self.images.qemu_args(qemu_args)
+
+        if self.snapshots and self.snapshots.exists():
+            with self.shared_state.tracer.span('snapshot restore'):
+                await self.launch_qemu(qemu_args + self.snapshots.incoming_args())
+                restored = await self.wait_restored()
+            if restored:
+                self.shared_state.snapshot_restored = True
+                print(Color.GREEN + f"Restored VM snapshot {self.snapshots.key}" + Color.RESET)
+                await wait_shell_prompt(self.shared_state)
+                await self.shared_state.timeouts.calibrate()
+                return
+            print(Color.RED + "Unable to restore VM snapshot, discarding it and cold booting" + Color.RESET)
+            await self.ensure_qemu_stopped()
+            self.snapshots.discard()
+
+        if self.provision:
+            await self.provision.prepare()
+            qemu_args = self.provision.qemu_args(qemu_args)
+            if self.provision.provisioning:
+                print(Color.GREEN + f"Provisioning a new image {self.provision.key}" + Color.RESET)
+            else:
+                self.shared_state.provisioned = True
+                print(Color.GREEN + f"Using provisioned image {self.provision.key}" + Color.RESET)
+
+        await self.launch_qemu(qemu_args)
+        await self.boot()
+
+    async def launch_qemu(self, qemu_args: List[str]) -> None:
+        affinity = None
+        if self.tuning:
+            # Drives are tuned last, once the provisioned image's drive is there too
+            qemu_args = self.tuning.tune_drives(qemu_args)
+            affinity = self.tuning.affinity
+            print(Color.GREEN + "QEMU tuning:" + Color.RESET)
+            self.tuning.print_reasons()
+        # QMP gets its own socket, the human monitor stays there for people and logs
+        qmp_socket = self.shared_state.config['qemu_qmp_socket']
+        if os.path.exists(qmp_socket):
+            os.unlink(qmp_socket)
+        qemu_args = qemu_args + ['-qmp', f"unix:{qmp_socket.replace(',', ',,')},server=on,wait=off"]
+        if self.shared_state.config['qemu_debug']:
             print(Color.YELLOW + "QEMU args:" + Color.RESET, " ".join(qemu_args))
 
         self.shared_state.qemu_proc = await asyncio.create_subprocess_exec(
             self.shared_state.config['qemu_bin'],
             *qemu_args,
-            cwd=self.shared_state.config['qemu_workdir']
+            cwd=self.shared_state.config['qemu_workdir'],
+            preexec_fn=(lambda: os.sched_setaffinity(0, affinity)) if affinity else None
         )
 
         # Create serial and monitor consoles socket handle pairs
         await asyncio.sleep(1)
         self.shared_state.qemu_sock_stopdebug = False
+        config = self.shared_state.config
+        if config['qemu_debug'] and not self.shared_state.qemu_debug_log:
+            self.shared_state.qemu_debug_log = ConsoleDebugLog(config['qemu_debug_log'], config['qemu_debug_rate'],
+                                                               config['qemu_debug_backlog'], config['qemu_debug_drop'])
 
         # Serial
-        await wait_exists("/tmp/qemu-android.sock")
-        reader, writer = await asyncio.open_unix_connection("/tmp/qemu-android.sock")
+        await wait_exists(config['qemu_serial_socket'])
+        reader, writer = await asyncio.open_unix_connection(config['qemu_serial_socket'])
         self.shared_state.qemu_serial_reader = reader
         self.shared_state.qemu_serial_writer = writer
-        self.shared_state.qemu_serial_buffer = b""
-        asyncio.create_task(self.qemu_log_reader('VM', reader, 'qemu_serial_buffer'))
+        self.shared_state.qemu_serial_buffer = ConsoleBuffer(config['console_buffer_size'], config['qemu_serial_log'])
+        self.shared_state.qemu_serial_expect = ExpectEngine(self.shared_state.qemu_serial_buffer)
+        asyncio.create_task(self.qemu_log_reader('VM', reader, self.shared_state.qemu_serial_expect, store=True))
         print(Color.GREEN + "Connected to QEMU serial socket" + Color.RESET)
 
         # Monitor
-        await wait_exists("/tmp/qemu-monitor.sock")
-        reader, writer = await asyncio.open_unix_connection("/tmp/qemu-monitor.sock")
+        await wait_exists(config['qemu_monitor_socket'])
+        reader, writer = await asyncio.open_unix_connection(config['qemu_monitor_socket'])
         self.shared_state.qemu_monitor_reader = reader
         self.shared_state.qemu_monitor_writer = writer
-        self.shared_state.qemu_monitor_buffer = b""
-        asyncio.create_task(self.qemu_log_reader('QEMU', reader, 'qemu_monitor_buffer'))
+        self.shared_state.qemu_monitor_buffer = ConsoleBuffer(config['console_buffer_size'], config['qemu_monitor_log'])
+        self.shared_state.qemu_monitor_expect = ExpectEngine(self.shared_state.qemu_monitor_buffer)
+        asyncio.create_task(self.qemu_log_reader('QEMU', reader, self.shared_state.qemu_monitor_expect))
         print(Color.GREEN + "Connected to QEMU monitor socket" + Color.RESET)
 
+        # QMP
+        await wait_exists(qmp_socket)
+        self.shared_state.qmp = await QmpClient.connect(qmp_socket)
+        asyncio.create_task(watch_events(self.shared_state.qmp, lambda: bool(self.shared_state.qemu_sock_stopdebug),
+                                         self.qemu_gone))
+        print(Color.GREEN + "Connected to QEMU QMP socket" + Color.RESET)
+        self.reach(milestones.QEMU_RUNNING)
+
+    def qemu_gone(self, reason: str) -> None:
+        # The job can't get anywhere without the VM, don't wait for it to find out on its own
+        job_proc = self.shared_state.job_proc
+        if job_proc and job_proc.returncode is None:
+            print(Color.RED + f"Stopping the job: {reason}" + Color.RESET)
+            try:
+                job_proc.kill()
+            except ProcessLookupError:
+                pass
+
+    async def boot(self) -> None:
         # Wait for a root shell to show up over serial
         found = await wait_shell_prompt(self.shared_state)
         if not found:
@@ -105,48 +231,136 @@ class QemuSystemManager(WorkerFSM):
         await self.run_oneshot("stty cols 194")  # Travis "terminal" width
         await self.run_oneshot("stty rows 80")  # So that enough top output shows
         await wait_shell_prompt(self.shared_state)
+        await self.shared_state.timeouts.calibrate()
+        self.reach(milestones.SHELL_READY)
+
+        tracer = self.shared_state.tracer
 
-        # Give it some other time to start zygote and all the bloat
-        await asyncio.sleep(10 * self.shared_state.vm_timeout_multiplier)
+        # The package manager lives in system_server, which is forked from zygote
+        await wait_zygote(self.shared_state)
 
         # Wait for package manager to be running
         if not await detect_package_manager(self.shared_state):
             print(Color.RED + "Warning: timeout waiting for package manager" + Color.RESET)
         else:
             print(Color.GREEN + "Package manager is running" + Color.RESET)
+        self.reach(milestones.PACKAGE_MANAGER_UP)
 
-        await self.debloat()
-        print(Color.GREEN + "System debloated" + Color.RESET)
-
-        await asyncio.sleep(10)
-        await wait_shell_prompt(self.shared_state)
+        if self.shared_state.provisioned:
+            print(Color.GREEN + "System already debloated" + Color.RESET)
+        else:
+            with tracer.span('debloat'):
+                await self.debloat()
+                print(Color.GREEN + "System debloated" + Color.RESET)
 
         await wait_shell_available(self.shared_state)
 
         print(Color.GREEN + "VM processes (top)" + Color.RESET)
-        self.shared_state.qemu_monitor_writer.write(b'top\n')
-        await self.shared_state.qemu_monitor_writer.drain()
-        await asyncio.sleep(2.7)
-        self.shared_state.qemu_monitor_writer.write(b'q')
-        await self.shared_state.qemu_monitor_writer.drain()
+        top = await run_shell(self.shared_state, 'top -b -n 1 | head -n 40')
+        if top:
+            print(top.decode(errors='replace'))
 
-        await run_and_not_expect(b'ps -A | grep dex.oat\n', b'dex2oat', 40, self.shared_state)
+        with tracer.span('dex2oat wait'):
+            await run_and_not_expect(b'ps -A | grep dex.oat\n', b'dex2oat', 40, self.shared_state)
         print(Color.GREEN + "dex2oat terminated" + Color.RESET)
 
         # Wait for boot animation to be over
-        if not await run_and_not_expect(b'ps -A | grep bootanim\n', b'bootanimation', 40, self.shared_state):
-            print(Color.RED + "Warning: timeout waiting for boot animation to stop" + Color.RESET)
-        else:
-            print(Color.GREEN + "Boot animation terminated" + Color.RESET)
+        await wait_boot_animation(self.shared_state)
+        await wait_boot_completed(self.shared_state)
+
+    async def wait_restored(self) -> bool:
+        # QEMU only starts running the guest on its own if it was running when the snapshot was taken. Snapshots are
+        # saved with the guest paused, so once the incoming migration is loaded the guest has to be resumed.
+        qmp = self.shared_state.qmp
+        deadline = asyncio.get_event_loop().time() + 120 * self.shared_state.vm_timeout_multiplier
+        while asyncio.get_event_loop().time() < deadline:
+            try:
+                status = await qmp.execute('query-status', timeout=5)
+                if status['status'] == 'running':
+                    return True
+                if status['status'] == 'paused' and \
+                        (await qmp.execute('query-migrate', timeout=5)).get('status') == 'completed':
+                    await qmp.execute('cont', timeout=5)
+                    return True
+            except (QmpError, QemuGone, asyncio.TimeoutError):
+                return False
+            if status['status'] in ('internal-error', 'io-error', 'shutdown', 'guest-panicked'):
+                return False
+            await asyncio.sleep(0.5)
+        return False
+
+    async def save_snapshot(self) -> None:
+        assert self.snapshots
+        qmp = self.shared_state.qmp
+
+        print(Color.GREEN + f"Saving VM snapshot {self.snapshots.key}" + Color.RESET)
+        # Pause the guest so the snapshot is consistent and the migration doesn't have to chase dirty pages
+        await qmp.execute('stop')
+        try:
+            await qmp.execute('migrate', {'uri': self.snapshots.migrate_uri()})
+            while True:
+                status = (await qmp.execute('query-migrate')).get('status')
+                if status == 'completed':
+                    self.snapshots.commit()
+                    print(Color.GREEN + "VM snapshot saved" + Color.RESET)
+                    return
+                if status in ('failed', 'cancelled'):
+                    self.snapshots.discard()
+                    print(Color.RED + "Warning: unable to save VM snapshot" + Color.RESET)
+                    return
+                await asyncio.sleep(0.2)
+        except QmpError as e:
+            self.snapshots.discard()
+            print(Color.RED + f"Warning: unable to save VM snapshot: {e}" + Color.RESET)
+        finally:
+            await qmp.execute('cont')
+
+    async def save_provisioned(self) -> None:
+        assert self.provision
+        qmp = self.shared_state.qmp
+        error_re = re.compile(r'(?i)error|not found|failed|cannot')
+
+        print(Color.GREEN + f"Saving provisioned image {self.provision.key}" + Color.RESET)
+        await self.run_oneshot('sync')
+        await wait_shell_prompt(self.shared_state)
+
+        # Pause the guest so nothing is written while the overlay is being merged. HMP's commit is synchronous, so the
+        # reply only comes once it's done.
+        await qmp.execute('stop')
+        try:
+            output = await qmp.hmp(self.provision.commit_command(), 600 * self.shared_state.vm_timeout_multiplier)
+            if error_re.search(output):
+                print(Color.RED + f"Warning: unable to save provisioned image: {output.strip()}" + Color.RESET)
+                return
+            self.provision.commit()
+            print(Color.GREEN + "Provisioned image saved" + Color.RESET)
+        except (QmpError, asyncio.TimeoutError) as e:
+            print(Color.RED + f"Warning: unable to save provisioned image: {e}" + Color.RESET)
+        finally:
+            await qmp.execute('cont')
+
+    async def disconnect_consoles(self) -> None:
+        self.shared_state.qemu_sock_stopdebug = True
+        for writer in (self.shared_state.qemu_serial_writer, self.shared_state.qemu_monitor_writer):
+            if writer:
+                writer.close()
+        for expect in (self.shared_state.qemu_serial_expect, self.shared_state.qemu_monitor_expect):
+            if expect:
+                expect.close()
+                expect.buffer.close()
+        if self.shared_state.qmp:
+            await self.shared_state.qmp.close()
 
     async def ensure_qemu_stopped(self) -> None:
-        if not self.shared_state.qemu_proc or self.shared_state.qemu_proc.returncode:
+        if not self.shared_state.qemu_proc:
+            return
+        if self.shared_state.qemu_proc.returncode is not None:
+            await self.disconnect_consoles()
             return
         self.shared_state.qemu_sock_stopdebug = True
         # Wait one second before killing QEMU to give time to the other workers to terminate gracefully
         await asyncio.sleep(1)
-        self.shared_state.qemu_serial_writer.close()
-        self.shared_state.qemu_monitor_writer.close()
+        await self.disconnect_consoles()
         try:
             self.shared_state.qemu_proc.terminate()
         except ProcessLookupError:
@@ -160,10 +374,31 @@ class QemuSystemManager(WorkerFSM):
 
     async def enter_state(self, state: State) -> TransitionResult:
         if state == State.QEMU_UP:
-            await asyncio.wait_for(self.ensure_qemu(), 60 * 25 * self.shared_state.vm_timeout_multiplier)
+            await asyncio.wait_for(self.ensure_qemu(), step_timeout(self.shared_state, f'{self.name}: enter QEMU_UP',
+                                                                    60 * 25))
+            return TransitionResult.DONE
+        elif state == State.ADB_UP and self.snapshots and not self.shared_state.snapshot_restored \
+                and not self.snapshots.exists():
+            # Wait for the ADB checker so the snapshot is taken with everything set up
+            await asyncio.wait_for(self.shared_state.adb_ready.wait(), 1200 * self.shared_state.vm_timeout_multiplier)
+            with self.shared_state.tracer.span('snapshot save'):
+                await asyncio.wait_for(self.save_snapshot(), 600 * self.shared_state.vm_timeout_multiplier)
+            return TransitionResult.DONE
+        elif state == State.ADB_UP and self.provision and self.provision.provisioning:
+            await asyncio.wait_for(self.shared_state.adb_ready.wait(), 1200 * self.shared_state.vm_timeout_multiplier)
+            with self.shared_state.tracer.span('provisioned image save'):
+                await self.save_provisioned()
             return TransitionResult.DONE
         elif state == State.STOP:
-            await asyncio.wait_for(self.ensure_qemu_stopped(), 10)
+            try:
+                await asyncio.wait_for(self.ensure_qemu_stopped(), 10)
+            finally:
+                if self.provision:
+                    self.provision.cleanup()
+                if self.images:
+                    await self.images.cleanup()
+                if self.shared_state.qemu_debug_log:
+                    await self.shared_state.qemu_debug_log.close()
             return TransitionResult.DONE
         return TransitionResult.NOOP
 
@@ -0,0 +1,63 @@
+import asyncio
+import re
+from typing import Optional
+
+from qemu_android_test_orchestrator import milestones
+from qemu_android_test_orchestrator.fsm import WorkerFSM, State, TransitionResult
+from qemu_android_test_orchestrator.logcat import Subscription
+from qemu_android_test_orchestrator.screenrec import ScreenCapture
+from qemu_android_test_orchestrator.shared_state import SynchronizedObject
+
+# AndroidJUnitRunner logs this for every failed test
+TEST_FAILED_RE = re.compile(rb'failed: (\S+)')
+
+
+class ScreenRecorder(WorkerFSM):
+    ensure_coro = None
+    requires = {
+        State.QEMU_UP: (milestones.QEMU_RUNNING,),
+        State.NETWORK_UP: (),
+        State.ADB_UP: (),
+    }
+
+    @property
+    def name(self) -> str:
+        return 'Screen recorder'
+
+    def __init__(self, shared_state: SynchronizedObject) -> None:
+        super().__init__(shared_state)
+        self.capture = ScreenCapture(shared_state)
+        self.logcat: Optional[Subscription] = None
+
+    async def watch_failures(self) -> None:
+        self.logcat = self.shared_state.logcat.subscribe(TEST_FAILED_RE, tags={'TestRunner'})
+        try:
+            async for entry in self.logcat:
+                match = TEST_FAILED_RE.search(entry.message)
+                if match:
+                    self.capture.failure(f"{match.group(1).decode(errors='replace')} failed")
+        finally:
+            self.logcat.close()
+            self.logcat = None
+
+    async def enter_state(self, state: State) -> TransitionResult:
+        if state == State.QEMU_UP:
+            self.capture.start()
+            return TransitionResult.DONE
+        elif state == State.JOB and self.capture.window:
+            self.ensure_coro = asyncio.create_task(self.watch_failures())
+            return TransitionResult.DONE
+        elif state == State.STOP:
+            if self.ensure_coro:
+                self.ensure_coro.cancel()
+                await asyncio.gather(self.ensure_coro, return_exceptions=True)
+                self.ensure_coro = None
+            job_proc = self.shared_state.job_proc
+            if job_proc and job_proc.returncode:
+                self.capture.failure(f"job exited with {job_proc.returncode}")
+            await self.capture.stop()
+            return TransitionResult.DONE
+        return TransitionResult.NOOP
+
+    async def exit_state(self, state: State) -> TransitionResult:
+        return TransitionResult.NOOP
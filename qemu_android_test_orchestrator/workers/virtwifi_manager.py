@@ -1,114 +1,103 @@
 import asyncio
-import base64
 import os
 
+from qemu_android_test_orchestrator import milestones
 from qemu_android_test_orchestrator.fsm import WorkerFSM, State, TransitionResult
-from qemu_android_test_orchestrator.utils import wait_shell_prompt, keypress, run_and_expect, Color, \
-    detect_package_manager, wait_shell_available, run_and_not_expect
+from qemu_android_test_orchestrator.probes import wait_until, run_shell, package_installed, activity_focused, \
+    wifi_connected
+from qemu_android_test_orchestrator.transfer import push_file
+from qemu_android_test_orchestrator.utils import keypress, Color, wait_shell_available, run_and_not_expect, \
+    step_timeout
+
+VIRTWIFI_PACKAGE = 'eu.depau.virtwificonnector'
 
 
 class VirtWifiManager(WorkerFSM):
+    # Everything goes through the serial shell, so wait for the QEMU manager to be done with it
+    requires = {
+        State.QEMU_UP: (),
+        State.NETWORK_UP: (milestones.SYSTEM_READY,),
+    }
+    provides = {
+        State.NETWORK_UP: (milestones.NETWORK_UP,),
+    }
+
     @property
     def name(self) -> str:
         return 'VirtWifi enabler'
 
-    async def ensure_virtwifi(self) -> None:
-        assert self.shared_state.config
-        apk_file = self.shared_state.config['virtwificonnector_apk']
-        if not os.access(apk_file, os.R_OK):
-            raise OSError(f"VirtWifiConnector APK path '{apk_file}' does not exist or is inaccessible")
-        with open(apk_file, 'rb') as f:
-            apk_b64 = base64.standard_b64encode(f.read())
-
-        serial = self.shared_state.qemu_serial_writer
-        assert serial
-
-        # Turn on wi-fi
-        serial.write(b'svc wifi enable\n')
-        await serial.drain()
-        await asyncio.sleep(0.5)
-        await wait_shell_prompt(self.shared_state)
-
-        await wait_shell_available(self.shared_state)
-
-        # Temporarily disable debug to avoid echoing the APK back to the log
-        debug = self.shared_state.config['qemu_debug']
-        self.shared_state.config['qemu_debug'] = False
-
-        # Write some new lines so that the debugger picks up on debug = False
-        serial.write(b'\n\n')
-        await serial.drain()
-        print(Color.GREEN +
-              "Sending VirtWifi APK" + (" (debug output suppressed temporarily)" if debug else "") + Color.RESET)
+    async def install_virtwifi(self, apk_file: str) -> None:
+        assert self.shared_state.qemu_serial_writer
+        tracer = self.shared_state.tracer
 
         # Send app apk
-        serial.write(b'base64 -d > /data/local/tmp/app.apk << EOF\n')
-        # Send the base64 string in 1KB chunks cause Python and Busybox are little cry babies
-        chunk_size = 1024
-        for i in range(0, len(apk_b64), chunk_size):
-            serial.write(apk_b64[i:i + chunk_size] + b'\n')
-            await serial.drain()
-            await asyncio.sleep(0.1)
-
-        await asyncio.sleep(0.5)
-        serial.write(b'EOF\n')
-        await serial.drain()
-
-        await wait_shell_available(self.shared_state)
-
-        serial.write(b'\n\n')
-        await serial.drain()
-
-        self.shared_state.config['qemu_debug'] = debug
-
-        serial.write(b"md5sum /data/local/tmp/app.apk\n")
+        print(Color.GREEN + "Sending VirtWifi APK" + Color.RESET)
+        with tracer.span('APK transfer'):
+            await push_file(self.shared_state, apk_file, '/data/local/tmp/app.apk')
 
         await wait_shell_available(self.shared_state)
 
         print(Color.GREEN + "VM processes (top)" + Color.RESET)
-        serial.write(b'top\n')
-        await serial.drain()
-        await asyncio.sleep(2.7)
-        serial.write(b'q')
-        await serial.drain()
-
-        await wait_shell_available(self.shared_state)
+        top = await run_shell(self.shared_state, 'top -b -n 1 | head -n 40')
+        if top:
+            print(top.decode(errors='replace'))
 
         # dex2oat likes to sneak in around here in API25 builds, let's wait for it more aggressively
-        await run_and_not_expect(b'ps -A | grep dex.oat\n', b'dex2oat', 40, self.shared_state, test_times=10)
+        with tracer.span('dex2oat wait'):
+            await run_and_not_expect(b'ps -A | grep dex.oat\n', b'dex2oat', 40, self.shared_state, test_times=10)
 
         # Install app
-        serial.write(b'pm install /data/local/tmp/app.apk\n')
-        await serial.drain()
-        await asyncio.sleep(0.5)
-
-        await wait_shell_available(self.shared_state)
+        with tracer.span('APK install'):
+            await run_shell(self.shared_state, 'pm install /data/local/tmp/app.apk', timeout=300)
+            await wait_until(self.shared_state, 'VirtWifiConnector installed',
+                             lambda: package_installed(self.shared_state, VIRTWIFI_PACKAGE), timeout=120)
 
         # We like our RAM
-        serial.write(b'rm /data/local/tmp/app.apk\n')
-        await serial.drain()
-        await asyncio.sleep(0.5)
-        await wait_shell_prompt(self.shared_state)
+        await run_shell(self.shared_state, 'rm /data/local/tmp/app.apk')
 
-        # Open app
-        serial.write(b'am start -a android.intent.action.MAIN -n '
-                     b'eu.depau.virtwificonnector/.MainActivity\n')
-        await serial.drain()
-        await wait_shell_prompt(self.shared_state)
-        await asyncio.sleep(5)
+    async def ensure_virtwifi(self) -> None:
+        assert self.shared_state.config
+        apk_file = self.shared_state.config['virtwificonnector_apk']
+        if not os.access(apk_file, os.R_OK):
+            raise OSError(f"VirtWifiConnector APK path '{apk_file}' does not exist or is inaccessible")
+
+        assert self.shared_state.qemu_serial_writer
 
+        # Turn on wi-fi
+        await run_shell(self.shared_state, 'svc wifi enable')
         await wait_shell_available(self.shared_state)
 
-        # Dismiss "old API" warning
-        # We really want it out of the way
-        for i in range(5):
-            await keypress(self.shared_state, 'esc')
+        if self.shared_state.provisioned:
+            print(Color.GREEN + "VirtWifi is already installed in the provisioned image" + Color.RESET)
+        else:
+            await self.install_virtwifi(apk_file)
 
-        await asyncio.sleep(5)
+        # Open app
+        with self.shared_state.tracer.span('launch VirtWifiConnector'):
+            await run_shell(self.shared_state, f'am start -a android.intent.action.MAIN -n '
+                                               f'{VIRTWIFI_PACKAGE}/.MainActivity')
+            await wait_until(self.shared_state, 'VirtWifiConnector focused',
+                             lambda: activity_focused(self.shared_state, VIRTWIFI_PACKAGE), timeout=60)
+            await wait_until(self.shared_state, 'Wi-Fi connected', lambda: wifi_connected(self.shared_state),
+                             timeout=60)
+
+            # Dismiss "old API" warning and the app itself. We really want it out of the way.
+            for i in range(5):
+                await keypress(self.shared_state, 'esc', settle=0)
+                if await wait_until(self.shared_state, 'VirtWifiConnector dismissed', self.dismissed, timeout=2,
+                                    warn=False):
+                    break
+
+    async def dismissed(self) -> bool:
+        return not await activity_focused(self.shared_state, VIRTWIFI_PACKAGE)
 
     async def enter_state(self, state: State) -> TransitionResult:
         if state == State.NETWORK_UP:
-            await asyncio.wait_for(self.ensure_virtwifi(), 1000 * self.shared_state.vm_timeout_multiplier)
+            if self.shared_state.snapshot_restored:
+                # VirtWifi is already connected in the restored VM
+                return TransitionResult.NOOP
+            await asyncio.wait_for(self.ensure_virtwifi(),
+                                   step_timeout(self.shared_state, f'{self.name}: enter NETWORK_UP', 1000))
             return TransitionResult.DONE
         return TransitionResult.NOOP
 
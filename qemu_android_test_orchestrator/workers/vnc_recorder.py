@@ -1,11 +1,17 @@
 import asyncio
 
+from qemu_android_test_orchestrator import milestones
 from qemu_android_test_orchestrator.fsm import WorkerFSM, State, TransitionResult
 from qemu_android_test_orchestrator.utils import Color, wait_kms
 
 
 class VncRecorder(WorkerFSM):
     ensure_coro = None
+    requires = {
+        State.QEMU_UP: (milestones.QEMU_RUNNING,),
+        State.NETWORK_UP: (),
+        State.ADB_UP: (),
+    }
 
     @property
     def name(self) -> str: